@@ -36,15 +36,80 @@ import argparse
 import glob
 import logging
 import os
+import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from dotenv import load_dotenv
 from swiftclient.service import SwiftService, SwiftUploadObject
 
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+try:
+    import confluent_kafka
+except ImportError:
+    confluent_kafka = None
+
+# objects larger than this are uploaded as segments in parallel
+SEGMENT_SIZE = 1073741824
+CONTAINER_PREFIX = "bgp-hijacks-"
+
+# consumer file name patterns, same as the ones handled by grip-swift-archiver.pl
+# the first group is the consumer name, the second group is the timestamp
+CONSUMER_FILE_PATTERNS = [
+    re.compile(r"^(announced-pfxs)\.(\d+)\.w\d+\.gz$"),                 # announced-pfxs.1506718080.w86400.gz
+    re.compile(r"^(pfx-origins)\.(\d+)\.gz$"),                          # pfx-origins.1506718080.gz
+    re.compile(r"^(routed-space)\.(\d+)\.\d+s-window\.gz$"),            # routed-space.1506717960.86400s-window.gz
+    re.compile(r"^(moas)\.(\d+)\.\d+s-window\.events\.gz$"),            # moas.1506716160.0s-window.events.gz
+    re.compile(r"^subpfx-(submoas)\.(\d+)\.events\.gz$"),               # subpfx-submoas.1506709380.events.gz
+    re.compile(r"^subpfx-(defcon)\.(\d+)\.events\.gz$"),                # subpfx-defcon.1506715740.events.gz
+    re.compile(r"^(edges)\.(\d+)\.\d+s-window\.events\.gz$"),           # edges.1506707160.0s-window.events.gz
+]
+# consumers whose window size is unused and removed from the object name
+WINDOWED_CONSUMERS = ["moas", "edges"]
+
+
+class Announcer:
+    """
+    Announcer publishes upload announcements to Kafka, in the same format as `grip-announce`.
+
+    Messages are batched by the producer and delivered in the background.
+    """
+
+    def __init__(self, brokers, topic, linger_ms=1000):
+        assert confluent_kafka is not None, "confluent_kafka is required for announcements"
+        self.topic = topic
+        self.failed = 0
+        self.producer = confluent_kafka.Producer({
+            "bootstrap.servers": brokers,
+            "linger.ms": linger_ms,
+        })
+
+    def _on_delivery(self, err, msg):
+        if err is not None:
+            self.failed += 1
+            logging.error("announcement delivery failed: {} ({})".format(msg.value(), err))
+
+    def announce(self, consumer, container, obj, ts):
+        announcement = "swift consumer {} {} {} {}".format(consumer, container, obj, ts)
+        self.producer.produce(self.topic, announcement.encode(), on_delivery=self._on_delivery)
+        # serve delivery callbacks of earlier batches
+        self.producer.poll(0)
+
+    def close(self, timeout=30):
+        remaining = self.producer.flush(timeout)
+        if remaining:
+            logging.error("{} announcements not delivered".format(remaining))
+
 
 class SwiftUtils:
-    def __init__(self, env):
+    def __init__(self, env, segment_size=SEGMENT_SIZE, segment_threads=4, container_prefix=CONTAINER_PREFIX,
+                 announcer=None):
         # load swift credentials
         load_dotenv(env, override=True)
         swift_auth_options = {
@@ -57,27 +122,36 @@ class SwiftUtils:
 
         self.auth_options = swift_auth_options
         assert not any([option is None for option in self.auth_options.values()])
-        self.swift_service = SwiftService(self.auth_options)
+        self.segment_size = segment_size
+        self.container_prefix = container_prefix
+        self.announcer = announcer
+        # one service for all uploads, its connections stay authenticated between files
+        self.swift_service = SwiftService(dict(self.auth_options, segment_threads=segment_threads))
 
     def _parse_file_name(self, filename):
-        relative_fn = filename.split("/")[-1]
-        timestr = relative_fn.split(".")[1]
-        ts = int(timestr)
-        datestr = datetime.utcfromtimestamp(ts).strftime("year=%Y/month=%m/day=%d/hour=%H")
+        """
+        Find the consumer, timestamp, upload destination and container of a consumer file.
 
-        parts = relative_fn.split(".")
-        file_type = parts[0]
-        assert file_type in ["moas", "pfx-origins"]
-        if file_type == "moas":
-            container = "bgp-hijacks-moas"
-            del parts[2]
-        elif file_type == "pfx-origins":
-            container = "bgp-hijacks-pfx-origins"
+        :return: tuple of (destination object name, container, consumer, timestamp)
+        """
+        relative_fn = filename.split("/")[-1]
+        for pattern in CONSUMER_FILE_PATTERNS:
+            match = pattern.match(relative_fn)
+            if match:
+                break
         else:
-            container = ""
+            raise ValueError("unrecognized consumer file: {}".format(relative_fn))
 
-        dst = "{}/{}".format(datestr, ".".join(parts))
-        return dst, container
+        consumer = match.group(1)
+        ts = int(match.group(2))
+        if consumer in WINDOWED_CONSUMERS:
+            # window is unused, remove from file name
+            relative_fn = "{}.{}.events.gz".format(consumer, ts)
+        datestr = datetime.utcfromtimestamp(ts).strftime("year=%Y/month=%m/day=%d/hour=%H")
+        container = self.container_prefix + consumer
+
+        dst = "{}/{}".format(datestr, relative_fn)
+        return dst, container, consumer, ts
 
     def upload(self, filename, check_done_flag=True, delete_on_success=True, no_op=False):
         # INPUT:  moas.1577786400.36000s-window.events.gz
@@ -86,18 +160,27 @@ class SwiftUtils:
         # check done flag first
         if check_done_flag and not os.path.exists(filename+".done"):
             logging.warning(".done flag file not exist for {}".format(filename))
-            return
+            return False
 
         # extract to upload destination name and container based on input file
-        dst, container = self._parse_file_name(filename)
+        dst, container, consumer, ts = self._parse_file_name(filename)
         logging.info("to upload: {} to {}/{} ...".format(filename, container, dst))
 
         if no_op:
             logging.info("\tupload and deletion skipped")
-            return
-        for r in self.swift_service.upload(container, [SwiftUploadObject(filename, dst)]):
-            if r['success']:
-                if 'object' in r:
+            return True
+        success = True
+        options = {
+            "segment_size": self.segment_size,
+            "segment_container": ".{}-segments".format(container),
+        }
+        for r in self.swift_service.upload(container, [SwiftUploadObject(filename, dst)], options=options):
+            if not r['success']:
+                success = False
+                logging.error("\tupload failed: {} {}".format(r.get('action'), r.get('error')))
+            elif success:
+                # segment uploads report their own results, only act on the final object
+                if r.get('action') == 'upload_object':
                     logging.info("\tuploaded: {}".format(r['object']))
 
                     # attempt to delete input file if succeeded
@@ -110,7 +193,154 @@ class SwiftUtils:
                         except OSError:
                             pass
 
+        if success and self.announcer is not None:
+            # announce that this file is now available for further processing
+            self.announcer.announce(consumer, container, dst, ts)
+
         logging.info("\tdone")
+        return success
+
+
+class UploadDaemon:
+    """
+    UploadDaemon watches a directory for `.done` flag files and uploads the corresponding data files to Swift using a
+    bounded pool of concurrent uploads.
+
+    Flag files are detected with inotify if `inotify_simple` is installed, otherwise the directory is polled.
+    Failed uploads are retried with exponential backoff. Queue depth and upload throughput are logged periodically.
+    """
+
+    def __init__(self, swift_utils, directory, workers=4, max_retries=5, backoff=10, delete=False, no_op=False,
+                 poll_interval=5, stats_interval=60):
+        self.swift_utils = swift_utils
+        self.directory = directory
+        self.workers = workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.delete = delete
+        self.no_op = no_op
+        self.poll_interval = poll_interval
+        self.stats_interval = stats_interval
+
+        self.lock = threading.Lock()
+        self.in_flight = set()
+        self.uploaded = set()
+        self.failed = set()
+        self.active = 0
+
+        # statistics
+        self.uploaded_files = 0
+        self.uploaded_bytes = 0
+        self.stats_ts = time.time()
+        self.stats_bytes = 0
+
+    def _done_files(self):
+        return [fn[:-len(".done")] for fn in glob.glob("{}/*.gz.done".format(self.directory))]
+
+    def _open_watch(self):
+        """
+        Register the inotify watch, if available, before the directory is scanned for files finished earlier, so that no
+        flag file created in between is missed.
+        """
+        if INotify is None:
+            logging.info("inotify_simple not available, polling {} every {} seconds".format(
+                self.directory, self.poll_interval))
+            return None
+        inotify = INotify()
+        inotify.add_watch(self.directory, flags.CLOSE_WRITE | flags.MOVED_TO)
+        return inotify
+
+    def _prune_uploaded(self, files):
+        with self.lock:
+            # only remember uploaded files that are still on disk
+            self.uploaded.intersection_update(files)
+
+    def _watch(self, inotify):
+        """
+        Generate batches of data files whose .done flag file appeared.
+        """
+        if inotify is None:
+            while True:
+                time.sleep(self.poll_interval)
+                files = self._done_files()
+                self._prune_uploaded(files)
+                yield files
+
+        prune_ts = time.time()
+        while True:
+            events = inotify.read(timeout=self.stats_interval * 1000)
+            yield [os.path.join(self.directory, e.name[:-len(".done")]) for e in events if e.name.endswith(".gz.done")]
+            if time.time() - prune_ts >= self.stats_interval:
+                self._prune_uploaded(self._done_files())
+                prune_ts = time.time()
+
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            rate = (self.uploaded_bytes - self.stats_bytes) / max(now - self.stats_ts, 1)
+            return {
+                "queue_depth": len(self.in_flight) - self.active,
+                "active_uploads": self.active,
+                "uploaded_files": self.uploaded_files,
+                "uploaded_bytes": self.uploaded_bytes,
+                "failed_files": len(self.failed),
+                "bytes_per_sec": rate,
+            }
+
+    def _log_stats_if_due(self):
+        if time.time() - self.stats_ts < self.stats_interval:
+            return
+        logging.info("uploader stats: {}".format(self.stats()))
+        with self.lock:
+            self.stats_ts = time.time()
+            self.stats_bytes = self.uploaded_bytes
+
+    def _submit(self, executor, filename):
+        with self.lock:
+            if filename in self.in_flight or filename in self.uploaded or filename in self.failed:
+                return
+            self.in_flight.add(filename)
+        executor.submit(self._upload, filename)
+
+    def _upload(self, filename):
+        with self.lock:
+            self.active += 1
+        try:
+            size = os.path.getsize(filename) if os.path.exists(filename) else 0
+            for attempt in range(self.max_retries + 1):
+                try:
+                    if self.swift_utils.upload(filename, delete_on_success=self.delete, no_op=self.no_op):
+                        with self.lock:
+                            self.uploaded.add(filename)
+                            self.uploaded_files += 1
+                            self.uploaded_bytes += size
+                        return
+                except ValueError as error:
+                    # not a consumer file, retrying will not help
+                    logging.warning("skipping {}: {}".format(filename, error))
+                    break
+                except Exception as error:
+                    logging.error("uploading {} failed: {}".format(filename, error))
+                if attempt < self.max_retries:
+                    time.sleep(self.backoff * (2 ** attempt))
+            logging.error("giving up uploading {}".format(filename))
+            with self.lock:
+                self.failed.add(filename)
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.in_flight.discard(filename)
+
+    def run(self):
+        inotify = self._open_watch()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # catch up with files finished before the daemon started
+            for filename in self._done_files():
+                self._submit(executor, filename)
+            for filenames in self._watch(inotify):
+                for filename in filenames:
+                    self._submit(executor, filename)
+                self._log_stats_if_due()
 
 
 def main():
@@ -130,6 +360,20 @@ def main():
                         help="debug, no action executed")
     parser.add_argument("-D", "--delete", action="store_true", default=False,
                         help="delete original file on upload success")
+    parser.add_argument("-w", "--workers", type=int, default=4,
+                        help="number of concurrent uploads")
+    parser.add_argument("-r", "--retries", type=int, default=5,
+                        help="number of retries for failed uploads")
+    parser.add_argument("--segment-size", type=int, default=SEGMENT_SIZE,
+                        help="upload files larger than this many bytes as segments")
+    parser.add_argument("--stats-interval", type=int, default=60,
+                        help="seconds between logging queue depth and throughput")
+    parser.add_argument("-c", "--container-prefix", default=CONTAINER_PREFIX,
+                        help="prefix of the swift container names, followed by the consumer name")
+    parser.add_argument("-b", "--brokers", nargs="?",
+                        help="comma-separated list of Kafka brokers to publish upload announcements to")
+    parser.add_argument("-a", "--announce-topic", nargs="?",
+                        help="Kafka topic to publish upload announcements to, no announcements if not specified")
 
     logging.basicConfig(level="INFO",
                         format="%(asctime)s|%(levelname)s: %(message)s",
@@ -137,15 +381,18 @@ def main():
 
     opts, _ = parser.parse_known_args()
 
-    swift_utils = SwiftUtils(env=opts.env)
-    files = []
-    while True:
-        for filename in glob.glob("{}/*.gz".format(opts.dir)):
-            files.append(filename)
-            swift_utils.upload(filename, delete_on_success=opts.delete, no_op=opts.no_op)
-
-        time.sleep(3600)
+    announcer = None
+    if opts.announce_topic:
+        announcer = Announcer(opts.brokers, opts.announce_topic)
 
+    swift_utils = SwiftUtils(env=opts.env, segment_size=opts.segment_size, container_prefix=opts.container_prefix,
+                             announcer=announcer)
+    try:
+        UploadDaemon(swift_utils, opts.dir, workers=opts.workers, max_retries=opts.retries, delete=opts.delete,
+                     no_op=opts.no_op, stats_interval=opts.stats_interval).run()
+    finally:
+        if announcer is not None:
+            announcer.close()
 
 
 if __name__ == "__main__":
@@ -34,10 +34,31 @@ import argparse
 import gzip
 import json
 import logging
+import multiprocessing as mp
+import os
+import textwrap
 from datetime import datetime
 
 from bgphijacks.utils.data.elastic import ElasticConn
 from bgphijacks.utils.data.elastic_queries import query_in_range
+from scripts.utils.daily_index import list_daily_indices
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+EVENT_URL = "https://dev.hicube.caida.org/feeds/hijacks/events/{}/{}"
+
+# number of events buffered by each worker before writing a row group
+ROW_GROUP_SIZE = 100000
+
+MANIFEST_NAME = "manifest.json"
+
+# default threshold of -S: the lowest non-zero suspicion level, i.e. the same boundary as the `_normal` file, which
+# holds the events with suspicion_level > 0
+SUSPICIOUS_LEVEL = 1
 
 
 class Exporter:
@@ -49,7 +70,8 @@ class Exporter:
         self.event_type = event_type
         self.esconn = ElasticConn()
 
-    def list_events(self, start_ts, end_ts, min_susp=None, max_susp=None, simplify=True):
+    def list_events(self, start_ts, end_ts, min_susp=None, max_susp=None, simplify=True, index_pattern=None,
+                    with_url=True):
         """
         Rerun the inference code for the given time period.
 
@@ -58,6 +80,8 @@ class Exporter:
         :param simplify:
         :param start_ts:
         :param end_ts:
+        :param index_pattern: index pattern to search, defaults to all indices of the event type
+        :param with_url: include the event page url in simplified events
         :return:
         """
         show_time(start_ts, "start_ts")
@@ -65,32 +89,112 @@ class Exporter:
         query = query_in_range(start_ts, end_ts, min_susp=min_susp, max_susp=max_susp)
         if simplify:
             query["_source"] = ["id", "event_type", "view_ts", "last_modified_ts", "summary"]  # we only want timestamps
-        index_pattern = self.esconn.get_index_name(event_type=self.event_type)
+        if index_pattern is None:
+            index_pattern = self.esconn.get_index_name(event_type=self.event_type)
         logging.info(index_pattern)
 
         for e in self.esconn.search_generator(index=index_pattern, query=query, raw_json=simplify):
             if simplify:
                 # we will have e as raw json, and then simply it
-                inf = e["summary"]["inference_result"]
-                try:
-                    event = {
-                        "event_id": e["id"],
-                        "event_type": e["event_type"],
-                        "event_time": e["view_ts"],
-                        "property_tags": e["summary"]["tags"],
-                        "inference_tags": [i["inference_id"] for i in inf["inferences"]],
-                        "suspicion_level": inf["primary_inference"]["suspicion_level"],
-                        "confidence": inf["primary_inference"]["confidence"],
-                        "url": f"https://dev.hicube.caida.org/feeds/hijacks/events/{e['event_type']}/{e['id']}"
-                    }
-                    # print(event)
-                    yield event
-                except TypeError as error:
-                    print(json.dumps(e, indent=4))
-                    raise error
+                yield simplify_event(e, with_url=with_url)
             else:
                 yield e
 
+    def list_daily_indices(self, start_ts=None, end_ts=None):
+        """
+        List the daily indices of the event type, skipping those whose date suffix falls outside the time range.
+
+        :param start_ts:
+        :param end_ts:
+        :return: sorted list of index names
+        """
+        index_pattern = self.esconn.get_index_name(event_type=self.event_type)
+        return list_daily_indices(self.esconn, index_pattern, start_ts, end_ts)
+
+
+def simplify_event(e, with_url=True):
+    inf = e["summary"]["inference_result"]
+    try:
+        event = {
+            "event_id": e["id"],
+            "event_type": e["event_type"],
+            "event_time": e["view_ts"],
+            "property_tags": e["summary"]["tags"],
+            "inference_tags": [i["inference_id"] for i in inf["inferences"]],
+            "suspicion_level": inf["primary_inference"]["suspicion_level"],
+            "confidence": inf["primary_inference"]["confidence"],
+        }
+        if with_url:
+            event["url"] = EVENT_URL.format(e["event_type"], e["id"])
+        return event
+    except TypeError as error:
+        print(json.dumps(e, indent=4))
+        raise error
+
+
+def columnar_schema():
+    return pa.schema([
+        ("event_id", pa.string()),
+        ("event_type", pa.string()),
+        ("event_time", pa.int64()),
+        ("property_tags", pa.list_(pa.string())),
+        ("inference_tags", pa.list_(pa.string())),
+        ("suspicion_level", pa.int64()),
+        ("confidence", pa.float64()),
+    ])
+
+
+class ColumnarWriter:
+    """
+    ColumnarWriter buffers simplified events column by column and writes them as Parquet row groups or Arrow record
+    batches.
+    """
+
+    def __init__(self, path, fmt="parquet", row_group_size=ROW_GROUP_SIZE):
+        assert pa is not None, "pyarrow is required for columnar exports"
+        assert fmt in ("parquet", "arrow")
+        self.path = path
+        self.schema = columnar_schema()
+        self.row_group_size = row_group_size
+        self.columns = {name: [] for name in self.schema.names}
+        self.count = 0
+        self.min_ts = None
+        self.max_ts = None
+        if fmt == "parquet":
+            self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+        else:
+            self.sink = pa.OSFile(path, "wb")
+            self.writer = pa.ipc.new_file(self.sink, self.schema)
+        self.fmt = fmt
+
+    def write(self, event):
+        for name, column in self.columns.items():
+            column.append(event[name])
+        ts = event["event_time"]
+        self.min_ts = ts if self.min_ts is None else min(self.min_ts, ts)
+        self.max_ts = ts if self.max_ts is None else max(self.max_ts, ts)
+        self.count += 1
+        if len(self.columns["event_id"]) >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if not self.columns["event_id"]:
+            return
+        batch = pa.RecordBatch.from_arrays(
+            [pa.array(self.columns[field.name], type=field.type) for field in self.schema], schema=self.schema)
+        if self.fmt == "parquet":
+            self.writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+        for column in self.columns.values():
+            column.clear()
+
+    def close(self):
+        self._flush()
+        self.writer.close()
+        if self.fmt == "arrow":
+            self.sink.close()
+
 
 def show_time(ts: int, name: str, count=None):
     if ts:
@@ -102,7 +206,67 @@ def show_time(ts: int, name: str, count=None):
         logging.info(log_str)
 
 
-def dump_events(event_type, start_ts, end_ts, dump_all):
+class EventWriter:
+    """
+    EventWriter writes events to a file as they arrive, either as one JSON document per line (NDJSON) or as a JSON
+    array written incrementally, so memory use does not grow with the number of events exported. JSON arrays are laid
+    out exactly as `json.dump(events, fh, indent=4, sort_keys=True)` would.
+    """
+
+    def __init__(self, path, fmt="json"):
+        assert fmt in ("ndjson", "json")
+        self.path = path
+        self.fmt = fmt
+        self.count = 0
+        opener = gzip.open if path.endswith(".gz") else open
+        self.fh = opener(path, "wt")
+        if self.fmt == "json":
+            self.fh.write("[")
+
+    def write(self, event):
+        if self.fmt == "json":
+            self.fh.write(",\n" if self.count else "\n")
+            self.fh.write(textwrap.indent(json.dumps(event, indent=4, sort_keys=True), " " * 4))
+        else:
+            self.fh.write(json.dumps(event, sort_keys=True))
+            self.fh.write("\n")
+        self.count += 1
+
+    def close(self):
+        if self.fmt == "json":
+            self.fh.write("\n]" if self.count else "]")
+        self.fh.close()
+        logging.info("wrote {} events to {}".format(self.count, self.path))
+
+
+class EventRouter:
+    """
+    EventRouter sends each event to every writer whose condition it matches, in a single pass over the events.
+    """
+
+    def __init__(self):
+        self.routes = []
+
+    def add_route(self, writer, condition=None):
+        self.routes.append((writer, condition))
+
+    def write(self, event):
+        for writer, condition in self.routes:
+            if condition is None or condition(event):
+                writer.write(event)
+
+    def close(self):
+        for writer, _ in self.routes:
+            writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def dump_events(event_type, start_ts, end_ts, dump_all, fmt="json", prefix="grip_events", suspicious_level=None):
     lister = Exporter(event_type)
 
     if dump_all:
@@ -114,21 +278,79 @@ def dump_events(event_type, start_ts, end_ts, dump_all):
                 if count % 10000 == 0:
                     show_time(event.view_ts, "event_ts", count=count)
     else:
-        normal_events = []
-        all_events = []
-        for event in lister.list_events(start_ts=start_ts, end_ts=end_ts):
-            all_events.append(event)
-            if event["suspicion_level"] > 0:
-                normal_events.append(event)
-            if len(all_events) % 10000 == 0:
-                print(datetime.utcfromtimestamp(event["event_time"]))
-                print(f"{len(normal_events)}/{len(all_events)}")
-                print(event)
-
-        with open("grip_events_normal.json", "w") as nof:
-            json.dump(normal_events, nof, indent=4, sort_keys=True)
-        with open("grip_events_all.json", "w") as aof:
-            json.dump(all_events, aof, indent=4, sort_keys=True)
+        ext = "jsonl" if fmt == "ndjson" else "json"
+        with EventRouter() as router:
+            router.add_route(EventWriter("{}_all.{}".format(prefix, ext), fmt))
+            router.add_route(EventWriter("{}_normal.{}".format(prefix, ext), fmt),
+                             lambda e: e["suspicion_level"] > 0)
+            if suspicious_level is not None:
+                # disjoint split by suspicion level, under names that do not exist in the default output
+                router.add_route(EventWriter("{}_below_{}.{}".format(prefix, suspicious_level, ext), fmt),
+                                 lambda e: e["suspicion_level"] < suspicious_level)
+                router.add_route(EventWriter("{}_from_{}.{}".format(prefix, suspicious_level, ext), fmt),
+                                 lambda e: e["suspicion_level"] >= suspicious_level)
+
+            count = 0
+            for event in lister.list_events(start_ts=start_ts, end_ts=end_ts):
+                router.write(event)
+                count += 1
+                if count % 10000 == 0:
+                    show_time(event["event_time"], "event_ts", count=count)
+
+
+def export_index_part(event_type, index, start_ts, end_ts, out_dir, fmt, row_group_size=ROW_GROUP_SIZE):
+    """
+    Export the simplified events of one daily index to one columnar part file.
+
+    :return: manifest entry of the part, or None if the index has no events in the time range
+    """
+    lister = Exporter(event_type)
+    path = os.path.join(out_dir, "part-{}.{}".format(index, fmt))
+    writer = None
+    for event in lister.list_events(start_ts=start_ts, end_ts=end_ts, index_pattern=index, with_url=False):
+        if writer is None:
+            writer = ColumnarWriter(path, fmt, row_group_size)
+        writer.write(event)
+    if writer is None:
+        return None
+    writer.close()
+    logging.info("exported {} events from {}".format(writer.count, index))
+    return {
+        "file": os.path.basename(path),
+        "index": index,
+        "rows": writer.count,
+        "min_event_time": writer.min_ts,
+        "max_event_time": writer.max_ts,
+    }
+
+
+def export_columnar(event_type, start_ts, end_ts, out_dir, fmt="parquet", processes=1,
+                    row_group_size=ROW_GROUP_SIZE):
+    """
+    Export simplified events to columnar files, one part per daily index exported by a pool of processes, tied
+    together by a manifest.
+    """
+    assert pa is not None, "pyarrow is required for columnar exports"
+    os.makedirs(out_dir, exist_ok=True)
+    indices = Exporter(event_type).list_daily_indices(start_ts, end_ts)
+    logging.info("exporting {} daily indices with {} processes".format(len(indices), processes))
+
+    args = [(event_type, index, start_ts, end_ts, out_dir, fmt, row_group_size) for index in indices]
+    with mp.Pool(processes=processes) as pool:
+        parts = [part for part in pool.starmap(export_index_part, args, chunksize=1) if part]
+
+    manifest = {
+        "event_type": event_type,
+        "start_ts": start_ts,
+        "end_ts": end_ts,
+        "format": fmt,
+        "schema": [{"name": field.name, "type": str(field.type)} for field in columnar_schema()],
+        "rows": sum(part["rows"] for part in parts),
+        "parts": parts,
+    }
+    with open(os.path.join(out_dir, MANIFEST_NAME), "w") as mf:
+        json.dump(manifest, mf, indent=4)
+    logging.info("exported {} events in {} parts to {}".format(manifest["rows"], len(parts), out_dir))
 
 
 def main():
@@ -146,6 +368,21 @@ def main():
                         help="end time for rerun (unix time)")
     parser.add_argument("-d", "--dump_all", action="store_true", default=False,
                         help="dump all events in one gz file")
+    parser.add_argument("-f", "--format", choices=["json", "ndjson", "parquet", "arrow"], default="json",
+                        help="output format of simplified events: a JSON array (default, <prefix>_all.json and "
+                             "<prefix>_normal.json), one event per line (.jsonl), or columnar parquet/arrow parts "
+                             "exported per daily index")
+    parser.add_argument("-O", "--output-dir", nargs="?", default="grip_events",
+                        help="output directory of columnar exports")
+    parser.add_argument('-p', '--processes', nargs="?", type=int, default=1,
+                        help="Number of processes exporting daily indices in columnar exports, specify 0 to use all "
+                             "available cores")
+    parser.add_argument("-o", "--prefix", nargs="?", default="grip_events",
+                        help="prefix of simplified output files")
+    parser.add_argument("-S", "--suspicious-level", type=int, nargs="?", const=SUSPICIOUS_LEVEL,
+                        help="also split the events into two disjoint files by suspicion level: "
+                             "<prefix>_below_<level> and <prefix>_from_<level>; the level defaults to %(const)s, the "
+                             "boundary used by <prefix>_normal (suspicion_level > 0)")
 
     opts = parser.parse_args()
     logging.basicConfig(format="%(levelname)s %(asctime)s: %(message)s",
@@ -153,7 +390,12 @@ def main():
                         level=logging.INFO)
 
     logging.getLogger('elasticsearch').setLevel(logging.INFO)
-    dump_events(opts.type, opts.start_ts, opts.end_ts, opts.dump_all)
+    if opts.format in ("parquet", "arrow") and not opts.dump_all:
+        processes = opts.processes if opts.processes > 0 else os.cpu_count()
+        export_columnar(opts.type, opts.start_ts, opts.end_ts, opts.output_dir, opts.format, processes)
+    else:
+        dump_events(opts.type, opts.start_ts, opts.end_ts, opts.dump_all, opts.format, opts.prefix,
+                    opts.suspicious_level)
 
 
 if __name__ == "__main__":
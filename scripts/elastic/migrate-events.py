@@ -30,7 +30,6 @@
 #  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
 #  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
 import argparse
-import hashlib
 import json
 import logging
 import multiprocessing as mp
@@ -43,6 +42,11 @@ import filelock as filelock
 from bgphijacks.events.event import Event
 from bgphijacks.utils.data.elastic import ElasticConn
 from bgphijacks.utils.data.elastic_queries import query_in_range
+from scripts.utils.checkpoint import run_hash
+from scripts.utils.daily_index import list_daily_indices
+from scripts.utils.elastic_bulk import BulkIndexer
+from scripts.utils.elastic_fetch import mget_events
+from scripts.utils.elastic_tasks import TASK_POLL_INTERVAL, wait_for_task
 
 
 class InferenceRunner:
@@ -84,6 +88,101 @@ class InferenceRunner:
                     else:
                         raise error
 
+    def rerun_diff(self, start_ts, end_ts, old_index_pattern, page_size=1000):
+        """
+        Copy missing events page by page: check existence of a whole page of ids with one request, fetch only the
+        missing documents with another, and commit them in bulk.
+
+        :param start_ts:
+        :param end_ts:
+        :param old_index_pattern: index pattern to read event ids from
+        :param page_size: number of event ids to check at once
+        :return:
+        """
+        self._show_time(start_ts, "start")
+        self._show_time(end_ts, "end")
+
+        query = query_in_range(start_ts, end_ts, size=10000)
+        copied = 0
+        with BulkIndexer(es_conn=self.esconn, debug=self.debug) as indexer:
+            page = []
+            for event_id in self.esconn.id_generator(index=old_index_pattern, query=query):
+                page.append(event_id)
+                if len(page) >= page_size:
+                    copied += self._copy_missing(page, indexer)
+                    page = []
+            if page:
+                copied += self._copy_missing(page, indexer)
+        logging.info("copied {} missing events".format(copied))
+
+    def _copy_missing(self, event_ids, indexer):
+        indices = {event_id: self.esconn.infer_index_name_by_id(event_id) for event_id in event_ids}
+        existing = mget_events(self.esconn, [(indices[event_id], event_id) for event_id in event_ids], source=False)
+        missing = [event_id for event_id in event_ids if existing.get(event_id) is None]
+        if not missing:
+            return 0
+
+        docs = mget_events(self.esconn, [(indices[event_id].replace("v3", "v2"), event_id) for event_id in missing],
+                           raw_json=True)
+        copied = 0
+        for event_id in missing:
+            doc = docs.get(event_id)
+            if doc is None:
+                logging.warning("event missing from source index: {}".format(event_id))
+                continue
+            # commit the same content as `rerun`; in debug mode the indexer picks the test index
+            indexer.add_event(Event.from_dict(doc), index=None if self.debug else indices[event_id])
+            copied += 1
+        return copied
+
+    def reindex(self, start_ts, end_ts, old_index_pattern, src_version="v2", dst_version="v3",
+                requests_per_second=-1, poll_interval=TASK_POLL_INTERVAL):
+        """
+        Migrate events with server-side reindex tasks, one per source daily index, so documents never leave the cluster.
+        Events already present in the destination index are kept as they are. Daily source indices outside of the time
+        range are skipped. Debug mode is not supported, as destination names are derived from the source indices.
+
+        :param start_ts:
+        :param end_ts:
+        :param old_index_pattern: pattern of the source indices
+        :param src_version: version string in the source index names
+        :param dst_version: version string replacing it in the destination index names
+        :param requests_per_second: throttle of each reindex task, -1 for no throttling
+        :param poll_interval: seconds between task progress checks
+        :return:
+        """
+        if self.debug:
+            raise ValueError("reindex does not support debug mode")
+        self._show_time(start_ts, "start")
+        self._show_time(end_ts, "end")
+
+        body_query = None
+        if start_ts or end_ts:
+            body_query = query_in_range(start_ts, end_ts)["query"]
+
+        # daily indices outside of the time range have nothing to migrate
+        for src_index in list_daily_indices(self.esconn, old_index_pattern, start_ts, end_ts):
+            if src_version not in src_index:
+                logging.info("skipping index without {} in its name: {}".format(src_version, src_index))
+                continue
+            dst_index = src_index.replace(src_version, dst_version)
+            self._reindex_index(src_index, dst_index, body_query, requests_per_second, poll_interval)
+
+    def _reindex_index(self, src_index, dst_index, body_query, requests_per_second, poll_interval):
+        source = {"index": src_index}
+        if body_query:
+            source["query"] = body_query
+        body = {
+            "source": source,
+            # only create missing events in the destination index
+            "dest": {"index": dst_index, "op_type": "create"},
+            "conflicts": "proceed",
+        }
+        res = self.esconn.es.reindex(body=body, slices="auto", requests_per_second=requests_per_second,
+                                     wait_for_completion=False)
+        logging.info("reindexing {} -> {}: task {}".format(src_index, dst_index, res["task"]))
+        wait_for_task(self.esconn, res["task"], name=src_index, poll_interval=poll_interval)
+
     @staticmethod
     def _event_in_range(event: Event, before, after):
         if before and event.insert_ts > before:
@@ -99,9 +198,12 @@ class InferenceRunner:
             logging.info("{}: {}".format(name, dt_object))
 
 
-def run_process(debug, start_ts, end_ts, old_index_pattern):
-    InferenceRunner(debug) \
-        .rerun(start_ts, end_ts, old_index_pattern)
+def run_process(debug, start_ts, end_ts, old_index_pattern, diff=False, page_size=1000):
+    runner = InferenceRunner(debug)
+    if diff:
+        runner.rerun_diff(start_ts, end_ts, old_index_pattern, page_size=page_size)
+    else:
+        runner.rerun(start_ts, end_ts, old_index_pattern)
 
 
 def main():
@@ -124,6 +226,18 @@ def main():
     parser.add_argument('-p', '--processes', nargs="?", type=int, required=False,
                         default=1,
                         help="Number of processes to divide the time range and run, specify 0 to use all available cores")
+    parser.add_argument("-R", "--reindex", action="store_true", default=False,
+                        help="Migrate with server-side reindex tasks, one per source daily index")
+    parser.add_argument("--src-version", nargs="?", default="v2",
+                        help="Version string in source index names for reindex mode")
+    parser.add_argument("--dst-version", nargs="?", default="v3",
+                        help="Version string in destination index names for reindex mode")
+    parser.add_argument("--requests-per-second", nargs="?", type=float, default=-1,
+                        help="Throttle of each reindex task, -1 to disable throttling")
+    parser.add_argument("-D", "--diff", action="store_true", default=False,
+                        help="Check existence of a page of events at once and copy missing ones in bulk")
+    parser.add_argument("-P", "--page-size", nargs="?", type=int, default=1000,
+                        help="Number of events to check at once in diff mode")
 
     opts = parser.parse_args()
     logging.basicConfig(format="%(levelname)s %(asctime)s: %(message)s",
@@ -140,13 +254,24 @@ def main():
             "cannot start multi-threading due to lack of end_ts or start_ts, forced back to single-thread processing")
         processes = 1
 
-    hash_str = hashlib.sha1((json.dumps(vars(opts), sort_keys=True, ensure_ascii=True)).encode()).hexdigest()
+    if opts.reindex and opts.debug:
+        # reindex tasks write to the production index names derived from the source indices
+        parser.error("--reindex does not support --debug")
+    if opts.reindex and processes > 1:
+        logging.info("reindex mode is sliced by elasticsearch, forced back to single-thread processing")
+        processes = 1
+
+    hash_str = run_hash(opts)
     lockfile = "/tmp/inference-runner-{}.lock".format(hash_str)
     lock = filelock.FileLock(lockfile)
     with lock.acquire(timeout=1):
         if processes == 1:
             logging.info("single-threaded processing starts...")
-            run_process(opts.debug, opts.start_ts, opts.end_ts, opts.old_index)
+            if opts.reindex:
+                InferenceRunner(opts.debug).reindex(opts.start_ts, opts.end_ts, opts.old_index, opts.src_version,
+                                                    opts.dst_version, opts.requests_per_second)
+            else:
+                run_process(opts.debug, opts.start_ts, opts.end_ts, opts.old_index, opts.diff, opts.page_size)
         else:
             args = []
             step = int((opts.end_ts - opts.start_ts) / processes)
@@ -154,7 +279,7 @@ def main():
             while cur_ts < opts.end_ts:
                 cur_end = cur_ts + step
                 args.append(
-                    (opts.debug, cur_ts, cur_end, opts.old_index))
+                    (opts.debug, cur_ts, cur_end, opts.old_index, opts.diff, opts.page_size))
                 cur_ts += step
             # logging.info(*args)
 
@@ -29,10 +29,12 @@
 #  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
 #  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
 #  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+import argparse
 import gzip
+import itertools
 import logging
 
-from ripe.atlas.cousteau import MeasurementRequest, AtlasResultsRequest
+from ripe.atlas.cousteau import MeasurementRequest
 from bgphijacks.active.ripe_atlas.ripe_atlas_msm import AtlasMeasurement as HijacksMeasurement
 import re
 
@@ -52,6 +54,31 @@ from bgphijacks.utils.data.elastic import ElasticConn
 from bgphijacks.utils.data.elastic_queries import query_missing_traceroutes
 import json
 
+from scripts.utils.atlas_results import DEFAULT_ATLAS_URL, DEFAULT_CACHE_DIR, AtlasResultsFetcher
+from scripts.utils.pfx2as_trie import DailyPfx2AsTries, Pfx2AsSnapshotDB
+
+# number of events whose measurement results are fetched together
+EVENTS_CHUNK_SIZE = 100
+
+# measurements were only scheduled for events since 2019-01-01
+MIN_REFILL_TS = 1546300800
+
+
+def event_id_ts(event_id):
+    """
+    Extract the view timestamp from an event id, e.g. moas-1546298700-136450_138522_65529
+    """
+    return int(event_id.split("-")[1])
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
 
 class RefillMsms:
 
@@ -62,9 +89,21 @@ class RefillMsms:
         "edges": "^edges-\\d+-[\\d\-_]+:\\d+$",
     }
 
-    def __init__(self):
+    def __init__(self, fetcher=None, chunk_size=EVENTS_CHUNK_SIZE, pfx2as_format=None):
         self.esconn = ElasticConn()
-        pass
+        self.fetcher = fetcher or AtlasResultsFetcher()
+        self.chunk_size = chunk_size
+        # resolve hops with in-process daily snapshots instead of redis if pfx2as files are given
+        self.pfx2as_tries = DailyPfx2AsTries(pfx2as_format) if pfx2as_format else None
+
+    def _pfx_origin_db(self):
+        return None if self.pfx2as_tries else Pfx2AsHistorical()
+
+    def _pfx_origin_db_for(self, view_ts, responses, pfx_origin_db):
+        if self.pfx2as_tries is None:
+            return pfx_origin_db
+        # resolve all hops of the measurement at once with the snapshot of the event's day
+        return Pfx2AsSnapshotDB(self.pfx2as_tries.for_ts(view_ts), responses)
 
     def extract_msm_ids(self):
 
@@ -101,112 +140,165 @@ class RefillMsms:
         :return:
         """
         as_traceroute_driver = AsTracerouteDriver()
-        pfx_origin_db = Pfx2AsHistorical()
+        pfx_origin_db = self._pfx_origin_db()
 
+        candidates = {}
         for t in ["moas", "submoas", "defcon", "edges"]:
-            msms_map = self._read_msms_from_file("atlas-map-{}.csv.gz".format(t))
-
-            for event_id, msms in msms_map.items():
+            for event_id, msms in self._read_msms_from_file("atlas-map-{}.csv.gz".format(t)).items():
                 if t == "defcon":
                     event_as = event_id.split("-")[-1]
                     if any([target_asn != event_as for _, target_asn in msms]):
                         # skip traceroutes that were wrongfully created.
                         # example: [('23081510', '1'), ('23081511', '9'), ('23081512', '3'), ('23081513', '1'), ('23081514', '9'), ('23081515', '3')]
                         continue
-                event = self.esconn.get_event_by_id(event_id)
-                if event is None:
-                    continue
+                candidates[event_id] = msms
 
+        # walk all event types in time order, so that with in-process pfx2as snapshots each day is loaded only once
+        for chunk in chunks(sorted(candidates, key=event_id_ts), self.chunk_size):
+            events = []
+            # only events that are traceroute worthy and lack results are fetched
+            for event in self._lookup_refill_candidates(chunk):
                 if not event.summary.tr_worthy or self._event_has_tr_results(event):
                     continue
+                events.append((event, candidates[event.event_id]))
+
+            events.sort(key=lambda item: item[0].view_ts)
+            # retrieve measurement results of the whole chunk first
+            results = self.fetcher.fetch_many(msm_id for _, msms in events for msm_id, _ in msms)
+            for event, msms in events:
+                self._refill_event_2(event, msms, results, as_traceroute_driver, pfx_origin_db)
+
+    def _lookup_refill_candidates(self, event_ids):
+        """
+        Retrieve, with one search, the events among `event_ids` that are traceroute worthy but have no traceroute
+        results yet. Other events are filtered out by elasticsearch and never transferred.
+
+        :param event_ids: list of event ids
+        :return: list of matching events
+        """
+        if not event_ids:
+            return []
+        indices = sorted(set(self.esconn.infer_index_name_by_id(event_id) for event_id in event_ids))
+        query = {
+            "size": len(event_ids),
+            "query": {
+                "bool": {
+                    "filter": [
+                        {"ids": {"values": event_ids}},
+                        query_missing_traceroutes(min_ts=MIN_REFILL_TS)["query"],
+                    ]
+                }
+            }
+        }
+        res = self.esconn.es.search(index=",".join(indices), body=query, ignore_unavailable=True)
+        return [Event.from_dict(hit["_source"]) for hit in res["hits"]["hits"]]
+
+    def _refill_event_2(self, event, msms, results, as_traceroute_driver, pfx_origin_db):
+        view_ts = event.view_ts
+        for msm_id, target_asn in msms:
+            # now refill measurements to corresponding pfx events
+            is_success, responses = results[msm_id]
 
-                view_ts = event.view_ts
-                for msm_id, target_asn in msms:
-                    # now refill measurements to corresponding pfx events
+            if not is_success:
+                continue
 
-                    # retrieve measurement results first
-                    kwargs = {"msm_id": msm_id}
-                    is_success, responses = AtlasResultsRequest(**kwargs).create()
+            # responses are there, should put it into corresponding pfx events
+            for pfx_event in event.pfx_events:
+                assert(isinstance(pfx_event, PfxEvent))
+                if not pfx_event.traceroutes.get("msms",[]) == []:
+                    # this prefix event already has measurement results, skipping
+                    continue
 
-                    if not is_success:
+                pfx_event.traceroutes["msms"] = []
+                if target_asn in pfx_event.details.get_current_origins():
+                    res = extract_atlas_response(
+                        responses=responses, pfx_origin_db=self._pfx_origin_db_for(view_ts, responses, pfx_origin_db))
+                    if not res:
                         continue
+                    as_traceroute_driver.fill_as_traceroute_results(traceroute_results=res, view_ts=view_ts)
+                    try:
+                        msm_obj = HijacksMeasurement(
+                            msm_id=msm_id, probe_ids=[msm["prb_id"] for msm in res], target_ip=res[-1]["dst"], target_pfx=res[-1]["dst"]+"/32", target_asn=target_asn,
+                            request_error="", event_id=event.event_id, results=res
+                        )
+                    except Exception as e:
+                        print(json.dumps(res, indent=4))
+                        raise e
+
+                    pfx_event.traceroutes["msms"].append(msm_obj)
+                    break
 
-                    # responses are there, should put it into corresponding pfx events
-                    for pfx_event in event.pfx_events:
-                        assert(isinstance(pfx_event, PfxEvent))
-                        if not pfx_event.traceroutes.get("msms",[]) == []:
-                            # this prefix event already has measurement results, skipping
-                            continue
-
-                        pfx_event.traceroutes["msms"] = []
-                        if target_asn in pfx_event.details.get_current_origins():
-                            res = extract_atlas_response(responses=responses, pfx_origin_db=pfx_origin_db)
-                            if not res:
-                                continue
-                            as_traceroute_driver.fill_as_traceroute_results(traceroute_results=res, view_ts=view_ts)
-                            try:
-                                msm_obj = HijacksMeasurement(
-                                    msm_id=msm_id, probe_ids=[msm["prb_id"] for msm in res], target_ip=res[-1]["dst"], target_pfx=res[-1]["dst"]+"/32", target_asn=target_asn,
-                                    request_error="", event_id=event.event_id, results=res
-                                )
-                            except Exception as e:
-                                print(json.dumps(res, indent=4))
-                                raise e
-
-                            pfx_event.traceroutes["msms"].append(msm_obj)
-                            break
-
-                # at last, update the event
-                self.esconn.index_event(event)
+        # at last, update the event
+        self.esconn.index_event(event)
 
     def refill_msms(self):
         """
         Refill by searching for elasticsseach objects and check if we have them on Atlas
         :return:
         """
-        query = query_missing_traceroutes(min_ts=1546300800)
+        query = query_missing_traceroutes(min_ts=MIN_REFILL_TS)
         as_traceroute_driver = AsTracerouteDriver()
 
-        pfx_origin_db = Pfx2AsHistorical()
+        pfx_origin_db = self._pfx_origin_db()
+        # only the ids are scanned, the events themselves are retrieved chunk by chunk below
+        query["_source"] = ["id"]
+        msms_map = {}
+        matched = []
         for t in ["moas", "submoas", "defcon", "edges"]:
-            msms_map = self._read_msms_from_file("atlas-map-{}.csv.gz".format(t))
+            type_msms_map = self._read_msms_from_file("atlas-map-{}.csv.gz".format(t))
+            msms_map.update(type_msms_map)
             logging.info("searching for events that are traeroute worthy but lacks traceroute results")
-            for event in self.esconn.search_generator(index="observatory-events-{}-*".format(t), query=query):
-                if event.event_id in msms_map:
-                    # we have results for the event
-                    logging.info("event {} has result but not loaded in elasticsearch yet. refill now".format(event.event_id))
-                    # reaching here means the status is either 4: Stopped, or 5: Forced to stop
-                    # meaning we can extract the results now
-                    view_ts = event.view_ts
-                    msms = msms_map[event.event_id]
-                    for msm_id, target_asn in msms:
-                        kwargs = {"msm_id": msm_id}
-                        is_success, responses = AtlasResultsRequest(**kwargs).create()
-                        if is_success:
-                            # responses are there, should put it into corresponding pfx events
-
-                            for pfx_event in event.pfx_events:
-                                assert(isinstance(pfx_event, PfxEvent))
-                                if not pfx_event.traceroutes.get("msms",[]) == []:
-                                    # this prefix event already has measurement results, skipping
-                                    continue
-
-                                pfx_event.traceroutes["msms"] = []
-                                if target_asn in pfx_event.details.get_current_origins():
-                                    res = extract_atlas_response(responses=responses, pfx_origin_db=pfx_origin_db)
-                                    as_traceroute_driver.fill_as_traceroute_results(traceroute_results=res, view_ts=view_ts)
-
-                                    try:
-                                        msm_obj = HijacksMeasurement(
-                                            msm_id=msm_id, probe_ids=[msm["prb_id"] for msm in res], target_ip=res[-1]["dst"], target_pfx=res[-1]["dst"]+"/32", target_asn=target_asn,
-                                            request_error="", event_id=event.event_id, results=res
-                                        )
-                                    except Exception as e:
-                                        json.dumps(res, indent=4)
-                                        raise e
-
-                                    pfx_event.traceroutes["msms"].append(msm_obj)
-                    self.esconn.index_event(event)
+            matched.extend(e["id"] for e in
+                           self.esconn.search_generator(index="observatory-events-{}-*".format(t), query=query,
+                                                        raw_json=True)
+                           if e["id"] in type_msms_map)
+
+        # the scan is not time ordered, walk all event types in time order so that with in-process pfx2as snapshots
+        # each day is loaded only once
+        for chunk in chunks(sorted(matched, key=event_id_ts), self.chunk_size):
+            events = sorted(self._lookup_refill_candidates(chunk), key=lambda event: event.view_ts)
+            # retrieve measurement results of the whole chunk first
+            results = self.fetcher.fetch_many(
+                msm_id for event in events for msm_id, _ in msms_map[event.event_id])
+            for event in events:
+                self._refill_event(event, msms_map[event.event_id], results, as_traceroute_driver,
+                                   pfx_origin_db)
+
+    def _refill_event(self, event, msms, results, as_traceroute_driver, pfx_origin_db):
+        # we have results for the event
+        logging.info("event {} has result but not loaded in elasticsearch yet. refill now".format(event.event_id))
+        # reaching here means the status is either 4: Stopped, or 5: Forced to stop
+        # meaning we can extract the results now
+        view_ts = event.view_ts
+        for msm_id, target_asn in msms:
+            is_success, responses = results[msm_id]
+            if is_success:
+                # responses are there, should put it into corresponding pfx events
+
+                for pfx_event in event.pfx_events:
+                    assert(isinstance(pfx_event, PfxEvent))
+                    if not pfx_event.traceroutes.get("msms",[]) == []:
+                        # this prefix event already has measurement results, skipping
+                        continue
+
+                    pfx_event.traceroutes["msms"] = []
+                    if target_asn in pfx_event.details.get_current_origins():
+                        res = extract_atlas_response(
+                            responses=responses,
+                            pfx_origin_db=self._pfx_origin_db_for(view_ts, responses, pfx_origin_db))
+                        as_traceroute_driver.fill_as_traceroute_results(traceroute_results=res, view_ts=view_ts)
+
+                        try:
+                            msm_obj = HijacksMeasurement(
+                                msm_id=msm_id, probe_ids=[msm["prb_id"] for msm in res], target_ip=res[-1]["dst"], target_pfx=res[-1]["dst"]+"/32", target_asn=target_asn,
+                                request_error="", event_id=event.event_id, results=res
+                            )
+                        except Exception as e:
+                            json.dumps(res, indent=4)
+                            raise e
+
+                        pfx_event.traceroutes["msms"].append(msm_obj)
+        self.esconn.index_event(event)
 
     def _read_msms_from_file(self, filename):
         msms_map = {}
@@ -226,10 +318,33 @@ class RefillMsms:
         return msms_map
 
 
-if __name__ == '__main__':
+def main():
+    parser = argparse.ArgumentParser(description="Refill RIPE Atlas traceroute results into events")
+    parser.add_argument("-c", "--cache-dir", nargs="?", default=DEFAULT_CACHE_DIR,
+                        help="Directory caching measurement results, empty to disable caching")
+    parser.add_argument("-w", "--workers", nargs="?", type=int, default=8,
+                        help="Number of concurrent Atlas requests")
+    parser.add_argument("-r", "--rate", nargs="?", type=float, default=10,
+                        help="Maximum number of Atlas requests per second, 0 for no limit")
+    parser.add_argument("--chunk-size", nargs="?", type=int, default=EVENTS_CHUNK_SIZE,
+                        help="Number of events whose measurement results are fetched together")
+    parser.add_argument("--atlas-url", nargs="?", default=DEFAULT_ATLAS_URL,
+                        help="Base URL of an Atlas-compatible API to fetch results from, e.g. a local stand-in")
+    parser.add_argument("--atlas-insecure", action="store_true", default=False,
+                        help="Skip TLS certificate verification of the Atlas server")
+    parser.add_argument("-P", "--pfx2as-files", nargs="?",
+                        help="strftime pattern of daily pfx2as files to resolve traceroute hops in process instead of "
+                             "redis, e.g. /data/routeviews-prefix2as/%%Y/%%m/routeviews-rv2-%%Y%%m%%d-1200.pfx2as.gz")
+    opts = parser.parse_args()
 
     logging.basicConfig(format="%(levelname)s %(asctime)s: %(message)s", level=logging.INFO)
-    refill = RefillMsms()
+    fetcher = AtlasResultsFetcher(cache_dir=opts.cache_dir or None, workers=opts.workers, rate=opts.rate,
+                                  base_url=opts.atlas_url, verify=not opts.atlas_insecure)
+    refill = RefillMsms(fetcher=fetcher, chunk_size=opts.chunk_size, pfx2as_format=opts.pfx2as_files)
     # refill.refill_msms_from_file("atlas-map-moas.csv.gz")
     refill.refill_msms_2()
 
+
+if __name__ == '__main__':
+    main()
+
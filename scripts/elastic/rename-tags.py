@@ -33,11 +33,54 @@
 """
 This script is designed to allow users to quickly rename tags for events on elasticsearch.
 """
+import argparse
 import logging
 
 from bgphijacks.events.event import Event
 from bgphijacks.utils.data.elastic import ElasticConn
 from bgphijacks.utils.data.elastic_queries import query_by_tags
+from scripts.utils.elastic_tasks import TASK_POLL_INTERVAL, wait_for_task
+
+EVENTS_INDEX_PATTERN = "observatory-events-*"
+
+# rename tags of an event and all its prefix events in place, keeping tags unique as they are sets in `Event`
+RENAME_TAGS_SCRIPT = """
+List renameTags(List tags, Map tagsMap) {
+    if (tags == null) {
+        return null;
+    }
+    boolean changed = false;
+    LinkedHashSet renamed = new LinkedHashSet();
+    for (def tag : tags) {
+        if (tagsMap.containsKey(tag)) {
+            renamed.add(tagsMap.get(tag));
+            changed = true;
+        } else {
+            renamed.add(tag);
+        }
+    }
+    return changed ? new ArrayList(renamed) : null;
+}
+
+boolean changed = false;
+List tags = renameTags(ctx._source.tags, params.tags_map);
+if (tags != null) {
+    ctx._source.tags = tags;
+    changed = true;
+}
+if (ctx._source.pfx_events != null) {
+    for (def pfx_event : ctx._source.pfx_events) {
+        List pfx_tags = renameTags(pfx_event.tags, params.tags_map);
+        if (pfx_tags != null) {
+            pfx_event.tags = pfx_tags;
+            changed = true;
+        }
+    }
+}
+if (!changed) {
+    ctx.op = "noop";
+}
+"""
 
 
 def rename_tag(event, old_tag, new_tag):
@@ -71,14 +114,78 @@ class RenameTags:
         assert(isinstance(tags_map, dict))
 
         query = query_by_tags(tags_map.keys())
-        for event in self.esconn.search_generator(index="observatory-events-*", query=query):
+        for event in self.esconn.search_generator(index=EVENTS_INDEX_PATTERN, query=query):
             for old_tag, new_tag in tags_map.items():
                 rename_tag(event, old_tag, new_tag)
             self.esconn.index_event(event)
 
+    def rename_tags_server_side(self, tags_map, index=EVENTS_INDEX_PATTERN, slices="auto", requests_per_second=-1,
+                                poll_interval=TASK_POLL_INTERVAL):
+        """
+        Rename tags in place with an `_update_by_query` task, rewriting only the `tags` of matching events and their
+        prefix events without pulling the documents out of elasticsearch.
+
+        :param tags_map: dictionary of old tag names to new tag names
+        :param index: index pattern to rename tags in
+        :param slices: number of slices of the task, or "auto" for one per shard
+        :param requests_per_second: throttle of the task, -1 for no throttling
+        :param poll_interval: seconds between task progress checks
+        :return: response of the finished task
+        """
+        assert(isinstance(tags_map, dict))
+
+        body = {
+            "query": query_by_tags(tags_map.keys())["query"],
+            "script": {
+                "lang": "painless",
+                "source": RENAME_TAGS_SCRIPT,
+                "params": {"tags_map": tags_map},
+            },
+        }
+        res = self.esconn.es.update_by_query(index=index, body=body, slices=slices,
+                                             requests_per_second=requests_per_second, conflicts="proceed",
+                                             wait_for_completion=False)
+        logging.info("renaming tags {} in {}: task {}".format(tags_map, index, res["task"]))
+        return wait_for_task(self.esconn, res["task"], name="rename-tags", poll_interval=poll_interval)
+
+
+def parse_tags_map(pairs):
+    tags_map = {}
+    for pair in pairs:
+        old_tag, sep, new_tag = pair.partition(":")
+        if not sep or not old_tag or not new_tag:
+            raise ValueError("invalid tag rename pair, expected OLD:NEW: {}".format(pair))
+        tags_map[old_tag] = new_tag
+    return tags_map
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rename tags of events on elasticsearch")
+    parser.add_argument("-t", "--tag", action="append", default=[],
+                        help="Tag rename pair as OLD:NEW, can be given multiple times")
+    parser.add_argument("-i", "--index", nargs="?", default=EVENTS_INDEX_PATTERN,
+                        help="Index pattern to rename tags in (server-side mode only)")
+    parser.add_argument("-S", "--server-side", action="store_true", default=False,
+                        help="Rename tags in place with update-by-query instead of reindexing events from here")
+    parser.add_argument("--slices", nargs="?", default="auto",
+                        help="Number of slices of the update-by-query task, or auto")
+    parser.add_argument("--requests-per-second", nargs="?", type=float, default=-1,
+                        help="Throttle of the update-by-query task, -1 to disable throttling")
+    opts = parser.parse_args()
 
-if __name__=="__main__":
-    renamer = RenameTags()
     logging.basicConfig(format="%(levelname)s %(asctime)s: %(message)s", level=logging.INFO)
     logging.getLogger('elasticsearch').setLevel(logging.INFO)
-    renamer.rename_tags({"all-newcomers-edge-ases":"all-newcomers-stub-ases"})
+
+    tags_map = parse_tags_map(opts.tag) or {"all-newcomers-edge-ases": "all-newcomers-stub-ases"}
+    slices = opts.slices if opts.slices == "auto" else int(opts.slices)
+
+    renamer = RenameTags()
+    if opts.server_side:
+        renamer.rename_tags_server_side(tags_map, index=opts.index, slices=slices,
+                                        requests_per_second=opts.requests_per_second)
+    else:
+        renamer.rename_tags(tags_map)
+
+
+if __name__=="__main__":
+    main()
@@ -48,14 +48,22 @@
 #  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
 #  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
 #  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+import argparse
+import logging
+import time
+
 from bgphijacks.events.event import Event
 from bgphijacks.utils.data.elastic import ElasticConn
+from bgphijacks.utils.data.elastic_queries import query_in_range
 import numpy as np
 
+from scripts.utils.event_aggregations import EVENTS_INDEX_PATTERN, EventAggregator, format_rows
+from scripts.utils.event_archive import COLUMNS, EventArchive
+
 
-class SearchEvent:
+class SearchEvent(EventAggregator):
     def __init__(self):
-        self.esconn = ElasticConn()
+        super().__init__(ElasticConn())
 
     def search_by_query(self, index, query, handler, limit=1000):
         count = 0
@@ -83,7 +91,7 @@ class SearchEvent:
             }]
         }
         print(query)
-        for event in self.esconn.search_generator(index="observatory-events-*", query=query, limit=10):
+        for event in self.esconn.search_generator(index=EVENTS_INDEX_PATTERN, query=query, limit=10):
             handler(event)
 
 
@@ -98,18 +106,90 @@ def count_origins(event):
     event_origins_count.append(len(event.summary.ases))
 
 
-if __name__ == "__main__":
-    search = SearchEvent()
-    query = {
-        "sort": {
-            "view_ts": {
-                "order": "desc"
+def main():
+    parser = argparse.ArgumentParser(description="Compute percentiles of event summaries")
+    parser.add_argument("-t", "--type", nargs="?", default="moas",
+                        help="Event type")
+    parser.add_argument("-s", "--start_ts", type=int, nargs="?",
+                        help="start time (unix time)")
+    parser.add_argument("-e", "--end_ts", type=int, nargs="?",
+                        help="end time (unix time)")
+    parser.add_argument("-a", "--archive", nargs="?",
+                        help="Local event archive directory to compute statistics from instead of elasticsearch")
+    parser.add_argument("-r", "--refresh", action="store_true", default=False,
+                        help="Fetch new and modified events into the local archive first")
+    parser.add_argument("-c", "--column", nargs="?", default="n_ases",
+                        choices=[name for name, dtype in COLUMNS.items() if dtype is not np.str_],
+                        help="Archived column to compute percentiles of")
+    parser.add_argument("-g", "--aggregation", nargs="?",
+                        choices=["percentiles", "cardinality", "terms", "histogram"],
+                        help="Compute the statistic with an elasticsearch aggregation and print it as a table")
+    parser.add_argument("-f", "--field", nargs="?",
+                        help="Field to aggregate, e.g. tags for terms, default to view_ts for histogram")
+    parser.add_argument("--script", nargs="?",
+                        help="Painless script computing the value to aggregate instead of a field, "
+                             "e.g. \"doc['summary.ases'].size()\"")
+    parser.add_argument("-G", "--group-by", nargs="?",
+                        help="Keyword field to compute percentiles or cardinality for each of its terms, "
+                             "or to split histogram buckets by")
+    parser.add_argument("-i", "--interval", nargs="?", default="1d",
+                        help="Histogram bucket width, e.g. 1h or 7d")
+    parser.add_argument("-n", "--size", nargs="?", type=int, default=100,
+                        help="Number of terms to return for terms and split histograms")
+    opts = parser.parse_args()
+
+    logging.basicConfig(format="%(levelname)s %(asctime)s: %(message)s", level=logging.INFO)
+    logging.getLogger('elasticsearch').setLevel(logging.INFO)
+
+    index_pattern = "observatory-events-{}-*".format(opts.type)
+    if opts.aggregation:
+        if opts.aggregation in ("percentiles", "cardinality") and not (opts.field or opts.script):
+            parser.error("-g {} requires --field or --script".format(opts.aggregation))
+        if opts.aggregation == "terms" and not opts.field:
+            parser.error("-g terms requires --field")
+        query = None
+        if opts.start_ts or opts.end_ts:
+            query = query_in_range(opts.start_ts or 0, opts.end_ts or int(time.time()))["query"]
+        search = SearchEvent()
+        if opts.aggregation == "percentiles":
+            rows = search.percentiles(field=opts.field, script=opts.script, index=index_pattern, query=query,
+                                      group_by=opts.group_by)
+        elif opts.aggregation == "cardinality":
+            rows = search.cardinality(field=opts.field, script=opts.script, index=index_pattern, query=query,
+                                      group_by=opts.group_by)
+        elif opts.aggregation == "terms":
+            rows = search.terms(opts.field, size=opts.size, index=index_pattern, query=query)
+        else:
+            rows = search.date_histogram(interval=opts.interval, field=opts.field or "view_ts",
+                                         split_by=opts.group_by, split_size=opts.size, index=index_pattern,
+                                         query=query)
+        for line in format_rows(rows):
+            print(line)
+        return
+
+    if opts.archive:
+        archive = EventArchive(opts.archive)
+        if opts.refresh:
+            archive.refresh(ElasticConn(), index_pattern, opts.start_ts, opts.end_ts)
+        frame = archive.load(event_type=opts.type, start_ts=opts.start_ts, end_ts=opts.end_ts)
+        percentiles = frame.percentiles(opts.column)
+    else:
+        search = SearchEvent()
+        query = {
+            "sort": {
+                "view_ts": {
+                    "order": "desc"
+                }
             }
         }
-    }
-    # search.search_by_tags(["hegemony-valley-paths"], handle_found_event)
-    search.search_by_query("observatory-events-moas-*", query, count_origins, limit=10000)
-    count = np.array(event_origins_count)
-    for percentile in xrange(1,100,1):
-        print(percentile, np.percentile(count, percentile))
+        # search.search_by_tags(["hegemony-valley-paths"], handle_found_event)
+        search.search_by_query(index_pattern, query, count_origins, limit=10000)
+        count = np.array(event_origins_count)
+        percentiles = [(percentile, np.percentile(count, percentile)) for percentile in range(1, 100, 1)]
+
+    for percentile, value in percentiles:
+        print(percentile, value)
 
+
+if __name__ == "__main__":
+    main()
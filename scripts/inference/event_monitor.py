@@ -39,8 +39,11 @@ import sys
 
 import bgphijacks.common
 from bgphijacks.utils.data.elastic import ElasticConn
+from scripts.utils.elastic_fetch import mget_events
+from scripts.utils.metrics import MetricsEmitter, kafka_consumer_lag, stage_timer
 
 KAFKA_POOLING_INTERVAL = 5
+KAFKA_BATCH_SIZE = 500
 
 
 class EventMonitor:
@@ -64,10 +67,11 @@ class EventMonitor:
         })
         self.kafka_consumer.subscribe([topic])
 
-    def listen(self, brokers, topic, group, offset):
+    def listen(self, brokers, topic, group, offset, batch_size=KAFKA_BATCH_SIZE, metrics_interval=0):
         """listen for traceroute request IDs from driver and retrieve results"""
 
         es_conn = ElasticConn()
+        metrics = MetricsEmitter(es_conn, "event-monitor", interval=metrics_interval) if metrics_interval else None
 
         shutdown = {"count": 0}
 
@@ -87,20 +91,42 @@ class EventMonitor:
                 logging.info("Shutting down")
                 break
 
+            if metrics is not None:
+                lag = kafka_consumer_lag(self.kafka_consumer)
+                for partition, partition_lag in lag.items():
+                    metrics.gauge("kafka_lag_p{}".format(partition), partition_lag)
+                metrics.gauge("kafka_lag", sum(lag.values()))
+                metrics.maybe_emit()
+
             # quickly polling all pending messages from kafka before processing results
-            msg = self.kafka_consumer.poll(KAFKA_POOLING_INTERVAL)
-            if msg is not None and not msg.error():
+            msgs = self.kafka_consumer.consume(num_messages=batch_size, timeout=KAFKA_POOLING_INTERVAL)
+            refs = []
+            for msg in msgs:
+                if msg.error():
+                    continue
                 # the message only contains the index and id for elasticsearch entries
-                index, event_id = msg.value().split(";")
-
-                # the actual event dictionary
-                event = es_conn.get_event_by_id(event_id=event_id)
+                value = msg.value()
+                if isinstance(value, bytes):
+                    value = value.decode()
+                index, event_id = value.split(";")
+                refs.append((index, event_id))
+            if not refs:
+                continue
+
+            # the actual events, fetched with one request from the exact indices
+            with stage_timer(metrics, "fetch"):
+                events = mget_events(es_conn, refs)
+            if metrics is not None:
+                metrics.incr("events", len(refs))
+            for _, event_id in refs:
+                event = events.get(event_id)
+                if event is None:
+                    logging.warning("event {} not found".format(event_id))
+                    continue
 
                 # the following is the processing of events
                 # pass
 
-                continue  # continue to poll next kafka message
-
 
 def main():
     parser = argparse.ArgumentParser(
@@ -115,6 +141,10 @@ def main():
                            help="Kafka topic to use")
     parser.add_argument('-g', "--group", nargs="?",
                         help="Listener group to join")
+    kafka_grp.add_argument('-B', "--batch-size", nargs="?", type=int, default=KAFKA_BATCH_SIZE,
+                           help="Maximum number of Kafka messages to consume and fetch events for at once")
+    parser.add_argument("--metrics", nargs="?", type=int, default=0,
+                        help="Emit consumer lag and throughput metrics every this many seconds, 0 to disable")
 
     logging.basicConfig(format="%(levelname)s %(asctime)s: %(message)s",
                         # filename=LOG_FILENAME,
@@ -134,6 +164,8 @@ def main():
         offset="latest",
         topic=opts.topic,
         brokers=opts.brokers,
+        batch_size=opts.batch_size,
+        metrics_interval=opts.metrics,
     )
 
 
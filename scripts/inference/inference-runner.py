@@ -41,6 +41,14 @@ from bgphijacks.events.event import Event
 from bgphijacks.inference.inference_collector import InferenceCollector
 from bgphijacks.utils.data.elastic import ElasticConn
 from bgphijacks.utils.data.elastic_queries import query_in_range, query_no_inference
+from scripts.utils.checkpoint import Checkpoint
+from scripts.utils.elastic_scan import close_point_in_time, open_point_in_time, sliced_search_generator
+from scripts.utils.partitioner import density_time_chunks
+
+# number of events processed between two checkpoint updates
+CHECKPOINT_INTERVAL = 1000
+# unique and stable sort order, so that a resumed run can continue from the last search_after key
+RESUMABLE_SORT = [{"view_ts": "asc"}, {"id": "asc"}]
 
 
 class InferenceRunner:
@@ -62,15 +70,20 @@ class InferenceRunner:
             event = self.collector.infer_event(event, to_query_hegemony=False)
             self.esconn.index_event(event)
 
-    def rerun(self, start_ts, end_ts, tr_worthy, inserted_before=None, inserted_after=None, must_tags=None, must_not_tags=None):
+    def rerun(self, start_ts, end_ts, tr_worthy, inserted_before=None, inserted_after=None, must_tags=None, must_not_tags=None,
+              checkpoint=None):
         """
         Rerun the inference code for the given time period.
 
+        With a checkpoint, events are read in (view_ts, id) order through a point-in-time, the `search_after` key is
+        recorded every CHECKPOINT_INTERVAL events, and a resumed run continues from the last recorded key.
+
         :param start_ts:
         :param end_ts:
         :param tr_worthy: weather to process only traceroute-worthy event
         :param inserted_before: only process events inserted before certain time
         :param inserted_after: only process events inserted after certain time
+        :param checkpoint: Checkpoint instance to record progress in
         :return:
         """
         self._show_time(start_ts, "start")
@@ -80,13 +93,43 @@ class InferenceRunner:
 
         query = query_in_range(start_ts, end_ts, must_tr_worthy=tr_worthy, must_tags=must_tags, must_not_tags=must_not_tags)
         json.dumps(query, indent=4)
-        index_pattern = "observatory-v2-events-{}-*".format(self.event_type)
-        for event in self.esconn.search_generator(index=index_pattern, query=query):
-            assert (isinstance(event, Event))
-            if self._event_in_range(event, inserted_before, inserted_after):
-                event.summary.clear_inference()
-                self.collector.infer_event(event=event, to_query_asrank=False, to_query_hegemony=False)
-                self.esconn.index_event(event)
+        index_pattern = self.get_index_pattern(self.event_type)
+        if checkpoint is None:
+            for event in self.esconn.search_generator(index=index_pattern, query=query):
+                self._rerun_event(event, inserted_before, inserted_after)
+            return
+
+        partition = Checkpoint.partition_name(start_ts, end_ts)
+        search_after, done = checkpoint.get_progress(partition)
+        if done:
+            logging.info(f"time range {partition} already finished, skipping")
+            return
+        if search_after:
+            logging.info(f"resuming time range {partition} after {search_after}")
+
+        pit_id = open_point_in_time(self.esconn, index_pattern)
+        try:
+            count = 0
+            for event, sort_value in sliced_search_generator(self.esconn, pit_id, query, 0, 1, sort=RESUMABLE_SORT,
+                                                             search_after=search_after, with_sort=True):
+                self._rerun_event(event, inserted_before, inserted_after)
+                count += 1
+                if count % CHECKPOINT_INTERVAL == 0:
+                    checkpoint.update(partition, sort_value)
+        finally:
+            close_point_in_time(self.esconn, pit_id)
+        checkpoint.finish(partition)
+
+    def _rerun_event(self, event, inserted_before, inserted_after):
+        assert (isinstance(event, Event))
+        if self._event_in_range(event, inserted_before, inserted_after):
+            event.summary.clear_inference()
+            self.collector.infer_event(event=event, to_query_asrank=False, to_query_hegemony=False)
+            self.esconn.index_event(event)
+
+    @staticmethod
+    def get_index_pattern(event_type):
+        return "observatory-v2-events-{}-*".format(event_type)
 
     @staticmethod
     def _event_in_range(event: Event, before, after):
@@ -103,9 +146,11 @@ class InferenceRunner:
             logging.info(f"{name}: {dt_object}")
 
 
-def run_process(event_type, debug, start_ts, end_ts, tr_worthy, after_ts, before_ts, must_tags, must_not_tags):
+def run_process(event_type, debug, start_ts, end_ts, tr_worthy, after_ts, before_ts, must_tags, must_not_tags,
+                checkpoint_path=None):
+    checkpoint = Checkpoint(checkpoint_path) if checkpoint_path else None
     InferenceRunner(event_type=event_type, debug=debug) \
-        .rerun(start_ts, end_ts, tr_worthy, before_ts, after_ts, must_tags, must_not_tags)
+        .rerun(start_ts, end_ts, tr_worthy, before_ts, after_ts, must_tags, must_not_tags, checkpoint)
 
 
 def main():
@@ -129,8 +174,16 @@ def main():
     parser.add_argument('-p', '--processes', nargs="?", type=int, required=False,
                         default=1,
                         help="Number of processes to divide the time range and run, specify 0 to use all available cores")
+    parser.add_argument('-C', '--chunks', nargs="?", type=int, required=False,
+                        default=0,
+                        help="Number of event-density-balanced chunks to split the time range into, "
+                             "default to one equal-width slice per process")
     parser.add_argument("-d", "--debug", action="store_true", default=False,
                         help="Whether to enable debug mode")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="Resume a previous rerun with the same parameters, skipping finished work")
+    parser.add_argument("--checkpoint-dir", nargs="?", type=str, required=False,
+                        default="/tmp", help="Directory to keep the checkpoint journals in")
 
     # event filters
     parser.add_argument("-w", "--tr_worthy", action="store_true", default=False,
@@ -159,17 +212,35 @@ def main():
     processes = opts.processes
     if processes <= 0:
         processes = os.cpu_count()
-    step = int((opts.end_ts - opts.start_ts) / processes)
-    cur_ts = opts.start_ts
+    checkpoint = Checkpoint.for_run("inference-runner", opts, directory=opts.checkpoint_dir, resume=opts.resume)
+    # reuse the time ranges of the resumed run, density-based chunks may have shifted since then
+    ranges = checkpoint.get_plan()
+    if ranges is None:
+        ranges = []
+        if opts.chunks > 0:
+            # idle workers pick up the next chunk, so a burst of events does not stall a single worker
+            query = query_in_range(opts.start_ts, opts.end_ts, must_tr_worthy=opts.tr_worthy,
+                                   must_tags=must_tags, must_not_tags=must_not_tags)
+            ranges = density_time_chunks(ElasticConn(), InferenceRunner.get_index_pattern(opts.type),
+                                         opts.start_ts, opts.end_ts, opts.chunks, query=query)
+        else:
+            step = int((opts.end_ts - opts.start_ts) / processes)
+            cur_ts = opts.start_ts
+            while cur_ts < opts.end_ts:
+                cur_end = cur_ts + step
+                ranges.append((cur_ts, cur_end))
+                cur_ts += step
+        checkpoint.save_plan(ranges)
+    checkpoint.close()
+
     args = []
-    while cur_ts < opts.end_ts:
-        cur_end = cur_ts + step
-        args.append((opts.type, opts.debug, cur_ts, cur_end, opts.tr_worthy, opts.after_ts, opts.before_ts, must_tags, must_not_tags))
-        cur_ts += step
+    for cur_ts, cur_end in ranges:
+        args.append((opts.type, opts.debug, cur_ts, cur_end, opts.tr_worthy, opts.after_ts, opts.before_ts, must_tags, must_not_tags,
+                     checkpoint.path))
     logging.info(args)
 
     with mp.Pool(processes=processes) as pool:
-        pool.starmap(run_process, args)
+        pool.starmap(run_process, args, chunksize=1)
 
 
 if __name__ == "__main__":
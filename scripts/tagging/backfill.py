@@ -35,11 +35,14 @@ Backfilling using consumer data
 """
 
 import argparse
+import functools
 import json
 import logging
 import multiprocessing
 import multiprocessing as mp
 import os
+import queue
+import sys
 from datetime import datetime
 
 from bgphijacks.events.details_submoas import SubmoasDetails
@@ -52,7 +55,13 @@ from bgphijacks.tagger.tagger_submoas import SubMoasTagger
 from bgphijacks.tagger.tags import tagshelper
 from bgphijacks.utils.data.elastic import ElasticConn
 from bgphijacks.utils.data.elastic_queries import query_in_range
-from bgphijacks.utils.swift import SwiftUtils
+from scripts.utils.checkpoint import Checkpoint
+from scripts.utils.elastic_bulk import BulkIndexer
+from scripts.utils.elastic_scan import close_point_in_time, open_point_in_time, sliced_search_generator
+from scripts.utils.metrics import MetricsEmitter, stage_timer
+from scripts.utils.partitioner import density_time_chunks
+from scripts.utils.swift_manifest import SwiftManifest
+from scripts.utils.view_cache import TaggerViewCache
 
 CLASSIFIERS = {
     "defcon": DefconTagger,
@@ -83,6 +92,8 @@ class BackfillEngine:
                  end,
                  enable_finisher,
                  debug,
+                 checkpoint=None,
+                 refresh_manifest=False,
                  ):
 
         # backfill configs
@@ -92,9 +103,11 @@ class BackfillEngine:
         self.end = end
         self.enable_finisher = enable_finisher
         self.debug = debug
+        self.checkpoint = checkpoint
+        self.refresh_manifest = refresh_manifest
 
         # helpers
-        self.swift = SwiftUtils()
+        self.manifest = SwiftManifest()
         self.es_conn = ElasticConn()
         self.inference_collector = InferenceCollector()
 
@@ -125,10 +138,26 @@ class BackfillEngine:
         - make sure to use `in-memory` mode for redis data checking since we don't have newcomer data after one day old
         - make sure that inference can handle the load, and we don't do anything heavy at the inference phase
 
+        # Resuming
+
+        With a checkpoint, the last processed consumer file of this time range is recorded after each file, and a
+        resumed run starts right after it.
+
         :return:
         """
         assert (self.start is not None)
 
+        partition = Checkpoint.partition_name(self.start, self.end)
+        start = self.start
+        if self.checkpoint is not None:
+            position, done = self.checkpoint.get_progress(partition)
+            if done:
+                logging.info("time range {} already finished, skipping".format(partition))
+                return
+            if position:
+                start = position["view_ts"] + 1
+                logging.info("resuming time range {} after {}".format(partition, position["file"]))
+
         tagger = CLASSIFIERS[self.event_type](options={
             "pfx_origins_file": None,
             "in_memory_data": True,
@@ -142,15 +171,15 @@ class BackfillEngine:
         # log all rerun parameters
         logging.info(self._get_parameters())
 
-        # gather all consumer data files on swift first
+        # gather all consumer data files on swift first, only listing the days within the time range
         swift_files = []
         cache_files = []
-        for swift_file_name in self.swift.swift_files_generator("bgp-hijacks-{}".format(self.event_type)):
-            ts = int(swift_file_name.split("/")[4].split('.')[1])
-
+        container = "bgp-hijacks-{}".format(self.event_type)
+        for swift_file_name, ts in self.manifest.list_objects(container, start - tagger.window.window_size, self.end,
+                                                              full=self.refresh_manifest):
             swift_file_name = "swift://bgp-hijacks-{}/{}".format(self.event_type, swift_file_name)
-            if ts < self.start:
-                if ts >= self.start - tagger.window.window_size:
+            if ts < start:
+                if ts >= start - tagger.window.window_size:
                     cache_files.append(swift_file_name)
                 continue
             if self.end and ts > self.end:
@@ -167,6 +196,11 @@ class BackfillEngine:
             view_ts = int(swift_file_name.split(".")[-3])
             logging.info("backfilling events on time {}".format(view_ts))
             tagger.process_consumer_file(swift_file_name)
+            if self.checkpoint is not None:
+                self.checkpoint.update(partition, {"view_ts": view_ts, "file": swift_file_name})
+
+        if self.checkpoint is not None:
+            self.checkpoint.finish(partition)
 
 
 def find_unretagged_timerange(event_type, start_ts, end_ts, modified_after):
@@ -214,7 +248,7 @@ def find_unretagged_timerange(event_type, start_ts, end_ts, modified_after):
             of.write("%d,%s\n" % (ts, processed))
 
 
-def process(t, traceroutes, start, end, enable_finisher, debug, elastic):
+def process(t, traceroutes, start, end, enable_finisher, debug, elastic, checkpoint_path=None, refresh_manifest=False):
     """
     Parallel processing main thread. It creates an BackfillEngine instance and start processing.
     :param t: Event type
@@ -223,20 +257,30 @@ def process(t, traceroutes, start, end, enable_finisher, debug, elastic):
     :param end: end timestamp
     :param enable_finisher: whether to enable finisher
     :param debug: whether to enable debug mode
+    :param checkpoint_path: path to the checkpoint journal to record progress in
+    :param refresh_manifest: list the consumer files of the time range again instead of trusting the manifest
     :return:
     """
-    engine = BackfillEngine(t, traceroutes, start, end, enable_finisher, debug)
+    checkpoint = Checkpoint(checkpoint_path) if checkpoint_path else None
+    engine = BackfillEngine(t, traceroutes, start, end, enable_finisher, debug, checkpoint=checkpoint,
+                            refresh_manifest=refresh_manifest)
     engine.backfill_with_consumer_data()
 
 
 class Consumer(multiprocessing.Process):
-    def __init__(self, event_type, task_queue, only_inference=False, debug=False):
+    def __init__(self, event_type, task_queue, only_inference=False, debug=False,
+                 bulk_size=500, bulk_bytes=10 * 1024 * 1024, bulk_interval=10, cache_views=1, cache_memory=None,
+                 metrics_interval=0):
         multiprocessing.Process.__init__(self)
         self.event_type = event_type
         self.task_queue = task_queue
         self.debug = debug
         self.only_inference = only_inference
-        self.tagger = CLASSIFIERS[event_type](options={
+        self.bulk_size = bulk_size
+        self.bulk_bytes = bulk_bytes
+        self.bulk_interval = bulk_interval
+        self.metrics_interval = metrics_interval
+        tagger_factory = functools.partial(CLASSIFIERS[event_type], options={
             "pfx_origins_file": None,
             "in_memory_data": True,
             "enable_finisher": False,
@@ -245,17 +289,37 @@ class Consumer(multiprocessing.Process):
             "produce_kafka_message": False,  # do not produce kafka messages, i.e. disable active-probing and inference
             "debug": self.debug
         })
+        # events from ElasticSearch arrive in random view order, keep taggers prepared for recently seen views
+        self.taggers = TaggerViewCache(tagger_factory, max_views=cache_views, memory_budget=cache_memory)
         self.inference_collector = InferenceCollector()
         self.es_conn = ElasticConn()
 
     def run(self):
         proc_name = self.name
         TagRecurring = tagshelper.get_tag("recurring-pfx-event")
+        indexer = BulkIndexer(es_conn=self.es_conn, max_docs=self.bulk_size, max_bytes=self.bulk_bytes,
+                              max_age=self.bulk_interval, debug=self.debug)
+        metrics = None
+        if self.metrics_interval:
+            metrics = MetricsEmitter(self.es_conn, "backfill-consumer", interval=self.metrics_interval)
         while True:
-            event = self.task_queue.get()
+            if metrics is not None:
+                metrics.gauge("queue_depth", self.task_queue.qsize())
+                metrics.gauge("view_cache_hits", self.taggers.hits)
+                metrics.gauge("view_cache_misses", self.taggers.misses)
+                metrics.maybe_emit()
+            try:
+                event = self.task_queue.get(timeout=self.bulk_interval)
+            except queue.Empty:
+                # make sure buffered events do not wait forever when the producer is slow
+                indexer.flush_if_stale()
+                continue
             if event is None:
                 # Poison pill means shutdown
-                logging.info('{}: Exiting'.format(proc_name))
+                indexer.close()
+                logging.info('{}: Exiting, indexed {} events, {} failed'.format(
+                    proc_name, indexer.indexed, len(indexer.failures)))
+                self.taggers.log_stats(prefix="{}: ".format(proc_name))
                 self.task_queue.task_done()
                 break
             assert isinstance(event, Event)
@@ -277,22 +341,61 @@ class Consumer(multiprocessing.Process):
             event.summary.clear_inference()
 
             # tag events
-            if not self.only_inference:
-                ts = event.view_ts
-                self.tagger.update_datasets(ts)  # NOTE: only edges run special function to update dataset
-                self.tagger.methodology.prepare_for_view(ts)
-                self.tagger.tag_event(event)
+            with stage_timer(metrics, "tag"):
+                if not self.only_inference:
+                    self.taggers.get(event.view_ts).tag_event(event)
 
             # re-inference
-            self.inference_collector.infer_event(event=event, to_query_asrank=True, to_query_hegemony=False)
+            with stage_timer(metrics, "infer"):
+                self.inference_collector.infer_event(event=event, to_query_asrank=True, to_query_hegemony=False)
 
             # upload back to elastic search
-            self.es_conn.index_event(event, debug=self.debug)
+            with stage_timer(metrics, "index"):
+                indexer.add_event(event)
+
+            if metrics is not None:
+                metrics.incr("events")
 
             # mark task as done.
             self.task_queue.task_done()
 
 
+class SliceReader(multiprocessing.Process):
+    """
+    Read one slice of a point-in-time search and feed the events to the consumers' task queue.
+    """
+
+    def __init__(self, task_queue, pit_id, query, slice_id, max_slices, keep_alive, metrics_interval=0):
+        multiprocessing.Process.__init__(self)
+        self.task_queue = task_queue
+        self.pit_id = pit_id
+        self.query = query
+        self.slice_id = slice_id
+        self.max_slices = max_slices
+        self.keep_alive = keep_alive
+        self.metrics_interval = metrics_interval
+        self.es_conn = ElasticConn()
+
+    def run(self):
+        proc_name = self.name
+        count = 0
+        metrics = None
+        if self.metrics_interval:
+            metrics = MetricsEmitter(self.es_conn, "backfill-reader", interval=self.metrics_interval)
+        for event in sliced_search_generator(self.es_conn, self.pit_id, self.query, self.slice_id, self.max_slices,
+                                             keep_alive=self.keep_alive):
+            if event is None:
+                continue
+            self.task_queue.put(event)
+            count += 1
+            if metrics is not None:
+                metrics.incr("events")
+                metrics.gauge("queue_depth", self.task_queue.qsize())
+                metrics.maybe_emit()
+        logging.info("{}: finished reading slice {}/{}, {} events".format(
+            proc_name, self.slice_id, self.max_slices, count))
+
+
 def process_elastic():
     pass
 
@@ -325,11 +428,30 @@ def main():
     parser.add_argument('-p', '--processes', nargs="?", type=int, required=False,
                         default=1,
                         help="Number of processes to divide the time range and run, specify 0 to use all available cores")
+    parser.add_argument('-C', '--chunks', nargs="?", type=int, required=False,
+                        default=0,
+                        help="Number of event-density-balanced chunks to split the time range into, "
+                             "default to one equal-width slice per process")
 
     parser.add_argument('-q', '--query-size', nargs="?", type=int, required=False,
                         default=20, help="Number of items to return for each ES query")
     parser.add_argument('-T', '--scroll-timeout', nargs="?", type=str, required=False,
                         default="10m", help="The amount of time a query scroll is valid for")
+    parser.add_argument('--slices', nargs="?", type=int, required=False,
+                        default=0, help="Read events with this many parallel point-in-time slices instead of one scroll")
+    parser.add_argument('--keep-alive', nargs="?", type=str, required=False,
+                        default="1m", help="The amount of time a point-in-time is kept alive between two requests")
+    parser.add_argument('--bulk-size', nargs="?", type=int, required=False,
+                        default=500, help="Maximum number of events to commit in one ES bulk request")
+    parser.add_argument('--bulk-bytes', nargs="?", type=int, required=False,
+                        default=10 * 1024 * 1024, help="Maximum size in bytes of one ES bulk request")
+    parser.add_argument('--bulk-interval', nargs="?", type=int, required=False,
+                        default=10, help="Maximum number of seconds an event is buffered before committing")
+    parser.add_argument('--cache-views', nargs="?", type=int, required=False,
+                        default=1, help="Number of views to keep prepared taggers for in each consumer process")
+    parser.add_argument('--cache-memory', nargs="?", type=int, required=False,
+                        default=0, help="Memory budget in MB per consumer process for the prepared taggers, "
+                                        "0 means unlimited")
 
     parser.add_argument("--missing-inference", action="store_true", default=False,
                         help="Only process events with missing inferences")
@@ -343,6 +465,17 @@ def main():
                         help="Whether to enable debug mode, events will be committed to -test- indices")
     parser.add_argument("-S", "--elastic", action="store_true", default=False,
                         help="Retagging events already on ElasticSearch")
+    parser.add_argument("--metrics", nargs="?", type=int, required=False,
+                        default=0, help="Emit throughput, latency and queue depth metrics every this many seconds, "
+                                        "0 to disable (--elastic only)")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="Resume a previous consumer data backfill with the same parameters, "
+                             "skipping consumer files already processed")
+    parser.add_argument("--checkpoint-dir", nargs="?", type=str, required=False,
+                        default="/tmp", help="Directory to keep the checkpoint journals in")
+    parser.add_argument("--refresh-manifest", action="store_true", default=False,
+                        help="List the consumer files of the time range on swift again, picking up files uploaded "
+                             "or rewritten after their day was listed")
 
     opts = parser.parse_args()
 
@@ -369,7 +502,11 @@ def main():
         QUERY_SIZE = opts.query_size
         es_conn = ElasticConn()
         tasks = multiprocessing.JoinableQueue(maxsize=QUERY_SIZE * 2)
-        consumers = [Consumer(opts.type, tasks, reinference, opts.debug) for _ in range(processes)]
+        consumers = [Consumer(opts.type, tasks, reinference, opts.debug,
+                              bulk_size=opts.bulk_size, bulk_bytes=opts.bulk_bytes, bulk_interval=opts.bulk_interval,
+                              cache_views=opts.cache_views, cache_memory=opts.cache_memory * 1024 * 1024,
+                              metrics_interval=opts.metrics)
+                     for _ in range(processes)]
         for c in consumers:
             c.start()
         query = query_in_range(opts.start, opts.end,
@@ -388,11 +525,33 @@ def main():
             )
         print(json.dumps(query, indent=4))
         index_pattern = ElasticConn.get_index_name(event_type=opts.type)
-        for event in es_conn.search_generator(index=index_pattern, query=query, timeout=opts.scroll_timeout):
-            if event is None:
-                continue
-            tasks.put(event)
-            logging.info("put event {} into queue. about {} in queue".format(event.event_id, tasks.qsize()))
+        failed_slices = []
+        if opts.slices > 0:
+            pit_id = open_point_in_time(es_conn, index_pattern, keep_alive=opts.keep_alive)
+            readers = [SliceReader(tasks, pit_id, query, i, opts.slices, opts.keep_alive, metrics_interval=opts.metrics)
+                       for i in range(opts.slices)]
+            for r in readers:
+                r.start()
+            for r in readers:
+                r.join()
+                if r.exitcode != 0:
+                    logging.error("{} exited with code {}, slice {} is incomplete".format(
+                        r.name, r.exitcode, r.slice_id))
+                    failed_slices.append(r.slice_id)
+            close_point_in_time(es_conn, pit_id)
+        else:
+            metrics = None
+            if opts.metrics:
+                metrics = MetricsEmitter(es_conn, "backfill-reader", interval=opts.metrics)
+            for event in es_conn.search_generator(index=index_pattern, query=query, timeout=opts.scroll_timeout):
+                if event is None:
+                    continue
+                tasks.put(event)
+                logging.info("put event {} into queue. about {} in queue".format(event.event_id, tasks.qsize()))
+                if metrics is not None:
+                    metrics.incr("events")
+                    metrics.gauge("queue_depth", tasks.qsize())
+                    metrics.maybe_emit()
 
         logging.info("adding poison pills to end tasks")
         for i in range(processes):
@@ -400,19 +559,40 @@ def main():
             tasks.put(None)
 
         tasks.join()
+        if failed_slices:
+            # events of failed slices were not all retagged, do not let the run look successful
+            logging.error("slices {} of {} failed, rerun the time range to retag the missing events".format(
+                sorted(failed_slices), opts.slices))
+            sys.exit(1)
         return
 
-    step = int((opts.end - opts.start) / processes)
-    cur_ts = opts.start
+    checkpoint = Checkpoint.for_run("backfill", opts, directory=opts.checkpoint_dir, resume=opts.resume)
+    # reuse the time ranges of the resumed run, density-based chunks may have shifted since then
+    ranges = checkpoint.get_plan()
+    if ranges is None:
+        ranges = []
+        if opts.chunks > 0:
+            # idle workers pick up the next chunk, so a burst of events does not stall a single worker
+            ranges = density_time_chunks(ElasticConn(), ElasticConn.get_index_name(event_type=opts.type),
+                                         opts.start, opts.end, opts.chunks)
+        else:
+            step = int((opts.end - opts.start) / processes)
+            cur_ts = opts.start
+            while cur_ts < opts.end:
+                cur_end = cur_ts + step
+                ranges.append((cur_ts, cur_end))
+                cur_ts += step
+        checkpoint.save_plan(ranges)
+    checkpoint.close()
+
     args = []
-    while cur_ts < opts.end:
-        cur_end = cur_ts + step
-        args.append((opts.type, opts.traceroutes, cur_ts, cur_end, opts.enable_finisher, opts.debug))
-        cur_ts += step
+    for cur_ts, cur_end in ranges:
+        args.append((opts.type, opts.traceroutes, cur_ts, cur_end, opts.enable_finisher, opts.debug, opts.elastic,
+                     checkpoint.path, opts.refresh_manifest))
     print(args)
 
     with mp.Pool(processes=processes) as pool:
-        pool.starmap(process, args)
+        pool.starmap(process, args, chunksize=1)
 
 
 if __name__ == "__main__":
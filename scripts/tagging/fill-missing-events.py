@@ -31,67 +31,145 @@
 #  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
 
 import argparse
+import functools
+import gzip
 import logging
+import multiprocessing as mp
+import os
+import sqlite3
+import tempfile
 
 import json
 import wandio
 
-from bgphijacks.utils.swift import SwiftUtils
+from scripts.utils.swift_manifest import SwiftManifest
 
+VERIFIED_MANIFEST = "/tmp/grip-fill-missing-verified.sqlite"
 
-def find_fill_missing_events(tagger_file, traceroute_file):
-    lines = []
+
+class VerifiedPairs:
+    """
+    Local record of tagger/traceroute file pairs found consistent, keyed by the etags of both files.
+    """
+
+    def __init__(self, path=VERIFIED_MANIFEST):
+        self.conn = sqlite3.connect(path, timeout=60)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS verified ("
+                              "tagger_file TEXT PRIMARY KEY, tagger_etag TEXT, traceroute_etag TEXT)")
+
+    def is_verified(self, tagger_file, tagger_etag, traceroute_etag):
+        row = self.conn.execute("SELECT tagger_etag, traceroute_etag FROM verified WHERE tagger_file = ?",
+                                (tagger_file,)).fetchone()
+        return row is not None and row == (tagger_etag, traceroute_etag)
+
+    def add(self, tagger_file, tagger_etag, traceroute_etag):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO verified (tagger_file, tagger_etag, traceroute_etag) "
+                              "VALUES (?, ?, ?)", (tagger_file, tagger_etag, traceroute_etag))
+
+
+def find_fill_missing_events(tagger_file, traceroute_file, tmp_dir=None):
+    """
+    Append events found in the tagger file but missing from the traceroute file.
+
+    Both files are streamed once into a temporary gzip file while only the event ids of the traceroute file are kept
+    in memory. The traceroute file is replaced with the temporary file only if anything is missing.
+
+    :param tagger_file: tagger events file
+    :param traceroute_file: traceroute results file, None if it does not exist yet
+    :param tmp_dir: directory for the temporary merged file
+    :return: True if the traceroute file was (re)written
+    """
     ids = set()
 
     count = 0
     empty_line = False
-    if traceroute_file is None:
-        logging.info("no traceroute_file found, skip reading")
-    else:
-        with wandio.open(traceroute_file) as fin:
-            logging.info("caching traceroute_file: %s", traceroute_file)
-            for line in fin:
-                # receive event from swift file
-                if line.startswith("#"):
-                    continue
-                if not line or line.isspace():
-                    # if emptyline found, rewrite the file
-                    empty_line = True
-                    continue
-                event_dict = json.loads(line)
-                ids.add(event_dict["id"])
-                lines.append(line.strip())
-                count += 1
-            logging.info("read {} events".format(count))
+    tmp_fd, tmp_name = tempfile.mkstemp(dir=tmp_dir, suffix=".gz")
+    os.close(tmp_fd)
+    try:
+        with gzip.open(tmp_name, "wt") as tmp_out:
+            if traceroute_file is None:
+                logging.info("no traceroute_file found, skip reading")
+            else:
+                with wandio.open(traceroute_file) as fin:
+                    logging.info("streaming traceroute_file: %s", traceroute_file)
+                    for line in fin:
+                        # receive event from swift file
+                        if line.startswith("#"):
+                            continue
+                        if not line or line.isspace():
+                            # if emptyline found, rewrite the file
+                            empty_line = True
+                            continue
+                        event_dict = json.loads(line)
+                        ids.add(event_dict["id"])
+                        tmp_out.write("%s\n" % line.strip())
+                        count += 1
+                    logging.info("read {} events".format(count))
+
+            count = 0
+            found_missing = 0
+            with wandio.open(tagger_file) as fin:
+                logging.info("reading tagger_file: %s", tagger_file)
+                for line in fin:
+                    # receive event from swift file
+                    if line.startswith("#") or not line or line.isspace():
+                        continue
+                    event_dict = json.loads(line)
+                    event_id = event_dict["id"]
+                    if event_id not in ids:
+                        # this event is in tagger file but not in traceroute file
+                        tmp_out.write("%s\n" % line.strip())
+                        found_missing += 1
+                    count += 1
+                logging.info("read {} events".format(count))
+
+        if found_missing == 0 and not empty_line:
+            return False
 
-    count = 0
-    found_missing = 0
-    with wandio.open(tagger_file) as fin:
-        logging.info("reading tagger_file: %s", tagger_file)
-        for line in fin:
-            # receive event from swift file
-            if line.startswith("#") or not line or line.isspace():
-                continue
-            event_dict = json.loads(line)
-            event_id = event_dict["id"]
-            if event_id not in ids:
-                # this event is in tagger file but not in traceroute file
-                # logging.info("found missing event: {}".format(line))
-                lines.append(line.strip())
-                found_missing += 1
-            count += 1
-        logging.info("read {} events".format(count))
-
-    if found_missing > 0 or empty_line:
         if empty_line:
             logging.info("found empty line in traceroute file, rewrite it")
         if traceroute_file is None:
             # if no traceroute_file is provided, construct one first
             traceroute_file = tagger_file.replace("events", "traceroutes")
         logging.info("updating traceroute file: {}".format(traceroute_file))
-        with wandio.open(traceroute_file, "w") as fout:
-            for line in lines:
-                fout.write("%s\n" % line)
+        replace_file(tmp_name, traceroute_file)
+        return True
+    finally:
+        os.remove(tmp_name)
+
+
+def replace_file(tmp_name, dst):
+    """
+    Replace `dst` with the content of the temporary gzip file. Swift objects are replaced atomically once the upload
+    completes; local files are written next to the destination and renamed over it.
+    """
+    target = dst if "://" in dst else dst + ".tmp"
+    with gzip.open(tmp_name, "rt") as fin, wandio.open(target, "w") as fout:
+        for line in fin:
+            fout.write(line)
+    if target != dst:
+        os.replace(target, dst)
+
+
+def reconcile_pair(pair, tmp_dir=None):
+    """
+    Pool worker reconciling one tagger/traceroute file pair.
+
+    :return: the pair and whether the traceroute file was rewritten, None if reconciliation failed
+    """
+    tagger_file, tagger_etag, traceroute_file, traceroute_etag = pair
+    try:
+        rewritten = find_fill_missing_events(tagger_file, traceroute_file, tmp_dir=tmp_dir)
+    except Exception as error:
+        logging.error("failed to reconcile {}: {}".format(tagger_file, error))
+        rewritten = None
+    return pair, rewritten
+
+
+def result_file_ts(name):
+    return int(name.split("/")[5].split('=')[1])
 
 
 def main():
@@ -104,6 +182,13 @@ def main():
                         help="start time for rerun (unix time)")
     parser.add_argument("-e", "--end_ts", type=int, nargs="?",
                         help="end time for rerun (unix time)")
+    parser.add_argument('-p', '--processes', nargs="?", type=int, required=False,
+                        default=1,
+                        help="Number of file pairs to reconcile in parallel, specify 0 to use all available cores")
+    parser.add_argument("-f", "--force", action="store_true", default=False,
+                        help="Reconcile file pairs even if they have been verified before and did not change")
+    parser.add_argument("-T", "--tmp-dir", nargs="?", default=None,
+                        help="Directory for temporary merged traceroute files, default to the system temp directory")
 
     logging.basicConfig(format="%(levelname)s %(asctime)s: %(message)s",
                         # filename=LOG_FILENAME,
@@ -115,27 +200,42 @@ def main():
     tagger_container = "bgp-hijacks-{}-events".format(event_type)
     traceroute_container = "bgp-hijacks-{}-traceroutes".format(event_type)
 
-    swift = SwiftUtils()
-    tagger_files = swift.swift_files_generator(tagger_container)
-    traceroute_files = swift.swift_files_generator(traceroute_container)
+    # result files are not laid out by day, so list whole containers; relist them fully to pick up changed etags
+    manifest = SwiftManifest()
+    tagger_files = manifest.list_entries(tagger_container, opts.start_ts, opts.end_ts,
+                                         parse_ts=result_file_ts, prefix_format=None, full=True)
+    traceroute_files = manifest.list_entries(traceroute_container, opts.start_ts, opts.end_ts,
+                                             parse_ts=result_file_ts, prefix_format=None, full=True)
     traceroute_dict = {}
-    for f in traceroute_files:
-        traceroute_dict[int(f.split("/")[5].split('=')[1])] = f
-    for tagger_file in tagger_files:
-        ts = int(tagger_file.split("/")[5].split('=')[1])
-        if opts.start_ts and ts < opts.start_ts:
-            continue
-        if opts.end_ts and ts < opts.end_ts:
-            continue
+    for f, ts, _, etag in traceroute_files:
+        traceroute_dict[ts] = (f, etag)
+
+    verified = VerifiedPairs()
+    pairs = []
+    for tagger_file, ts, _, tagger_etag in tagger_files:
 
         tagger_file = "swift://%s/%s" % (tagger_container, tagger_file)
         if ts not in traceroute_dict:
             logging.error("missing file for {}".format(ts))
-            traceroute_file = None
+            traceroute_file, traceroute_etag = None, None
         else:
-            traceroute_file = "swift://%s/%s" % (traceroute_container, traceroute_dict[ts])
+            traceroute_file = "swift://%s/%s" % (traceroute_container, traceroute_dict[ts][0])
+            traceroute_etag = traceroute_dict[ts][1]
+            if not opts.force and verified.is_verified(tagger_file, tagger_etag, traceroute_etag):
+                continue
 
-        find_fill_missing_events(tagger_file, traceroute_file)
+        pairs.append((tagger_file, tagger_etag, traceroute_file, traceroute_etag))
+    logging.info("{} file pairs to reconcile".format(len(pairs)))
+
+    processes = opts.processes
+    if processes <= 0:
+        processes = os.cpu_count()
+    with mp.Pool(processes=processes) as pool:
+        for (tagger_file, tagger_etag, traceroute_file, traceroute_etag), rewritten in \
+                pool.imap_unordered(functools.partial(reconcile_pair, tmp_dir=opts.tmp_dir), pairs):
+            # rewritten traceroute files get a new etag, they are verified again on the next run
+            if rewritten is False:
+                verified.add(tagger_file, tagger_etag, traceroute_etag)
 
 
 if __name__ == "__main__":
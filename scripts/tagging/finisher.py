@@ -33,6 +33,8 @@ import argparse
 import logging
 import os
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import wandio
 from joblib._multiprocessing_helpers import mp
@@ -40,26 +42,37 @@ from joblib._multiprocessing_helpers import mp
 from bgphijacks.events.event import Event
 from bgphijacks.events.pfxevent_parser import PfxEventParser
 from bgphijacks.tagger.finisher import Finisher
-from bgphijacks.utils.swift import SwiftUtils
+from bgphijacks.utils.data.elastic import ElasticConn
+from scripts.utils.finished_index import FinishedLinesIndex
+from scripts.utils.swift_manifest import SwiftManifest
+from scripts.utils.partitioner import density_time_chunks
 
 
 class FinisherEngine:
 
-    def __init__(self, event_type):
+    def __init__(self, event_type, prefetch=4, use_index=False, refresh_manifest=False):
         self.event_type = event_type
-        self.swift = SwiftUtils()
+        self.prefetch = max(1, prefetch)
+        self.refresh_manifest = refresh_manifest
+        self.manifest = SwiftManifest()
+        self.finished_index = FinishedLinesIndex(event_type, self.manifest) if use_index else None
+
+    def _read_finished_lines(self, filename):
+        if self.finished_index is not None:
+            return self.finished_index.finished_lines(filename)
+        return wandio.open("swift://bgp-hijacks-{}/{}".format(self.event_type, filename))
 
     def _extract_finished_event(self, filename):
         """
         One consumer file to one finished events with many finished prefix events in it.
 
-        :param filename: swift file name for consumer data
+        :param filename: swift object name of the consumer file
         :return: one finished event corresponding to the consumer file
         """
 
         parser = PfxEventParser(self.event_type)
         finished_event = None
-        for line in wandio.open(filename):
+        for line in self._read_finished_lines(filename):
             # ignore commented lines
             if line.startswith("#") or "FINISHED" not in line:
                 continue
@@ -91,27 +104,57 @@ class FinisherEngine:
 
         # now look for all finished events from start_ts
         logging.info("start processing data from consumer files on swift")
-        for swift_file_name in self.swift.swift_files_generator("bgp-hijacks-{}".format(self.event_type)):
-            ts = int(swift_file_name.split("/")[4].split('.')[1])
-            if ts < minimum_ts or ts > maximum_ts:
-                continue
-            swift_url = "swift://bgp-hijacks-{}/{}".format(self.event_type, swift_file_name)
-            view_ts = int(swift_file_name.split(".")[-3])
-
-            logging.info("backfilling events on time {} earliest {}".format(view_ts, minimum_ts))
-            finished_event = self._extract_finished_event(swift_url)
-            if finished_event is None:
-                continue
-            updated = finisher.process_finished_event(finished_event)
-            if not finisher.unfinished_events:
-                break
-            if updated:
-                # recalculate the minimum_ts if events have been updated
-                minimum_ts = int(min(finisher.unfinished_events).split("-")[1])
-
-
-def run_process(event_type, start_ts, end_ts):
-    finisher = FinisherEngine(event_type)
+        container = "bgp-hijacks-{}".format(self.event_type)
+        listing = self.manifest.list_objects(container, minimum_ts, maximum_ts, full=self.refresh_manifest)
+        candidates = iter([(name, ts) for name, ts in listing if minimum_ts <= ts <= maximum_ts])
+        if self.finished_index is not None:
+            self.finished_index.refresh(minimum_ts, maximum_ts)
+
+        # download and decompress the next few files while the current one is processed, in file order
+        with ThreadPoolExecutor(max_workers=self.prefetch) as executor:
+            pending = deque()
+
+            def prefetch_next():
+                for swift_file_name, ts in candidates:
+                    if ts < minimum_ts:
+                        # events before this file have all been finished already
+                        continue
+                    pending.append((swift_file_name, ts, executor.submit(self._extract_finished_event, swift_file_name)))
+                    return
+
+            for _ in range(self.prefetch):
+                prefetch_next()
+
+            while pending:
+                swift_file_name, ts, future = pending.popleft()
+                prefetch_next()
+                if ts < minimum_ts:
+                    future.cancel()
+                    continue
+                view_ts = int(swift_file_name.split(".")[-3])
+
+                logging.info("backfilling events on time {} earliest {}".format(view_ts, minimum_ts))
+                finished_event = future.result()
+                if self.finished_index is not None:
+                    self.finished_index.record_uploaded()
+                if finished_event is None:
+                    continue
+                updated = finisher.process_finished_event(finished_event)
+                if not finisher.unfinished_events:
+                    for _, _, f in pending:
+                        f.cancel()
+                    break
+                if updated:
+                    # recalculate the minimum_ts if events have been updated
+                    minimum_ts = int(min(finisher.unfinished_events).split("-")[1])
+
+        if self.finished_index is not None:
+            # sidecars of files still being prefetched when processing stopped
+            self.finished_index.record_uploaded()
+
+
+def run_process(event_type, start_ts, end_ts, prefetch=4, use_index=False, refresh_manifest=False):
+    finisher = FinisherEngine(event_type, prefetch=prefetch, use_index=use_index, refresh_manifest=refresh_manifest)
     finisher.run_finisher(start_ts=start_ts, end_ts=end_ts)
 
 
@@ -128,6 +171,18 @@ def main():
     parser.add_argument('-p', '--processes', nargs="?", type=int, required=False,
                         default=1,
                         help="Number of processes to divide the time range and run, specify 0 to use all available cores")
+    parser.add_argument('-C', '--chunks', nargs="?", type=int, required=False,
+                        default=0,
+                        help="Number of event-density-balanced chunks to split the time range into, "
+                             "default to one equal-width slice per process")
+    parser.add_argument('--prefetch', nargs="?", type=int, required=False,
+                        default=4,
+                        help="Number of consumer files to download and decompress ahead of processing")
+    parser.add_argument('-I', '--use-index', action="store_true", default=False,
+                        help="Read FINISHED lines from sidecar index objects, building missing ones on the way")
+    parser.add_argument("--refresh-manifest", action="store_true", default=False,
+                        help="List the consumer files of the time range on swift again, picking up files uploaded "
+                             "or rewritten after their day was listed")
 
     opts = parser.parse_args()
     logging.basicConfig(format="%(levelname)s %(asctime)s: %(message)s",
@@ -144,23 +199,30 @@ def main():
     processes = opts.processes
     if processes == 1:
         # single-process runner
-        run_process(opts.type, opts.start_ts, opts.end_ts)
+        run_process(opts.type, opts.start_ts, opts.end_ts, opts.prefetch, opts.use_index, opts.refresh_manifest)
         return
 
     # multi-process runner
     if processes <= 0:
         processes = os.cpu_count()
-    step = int((opts.end_ts - opts.start_ts) / processes)
-    cur_ts = opts.start_ts
     args = []
-    while cur_ts < opts.end_ts:
-        cur_end = cur_ts + step
-        args.append((opts.type, cur_ts, cur_end))
-        cur_ts += step
+    if opts.chunks > 0:
+        # idle workers pick up the next chunk, so a burst of events does not stall a single worker
+        chunks = density_time_chunks(ElasticConn(), ElasticConn.get_index_name(event_type=opts.type),
+                                     opts.start_ts, opts.end_ts, opts.chunks)
+        for cur_ts, cur_end in chunks:
+            args.append((opts.type, cur_ts, cur_end, opts.prefetch, opts.use_index, opts.refresh_manifest))
+    else:
+        step = int((opts.end_ts - opts.start_ts) / processes)
+        cur_ts = opts.start_ts
+        while cur_ts < opts.end_ts:
+            cur_end = cur_ts + step
+            args.append((opts.type, cur_ts, cur_end, opts.prefetch, opts.use_index, opts.refresh_manifest))
+            cur_ts += step
     logging.info(args)
 
     with mp.Pool(processes=processes) as pool:
-        pool.starmap(run_process, args)
+        pool.starmap(run_process, args, chunksize=1)
 
 
 if __name__ == "__main__":
@@ -30,16 +30,18 @@
 #  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
 #  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
 import argparse
+import functools
 import gzip
 import json
 import logging
 
 from bgphijacks.events.event import Event
-from bgphijacks.tagger.tagger import Tagger
 from bgphijacks.tagger.tagger_defcon import DefconTagger
 from bgphijacks.tagger.tagger_edges import EdgesTagger
 from bgphijacks.tagger.tagger_moas import MoasTagger
 from bgphijacks.tagger.tagger_submoas import SubMoasTagger
+from scripts.utils.elastic_bulk import BulkIndexer
+from scripts.utils.view_cache import TaggerViewCache
 
 TAGGER = {
     "defcon": DefconTagger,
@@ -48,36 +50,107 @@ TAGGER = {
     "submoas": SubMoasTagger,
 }
 
+LOG_INTERVAL = 10000
+
 
 def from_json(event_json: str):
     d = json.loads(event_json)
     return Event.from_dict(d)
 
 
-def retag_events(tagger: Tagger, events_file):
+class GzipSink:
     """
-    Retag an existing event.
-    :param events_file:
-    :param tagger:
-    :param event:
-    :return: event
+    Write retagged events to a gzip-compressed file, one JSON event per line.
     """
 
-    logging.info("counting events from {} ...".format(events_file))
-    total = 0
-    for _ in gzip.open(events_file):
-        total += 1
-    logging.info("{} events in total".format(total))
+    def __init__(self, filename):
+        self.fout = gzip.open(filename, "wt")
+
+    def write(self, event):
+        self.fout.write("{}\n".format(event.as_json()))
+
+    def close(self):
+        self.fout.close()
+
+
+class ElasticSink:
+    """
+    Commit retagged events back to ElasticSearch using bulk requests.
+    """
+
+    def __init__(self, debug=False):
+        self.indexer = BulkIndexer(debug=debug)
+
+    def write(self, event):
+        self.indexer.add_event(event)
+
+    def close(self):
+        self.indexer.close()
+
 
+def read_view_groups(events_file, sort=False):
+    """
+    Read events file once and group events by their view timestamps.
+
+    Without sorting, consecutive events sharing the same `view_ts` form one group, which suits files written by the
+    taggers in view order. With sorting, all events are loaded first and each view is yielded exactly once.
+
+    :param events_file: gzip-compressed events file, one JSON event per line
+    :param sort: whether to load all events and sort them by `view_ts`
+    :return: generator of (view_ts, list of events)
+    """
+    if sort:
+        groups = {}
+        for event_json in gzip.open(events_file):
+            event = from_json(event_json)
+            groups.setdefault(event.view_ts, []).append(event)
+        for view_ts in sorted(groups):
+            yield view_ts, groups.pop(view_ts)
+        return
+
+    cur_ts = None
+    cur_events = []
     for event_json in gzip.open(events_file):
         event = from_json(event_json)
-        assert isinstance(event, Event)
-        logging.info("retagging event {}".format(event.event_id))
-        ts = event.view_ts
-        tagger.update_datasets(ts)
-        tagger.methodology.prepare_for_view(ts)
-        tagger.tag_event(event)
-        logging.info("tagging finished")
+        if event.view_ts != cur_ts and cur_events:
+            yield cur_ts, cur_events
+            cur_events = []
+        cur_ts = event.view_ts
+        cur_events.append(event)
+    if cur_events:
+        yield cur_ts, cur_events
+
+
+def retag_events(taggers: TaggerViewCache, events_file, sink=None, sort=False):
+    """
+    Retag existing events, preparing tagger datasets only once per view.
+
+    :param taggers: cache of taggers prepared for recently used views
+    :param events_file: gzip-compressed events file
+    :param sink: optional sink to write retagged events to (GzipSink or ElasticSink)
+    :param sort: whether to sort all events by view time before retagging
+    :return: number of events retagged
+    """
+
+    logging.info("retagging events from {} ...".format(events_file))
+    total = 0
+    views = 0
+    for view_ts, events in read_view_groups(events_file, sort=sort):
+        tagger = taggers.get(view_ts)
+        views += 1
+        for event in events:
+            assert isinstance(event, Event)
+            tagger.tag_event(event)
+            if sink is not None:
+                sink.write(event)
+            total += 1
+            if total % LOG_INTERVAL == 0:
+                logging.info("retagged {} events in {} views".format(total, views))
+    if sink is not None:
+        sink.close()
+    logging.info("tagging finished: {} events in {} views".format(total, views))
+    taggers.log_stats()
+    return total
 
 
 def main():
@@ -91,6 +164,19 @@ def main():
     parser.add_argument("-p", "--pfx2as-file", help="Prefix to AS mapping file", default=None)
     parser.add_argument("-o", "--offsite-mode", action="store_true", default=False,
                         help="Run tagging off from production site")
+    parser.add_argument("-O", "--output", nargs="?", default=None,
+                        help="Write retagged events to this gzip file, one JSON event per line")
+    parser.add_argument("-S", "--elastic", action="store_true", default=False,
+                        help="Commit retagged events to ElasticSearch")
+    parser.add_argument("-d", "--debug", action="store_true", default=False,
+                        help="Commit events to -test- indices when used with --elastic")
+    parser.add_argument("--cache-views", type=int, default=1,
+                        help="Number of views to keep prepared taggers for")
+    parser.add_argument("--cache-memory", type=int, default=0,
+                        help="Memory budget in MB for the prepared taggers, 0 means unlimited")
+    parser.add_argument("--sort", action="store_true", default=False,
+                        help="Load all events and sort them by view time before retagging, "
+                             "use it for files not written in view order")
 
     opts = parser.parse_args()
 
@@ -99,7 +185,7 @@ def main():
                         # filename=LOG_FILENAME,
                         level=logging.INFO)
 
-    tagger = TAGGER[opts.type](options={
+    tagger_factory = functools.partial(TAGGER[opts.type], options={
         # "in_memory_data": opts.in_memory,
         "enable_finisher": False,
         "debug": True,
@@ -109,7 +195,14 @@ def main():
         "pfx2as_file": opts.pfx2as_file,
     })
 
-    retag_events(tagger, opts.events_file)
+    sink = None
+    if opts.output:
+        sink = GzipSink(opts.output)
+    elif opts.elastic:
+        sink = ElasticSink(debug=opts.debug)
+
+    taggers = TaggerViewCache(tagger_factory, max_views=opts.cache_views, memory_budget=opts.cache_memory * 1024 * 1024)
+    retag_events(taggers, opts.events_file, sink=sink, sort=opts.sort)
 
 
 if __name__ == "__main__":
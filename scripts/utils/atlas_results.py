@@ -0,0 +1,188 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Concurrent, rate-limited retrieval of RIPE Atlas measurement results with an on-disk cache
+"""
+import gzip
+import json
+import logging
+import os
+import ssl
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CACHE_DIR = "/tmp/grip-atlas-results"
+DEFAULT_ATLAS_URL = "https://atlas.ripe.net"
+# measurement status ids after which results no longer change: 4 (stopped) and 5 (forced to stop)
+STOPPED_STATUSES = (4, 5)
+
+
+class RateLimiter:
+    """
+    RateLimiter spaces calls to `wait` evenly so that at most `rate` of them return per second, across threads.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0
+        self.lock = threading.Lock()
+        self.next_ts = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            ts = max(now, self.next_ts)
+            self.next_ts = ts + self.interval
+        if ts > now:
+            time.sleep(ts - now)
+
+
+class AtlasResultsCache:
+    """
+    AtlasResultsCache stores raw results of each measurement in a gzipped JSON file named after its `msm_id`.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, msm_id):
+        return os.path.join(self.directory, "{}.json.gz".format(msm_id))
+
+    def get(self, msm_id):
+        path = self._path(msm_id)
+        if not os.path.exists(path):
+            return None
+        try:
+            with gzip.open(path, "rt") as fh:
+                return json.load(fh)
+        except (OSError, ValueError) as error:
+            logging.warning("ignoring corrupted cached results of measurement {}: {}".format(msm_id, error))
+            return None
+
+    def put(self, msm_id, responses):
+        path = self._path(msm_id)
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with gzip.open(tmp_path, "wt") as fh:
+            json.dump(responses, fh)
+        os.replace(tmp_path, path)
+
+
+class AtlasResultsFetcher:
+    """
+    AtlasResultsFetcher retrieves measurement results with a bounded pool of threads and a shared rate limit.
+
+    Results of stopped measurements never change, so their responses are cached on disk and reruns do not query Atlas
+    again. The status of a measurement is checked before its results are fetched, and results of measurements that
+    were still running are not cached.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, workers=8, rate=10, base_url=DEFAULT_ATLAS_URL, verify=True,
+                 max_retries=3, backoff=5, timeout=60):
+        """
+        :param cache_dir: directory of cached results, None to disable caching
+        :param workers: number of concurrent requests
+        :param rate: maximum number of requests started per second, 0 for no limit
+        :param base_url: scheme and host of an Atlas-compatible API, e.g. a local stand-in
+        :param verify: whether to verify the TLS certificate of the server
+        :param max_retries: number of retries of failed requests
+        :param backoff: seconds to wait before the first retry, doubled on each further retry
+        :param timeout: timeout of each request in seconds
+        """
+        self.cache = AtlasResultsCache(cache_dir) if cache_dir else None
+        self.workers = workers
+        self.limiter = RateLimiter(rate)
+        self.base_url = base_url.rstrip("/")
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.ssl_context = None
+        if not verify:
+            self.ssl_context = ssl.create_default_context()
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+
+    def _get_json(self, path):
+        self.limiter.wait()
+        request = urllib.request.Request("{}{}".format(self.base_url, path), headers={"Accept": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout, context=self.ssl_context) as response:
+            return json.load(response)
+
+    def _fetch_once(self, msm_id, stopped):
+        if stopped is None:
+            measurement = self._get_json("/api/v2/measurements/{}/".format(msm_id))
+            stopped = measurement["status"]["id"] in STOPPED_STATUSES
+        responses = self._get_json("/api/v2/measurements/{}/results/?format=json".format(msm_id))
+        return stopped, responses
+
+    def fetch(self, msm_id, stopped=None):
+        """
+        Retrieve the results of one measurement.
+
+        :param msm_id: measurement id
+        :param stopped: True if the caller knows the measurement has stopped, None to check its status first
+        :return: (is_success, responses), responses being the error message on failure
+        """
+        if self.cache:
+            responses = self.cache.get(msm_id)
+            if responses is not None:
+                return True, responses
+
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                is_stopped, responses = self._fetch_once(msm_id, stopped)
+            except Exception as error:
+                logging.warning("failed to fetch results of measurement {} (attempt {}): {}".format(
+                    msm_id, attempt + 1, error))
+                last_error = str(error)
+                continue
+            if self.cache and is_stopped:
+                self.cache.put(msm_id, responses)
+            return True, responses
+        return False, last_error
+
+    def fetch_many(self, msm_ids):
+        """
+        Retrieve the results of many measurements concurrently.
+
+        :param msm_ids: iterable of measurement ids
+        :return: dictionary of msm_id to (is_success, responses)
+        """
+        msm_ids = list(dict.fromkeys(msm_ids))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return dict(zip(msm_ids, executor.map(self.fetch, msm_ids)))
@@ -0,0 +1,140 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Durable per-partition progress journal for long-running batch jobs
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+
+# options that do not change the work a run has to do
+IGNORED_OPTIONS = ("resume", "checkpoint_dir", "refresh_manifest")
+
+
+def run_hash(opts, ignored=IGNORED_OPTIONS):
+    """
+    Hash the parameters of a run, so that reruns with the same parameters share the same lock and journal files.
+
+    :param opts: parsed argparse options
+    :param ignored: option names excluded from the hash
+    :return: hex digest string
+    """
+    params = {k: v for k, v in vars(opts).items() if k not in ignored}
+    return hashlib.sha1((json.dumps(params, sort_keys=True, ensure_ascii=True)).encode()).hexdigest()
+
+
+class Checkpoint:
+    """
+    Checkpoint records the progress of each partition (time range) of a run in a local SQLite journal.
+
+    The journal stores the partition plan of the run, the last position (e.g. the last processed `view_ts` or
+    `search_after` key) of every partition, and which partitions are finished. Worker processes open their own
+    `Checkpoint` on the same path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS progress ("
+                              "partition TEXT PRIMARY KEY, position TEXT, done INTEGER, updated_ts INTEGER)")
+
+    @classmethod
+    def for_run(cls, name, opts, directory="/tmp", resume=False):
+        """
+        Open the journal of a run identified by its name and parameters.
+
+        :param name: name of the tool, e.g. "backfill"
+        :param opts: parsed argparse options
+        :param directory: directory to keep journal files in
+        :param resume: keep the progress of a previous run with the same parameters, otherwise start over
+        :return: Checkpoint instance
+        """
+        path = os.path.join(directory, "{}-{}.sqlite".format(name, run_hash(opts)))
+        if os.path.exists(path):
+            if resume:
+                logging.info("resuming from checkpoint journal {}".format(path))
+            else:
+                logging.info("removing previous checkpoint journal {}".format(path))
+                for fn in [path, path + "-wal", path + "-shm"]:
+                    if os.path.exists(fn):
+                        os.remove(fn)
+        return cls(path)
+
+    @staticmethod
+    def partition_name(start_ts, end_ts):
+        return "{}-{}".format(start_ts, end_ts)
+
+    def get_plan(self):
+        """
+        :return: list of (start_ts, end_ts) partitions saved for this run, None if no plan has been saved
+        """
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'plan'").fetchone()
+        if row is None:
+            return None
+        return [tuple(r) for r in json.loads(row[0])]
+
+    def save_plan(self, ranges):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('plan', ?)", (json.dumps(ranges),))
+
+    def get_progress(self, partition):
+        """
+        :param partition: partition name
+        :return: tuple of (last position or None, whether the partition is finished)
+        """
+        row = self.conn.execute("SELECT position, done FROM progress WHERE partition = ?", (partition,)).fetchone()
+        if row is None:
+            return None, False
+        position = json.loads(row[0]) if row[0] is not None else None
+        return position, bool(row[1])
+
+    def update(self, partition, position):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO progress (partition, position, done, updated_ts) "
+                              "VALUES (?, ?, 0, ?)", (partition, json.dumps(position), int(time.time())))
+
+    def finish(self, partition):
+        with self.conn:
+            self.conn.execute("INSERT INTO progress (partition, position, done, updated_ts) VALUES (?, NULL, 1, ?) "
+                              "ON CONFLICT(partition) DO UPDATE SET done = 1, updated_ts = excluded.updated_ts",
+                              (partition, int(time.time())))
+
+    def close(self):
+        self.conn.close()
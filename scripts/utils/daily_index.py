@@ -0,0 +1,78 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Helpers for daily ElasticSearch event indices
+"""
+import calendar
+import re
+from datetime import datetime
+
+# date suffix of daily event indices, e.g. 2020.01.31 or 2020-01-31
+INDEX_DATE_PATTERN = re.compile(r"(\d{4})[.-](\d{2})[.-](\d{2})$")
+
+DAY_SECONDS = 86400
+
+
+def index_day_range(index):
+    """
+    Get the time range covered by a daily index from its name.
+
+    :param index: index name
+    :return: (start_ts, end_ts) of the day, or None if the name has no date suffix
+    """
+    match = INDEX_DATE_PATTERN.search(index)
+    if not match:
+        return None
+    day_start = calendar.timegm(datetime(*map(int, match.groups())).timetuple())
+    return day_start, day_start + DAY_SECONDS
+
+
+def list_daily_indices(es_conn, index_pattern, start_ts=None, end_ts=None):
+    """
+    List open indices matching a pattern, skipping daily indices whose day falls outside the time range.
+
+    :param es_conn: ElasticConn instance
+    :param index_pattern: index pattern
+    :param start_ts:
+    :param end_ts:
+    :return: sorted list of index names
+    """
+    indices = []
+    for index in sorted(es_conn.es.indices.get_alias(index=index_pattern, expand_wildcards="open").keys()):
+        day_range = index_day_range(index)
+        if day_range:
+            day_start, day_end = day_range
+            if (start_ts and day_end <= start_ts) or (end_ts and day_start >= end_ts):
+                continue
+        indices.append(index)
+    return indices
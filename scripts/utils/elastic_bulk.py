@@ -0,0 +1,198 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Buffered bulk writer for committing events to ElasticSearch
+"""
+
+import json
+import logging
+import time
+
+import elasticsearch
+
+from bgphijacks.events.event import Event
+from bgphijacks.utils.data.elastic import ElasticConn
+
+# HTTP status codes that mean "slow down and try again" vs. "this request is too large"
+STATUS_TOO_MANY_REQUESTS = 429
+STATUS_TOO_LARGE = 413
+
+
+class BulkIndexer:
+    """
+    BulkIndexer buffers documents and commits them to ElasticSearch using the `_bulk` API.
+
+    The buffer is flushed when it reaches `max_docs` documents, `max_bytes` bytes, or when the oldest buffered document
+    is older than `max_age` seconds. Batches rejected with 413 (request too large) are split in half and resubmitted;
+    requests and items rejected with 429 (too many requests) are retried with exponential backoff. Items that still fail
+    are logged and recorded in `failures`.
+    """
+
+    def __init__(self, es_conn=None, max_docs=500, max_bytes=10 * 1024 * 1024, max_age=10, max_retries=5,
+                 backoff=1, debug=False):
+        self.es_conn = es_conn if es_conn is not None else ElasticConn()
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.debug = debug
+
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.buffer_ts = None
+
+        # statistics
+        self.indexed = 0
+        self.retried = 0
+        self.failures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def add_event(self, event, index=None):
+        """
+        Buffer an event for indexing.
+
+        :param event: event to commit
+        :param index: destination index, inferred from event type and view time if not specified
+        :return:
+        """
+        assert isinstance(event, Event)
+        if index is None:
+            index = ElasticConn.get_index_name(event_type=event.event_type, view_ts=event.view_ts, debug=self.debug)
+        self.add(index, event.event_id, event.as_json())
+
+    def add(self, index, doc_id, source):
+        """
+        Buffer a raw document for indexing.
+
+        :param index: destination index name
+        :param doc_id: document id
+        :param source: document body, either a JSON string or a dictionary
+        :return:
+        """
+        if not isinstance(source, str):
+            source = json.dumps(source)
+        action = json.dumps({"index": {"_index": index, "_id": doc_id}})
+        item = (doc_id, index, "{}\n{}\n".format(action, source))
+
+        if self.buffer_ts is None:
+            self.buffer_ts = time.time()
+        self.buffer.append(item)
+        self.buffer_bytes += len(item[2])
+
+        if len(self.buffer) >= self.max_docs or self.buffer_bytes >= self.max_bytes:
+            self.flush()
+        else:
+            self.flush_if_stale()
+
+    def flush_if_stale(self):
+        """
+        Flush the buffer if the oldest buffered document has waited longer than `max_age` seconds.
+        Callers that may block for a long time between documents should call this periodically.
+        """
+        if self.buffer_ts is not None and time.time() - self.buffer_ts >= self.max_age:
+            self.flush()
+
+    def flush(self):
+        """
+        Commit all buffered documents to ElasticSearch.
+        """
+        if not self.buffer:
+            return
+        batch = self.buffer
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.buffer_ts = None
+        self._submit(batch)
+
+    def close(self):
+        self.flush()
+        if self.failures:
+            logging.warning("bulk indexing finished with {} failed documents".format(len(self.failures)))
+
+    def _sleep(self, attempt):
+        time.sleep(self.backoff * (2 ** attempt))
+
+    def _record_failure(self, item, status, reason):
+        doc_id, index, _ = item
+        logging.warning("failed to index {} into {}: status = {}, reason = {}".format(doc_id, index, status, reason))
+        self.failures.append((index, doc_id, status, reason))
+
+    def _submit(self, batch, attempt=0):
+        body = "".join([item[2] for item in batch])
+        try:
+            response = self.es_conn.es.bulk(body=body)
+        except elasticsearch.exceptions.TransportError as error:
+            if error.status_code == STATUS_TOO_LARGE:
+                if len(batch) == 1:
+                    # allow continuing the program if certain events are too large
+                    self._record_failure(batch[0], error.status_code, "document too large")
+                    return
+                logging.info("bulk request too large, splitting {} documents".format(len(batch)))
+                middle = len(batch) // 2
+                self._submit(batch[:middle], attempt)
+                self._submit(batch[middle:], attempt)
+                return
+            if error.status_code == STATUS_TOO_MANY_REQUESTS and attempt < self.max_retries:
+                logging.info("bulk request rejected, retrying {} documents".format(len(batch)))
+                self.retried += len(batch)
+                self._sleep(attempt)
+                self._submit(batch, attempt + 1)
+                return
+            raise error
+
+        if not response.get("errors", False):
+            self.indexed += len(batch)
+            return
+
+        to_retry = []
+        for item, result in zip(batch, response["items"]):
+            info = result.get("index", {})
+            status = info.get("status", 0)
+            if status < 300:
+                self.indexed += 1
+            elif status == STATUS_TOO_MANY_REQUESTS and attempt < self.max_retries:
+                to_retry.append(item)
+            else:
+                self._record_failure(item, status, info.get("error"))
+
+        if to_retry:
+            logging.info("{} documents rejected by bulk request, retrying".format(len(to_retry)))
+            self.retried += len(to_retry)
+            self._sleep(attempt)
+            self._submit(to_retry, attempt + 1)
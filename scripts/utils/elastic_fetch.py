@@ -0,0 +1,63 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Batched retrieval of ElasticSearch documents by id
+"""
+
+from bgphijacks.events.event import Event
+
+
+def mget_events(es_conn, refs, source=True, raw_json=False):
+    """
+    Retrieve many events with one `_mget` request.
+
+    :param es_conn: ElasticConn instance
+    :param refs: list of (index, event_id) tuples
+    :param source: True to fetch whole documents, False to only check existence, or list of fields to fetch
+    :param raw_json: return raw `_source` dictionaries instead of `Event` objects
+    :return: dictionary of event_id to event, missing events map to None
+    """
+    if not refs:
+        return {}
+    body = {"docs": [{"_index": index, "_id": event_id, "_source": source} for index, event_id in refs]}
+    res = es_conn.es.mget(body=body)
+
+    events = {}
+    for doc in res["docs"]:
+        if not doc.get("found", False):
+            events.setdefault(doc["_id"], None)
+        elif source is False or raw_json:
+            events[doc["_id"]] = doc.get("_source", {})
+        else:
+            events[doc["_id"]] = Event.from_dict(doc["_source"])
+    return events
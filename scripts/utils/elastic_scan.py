@@ -0,0 +1,121 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Parallel scanning of ElasticSearch indices using sliced point-in-time searches
+"""
+
+import logging
+import time
+
+import elasticsearch
+
+from bgphijacks.events.event import Event
+
+# transport errors worth retrying, anything else is a problem with the query itself
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+
+def open_point_in_time(es_conn, index, keep_alive="1m"):
+    """
+    Open a point-in-time on the given index pattern.
+
+    :return: point-in-time id
+    """
+    return es_conn.es.open_point_in_time(index=index, keep_alive=keep_alive)["id"]
+
+
+def close_point_in_time(es_conn, pit_id):
+    try:
+        es_conn.es.close_point_in_time(body={"id": pit_id})
+    except elasticsearch.exceptions.NotFoundError:
+        # point-in-time already expired
+        pass
+
+
+def sliced_search_generator(es_conn, pit_id, query, slice_id, max_slices, keep_alive="1m", raw_json=False,
+                            max_retries=10, backoff=1, sort=None, search_after=None, with_sort=False):
+    """
+    Iterate through one slice of a point-in-time using `search_after` pagination.
+
+    Unlike a scroll, the point-in-time only needs to live for `keep_alive` between two requests. On transient errors the
+    reader backs off and resumes from the sort value of the last received document.
+
+    :param es_conn: ElasticConn instance
+    :param pit_id: point-in-time id from `open_point_in_time`
+    :param query: search query, e.g. from `query_in_range`; its `sort` is replaced by `sort`
+    :param slice_id: id of the slice to read, from 0 to `max_slices` - 1
+    :param max_slices: total number of slices
+    :param keep_alive: how long the point-in-time stays alive between two requests
+    :param raw_json: yield raw `_source` dictionaries instead of `Event` objects
+    :param max_retries: number of consecutive failures before giving up
+    :param backoff: base number of seconds to wait before retrying
+    :param sort: sort order, default to the point-in-time shard order; use a unique, stable order to resume later runs
+    :param search_after: sort value of the last document already processed
+    :param with_sort: yield (event, sort value) tuples
+    :return: generator of events
+    """
+    body = {k: v for k, v in query.items() if k != "sort"}
+    body["sort"] = sort if sort is not None else [{"_shard_doc": "asc"}]
+    if max_slices > 1:
+        body["slice"] = {"id": slice_id, "max": max_slices}
+
+    failures = 0
+    while True:
+        body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+        if search_after is not None:
+            body["search_after"] = search_after
+        try:
+            res = es_conn.es.search(body=body)
+        except (elasticsearch.exceptions.ConnectionError, elasticsearch.exceptions.TransportError) as error:
+            status = getattr(error, "status_code", None)
+            if (isinstance(status, int) and status not in RETRY_STATUS_CODES) or failures >= max_retries:
+                raise error
+            failures += 1
+            logging.warning("slice {}/{}: search failed ({}), resuming after {}".format(
+                slice_id, max_slices, error, search_after))
+            time.sleep(backoff * (2 ** min(failures, 6)))
+            continue
+        failures = 0
+
+        # the point-in-time id may change between requests
+        pit_id = res.get("pit_id", pit_id)
+        hits = res["hits"]["hits"]
+        if not hits:
+            break
+        for hit in hits:
+            doc = hit["_source"] if raw_json else Event.from_dict(hit["_source"])
+            if with_sort:
+                yield doc, hit["sort"]
+            else:
+                yield doc
+        search_after = hits[-1]["sort"]
@@ -0,0 +1,69 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Tracking of long-running ElasticSearch tasks such as reindex and update-by-query
+"""
+import logging
+import time
+
+TASK_POLL_INTERVAL = 30
+
+
+def wait_for_task(es_conn, task_id, name=None, poll_interval=TASK_POLL_INTERVAL):
+    """
+    Poll the task API until a task started with `wait_for_completion=False` finishes, logging its progress.
+
+    :param es_conn: ElasticConn instance
+    :param task_id: id of the task, as returned when starting it
+    :param name: name of the task in log messages, defaults to the task id
+    :param poll_interval: seconds between progress checks
+    :return: response of the finished task
+    """
+    name = name or task_id
+    while True:
+        task = es_conn.es.tasks.get(task_id=task_id)
+        status = task["task"]["status"]
+        processed = sum(status.get(key, 0) for key in ("created", "updated", "deleted", "noops", "version_conflicts"))
+        logging.info("{}: {}/{} processed, {} created, {} updated, {} unchanged, {} conflicts".format(
+            name, processed, status.get("total", 0), status.get("created", 0), status.get("updated", 0),
+            status.get("noops", 0), status.get("version_conflicts", 0)))
+        if task.get("completed"):
+            break
+        time.sleep(poll_interval)
+
+    if "error" in task:
+        raise RuntimeError("task {} failed: {}".format(name, task["error"]))
+    response = task.get("response", {})
+    for failure in response.get("failures", []):
+        logging.warning("{}: failed on event {}: {}".format(name, failure.get("id"), failure.get("cause")))
+    return response
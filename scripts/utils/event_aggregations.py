@@ -0,0 +1,166 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Event statistics computed by ElasticSearch aggregations, returned as tidy rows
+"""
+
+EVENTS_INDEX_PATTERN = "observatory-events-*"
+# keep group counts well below the `search.max_buckets` cluster setting
+MAX_GROUPS = 10000
+
+
+class EventAggregator:
+    """
+    EventAggregator computes statistics over events with ElasticSearch aggregations instead of streaming documents to
+    the client. Results are lists of row dictionaries.
+    """
+
+    def __init__(self, esconn):
+        self.esconn = esconn
+
+    def _aggregate(self, aggs, index, query):
+        body = {"size": 0, "track_total_hits": True, "aggs": aggs}
+        if query:
+            body["query"] = query
+        res = self.esconn.es.search(index=index, body=body)
+        return res["hits"]["total"]["value"], res["aggregations"]
+
+    def _grouped_metric(self, metric, index, query, group_by, group_size):
+        """
+        Run a metric aggregation, optionally once per term of the `group_by` field.
+
+        :return: list of (group key, number of events, metric result) tuples, with None key if not grouped
+        """
+        aggs = {"metric": metric}
+        if group_by:
+            aggs = {"groups": {"terms": {"field": group_by, "size": group_size}, "aggs": aggs}}
+        total, aggregations = self._aggregate(aggs, index, query)
+        if group_by:
+            return [(b["key"], b["doc_count"], b["metric"]) for b in aggregations["groups"]["buckets"]]
+        return [(None, total, aggregations["metric"])]
+
+    @staticmethod
+    def _metric_source(field, script):
+        assert field or script, "either field or script is required"
+        if script:
+            return {"script": {"lang": "painless", "source": script}}
+        return {"field": field}
+
+    def percentiles(self, field=None, percents=(1, 5, 25, 50, 75, 95, 99), script=None, index=EVENTS_INDEX_PATTERN,
+                    query=None, group_by=None, group_size=MAX_GROUPS):
+        """
+        Compute percentiles of a numeric field or script value over events, e.g. the number of origins per event type
+        with `script="doc['summary.ases'].size()", group_by="event_type"`.
+
+        :param field: numeric field
+        :param percents: percentiles to compute
+        :param script: painless script computing the value instead of a field
+        :param index: index pattern to aggregate over
+        :param query: optional query selecting events
+        :param group_by: optional keyword field to compute percentiles for each of its terms
+        :param group_size: maximum number of groups
+        :return: list of rows {[group_by,] events, percentile, value}
+        """
+        metric = {"percentiles": dict(self._metric_source(field, script), percents=list(percents))}
+        rows = []
+        for key, events, result in self._grouped_metric(metric, index, query, group_by, group_size):
+            for percent in percents:
+                row = {group_by: key} if group_by else {}
+                row.update(events=events, percentile=percent, value=result["values"].get(str(float(percent))))
+                rows.append(row)
+        return rows
+
+    def cardinality(self, field=None, script=None, index=EVENTS_INDEX_PATTERN, query=None, group_by=None,
+                    group_size=MAX_GROUPS):
+        """
+        Approximate the number of distinct values of a field over events.
+
+        :return: list of rows {[group_by,] events, cardinality}
+        """
+        metric = {"cardinality": self._metric_source(field, script)}
+        rows = []
+        for key, events, result in self._grouped_metric(metric, index, query, group_by, group_size):
+            row = {group_by: key} if group_by else {}
+            row.update(events=events, cardinality=result["value"])
+            rows.append(row)
+        return rows
+
+    def terms(self, field, size=100, index=EVENTS_INDEX_PATTERN, query=None):
+        """
+        Count events by the most frequent terms of a field, e.g. tag frequencies with `field="tags"`.
+
+        :return: list of rows {field, count} ordered by decreasing count
+        """
+        _, aggregations = self._aggregate({"terms": {"terms": {"field": field, "size": size}}}, index, query)
+        return [{field: b["key"], "count": b["doc_count"]} for b in aggregations["terms"]["buckets"]]
+
+    def date_histogram(self, interval="1d", field="view_ts", split_by=None, split_size=100,
+                       index=EVENTS_INDEX_PATTERN, query=None):
+        """
+        Count events per time bucket, optionally split by the terms of another field, e.g. tag frequencies over time
+        with `split_by="tags"`.
+
+        :param interval: fixed bucket width, e.g. "1h" or "7d"
+        :param field: date field to bucket events by
+        :param split_by: optional keyword field to count each of its terms per bucket
+        :param split_size: maximum number of terms per bucket
+        :return: list of rows {time, [split_by,] count}, time in unix seconds
+        """
+        histogram = {"date_histogram": {"field": field, "fixed_interval": interval, "min_doc_count": 1}}
+        if split_by:
+            histogram["aggs"] = {"split": {"terms": {"field": split_by, "size": split_size}}}
+        _, aggregations = self._aggregate({"histogram": histogram}, index, query)
+
+        rows = []
+        for bucket in aggregations["histogram"]["buckets"]:
+            # bucket keys are epoch milliseconds
+            ts = int(bucket["key"] / 1000)
+            if split_by:
+                for split in bucket["split"]["buckets"]:
+                    rows.append({"time": ts, split_by: split["key"], "count": split["doc_count"]})
+            else:
+                rows.append({"time": ts, "count": bucket["doc_count"]})
+        return rows
+
+
+def format_rows(rows):
+    """
+    Format rows as tab-separated lines, starting with a header of the column names.
+
+    :param rows: list of row dictionaries sharing the same keys
+    :return: list of lines
+    """
+    if not rows:
+        return []
+    columns = list(rows[0])
+    return ["\t".join(columns)] + ["\t".join(str(row[column]) for column in columns) for row in rows]
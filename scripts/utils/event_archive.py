@@ -0,0 +1,261 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Local columnar archive of event summaries for offline analyses
+"""
+import glob
+import logging
+import os
+
+import numpy as np
+
+from scripts.utils.daily_index import index_day_range, list_daily_indices
+
+EVENTS_INDEX_PATTERN = "observatory-events-*"
+
+# columns kept for each event and their numpy types
+COLUMNS = {
+    "event_id": np.str_,
+    "event_type": np.str_,
+    "view_ts": np.int64,
+    "last_modified_ts": np.int64,
+    "n_ases": np.int32,
+    "n_prefixes": np.int32,
+    "n_tags": np.int32,
+    "suspicion_level": np.int32,
+}
+
+SOURCE_FIELDS = ["id", "event_type", "view_ts", "last_modified_ts", "summary.ases", "summary.prefixes",
+                 "summary.tags", "summary.inference_result.primary_inference.suspicion_level"]
+
+
+def summarize_event(e):
+    """
+    Reduce a raw event document to the archived columns.
+
+    :param e: raw event `_source` dictionary
+    :return: tuple of column values in `COLUMNS` order
+    """
+    summary = e.get("summary") or {}
+    inference = (summary.get("inference_result") or {}).get("primary_inference") or {}
+    suspicion_level = inference.get("suspicion_level")
+    return (
+        e["id"],
+        e["event_type"],
+        e["view_ts"],
+        e.get("last_modified_ts") or 0,
+        len(summary.get("ases") or []),
+        len(summary.get("prefixes") or []),
+        len(summary.get("tags") or []),
+        -1 if suspicion_level is None else suspicion_level,
+    )
+
+
+def _empty_columns():
+    return {name: np.array([], dtype=dtype) for name, dtype in COLUMNS.items()}
+
+
+def _to_columns(rows):
+    if not rows:
+        return _empty_columns()
+    values = list(zip(*rows))
+    return {name: np.array(values[i], dtype=dtype) for i, (name, dtype) in enumerate(COLUMNS.items())}
+
+
+class EventFrame:
+    """
+    EventFrame holds archived event summaries as one numpy array per column and answers queries with vectorized code.
+    """
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns["event_id"])
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def filter(self, mask):
+        """
+        Select events by a boolean mask, e.g. `frame.filter(frame["suspicion_level"] > 80)`.
+        """
+        return EventFrame({name: values[mask] for name, values in self.columns.items()})
+
+    def percentiles(self, column, q=range(1, 100)):
+        """
+        Compute percentiles of a column.
+
+        :return: list of (percentile, value) tuples
+        """
+        q = list(q)
+        if not len(self):
+            return [(p, None) for p in q]
+        return list(zip(q, np.percentile(self.columns[column], q)))
+
+    def distribution(self, column):
+        """
+        Count events by each distinct value of a column.
+
+        :return: list of (value, count) tuples sorted by value
+        """
+        values, counts = np.unique(self.columns[column], return_counts=True)
+        return list(zip(values.tolist(), counts.tolist()))
+
+    def group_by(self, key, column=None, agg="count"):
+        """
+        Aggregate a column over groups of events sharing the same key.
+
+        :param key: column to group by, e.g. `event_type`, or "day" to group by the day of `view_ts`
+        :param column: column to aggregate, not needed for `count`
+        :param agg: one of count, sum, mean, min, max, or a percentile as "p<N>", e.g. "p99"
+        :return: list of (key, value) tuples sorted by key
+        """
+        if not len(self):
+            return []
+        keys = self.columns["view_ts"] // 86400 * 86400 if key == "day" else self.columns[key]
+        groups, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        if agg == "count":
+            result = counts
+        elif agg in ("sum", "mean"):
+            result = np.bincount(inverse, weights=self.columns[column], minlength=len(groups))
+            if agg == "mean":
+                result = result / counts
+        elif agg in ("min", "max") or agg.startswith("p"):
+            # sort values by group, then reduce each contiguous run
+            order = np.lexsort((self.columns[column], inverse))
+            values = self.columns[column][order]
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            if agg == "min":
+                result = values[starts]
+            elif agg == "max":
+                result = values[starts + counts - 1]
+            else:
+                percentile = float(agg[1:])
+                result = np.array([np.percentile(values[s:s + c], percentile) for s, c in zip(starts, counts)])
+        else:
+            raise ValueError("unknown aggregation: {}".format(agg))
+        return list(zip(groups.tolist(), result.tolist()))
+
+
+class EventArchive:
+    """
+    EventArchive keeps summaries of events in one compressed numpy file per daily index under a local directory.
+
+    Refreshing only fetches events modified since the newest event already archived for each index, so the archive can
+    be kept up to date cheaply and analyses can run without querying the production cluster. `last_modified_ts` has a
+    resolution of one second, so events modified in the second of the newest archived event are fetched again.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _partition_path(self, index):
+        return os.path.join(self.directory, "{}.npz".format(index))
+
+    def _read_partition(self, path):
+        with np.load(path) as data:
+            return {name: data[name] for name in COLUMNS}
+
+    def _write_partition(self, path, columns):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as fh:
+            np.savez_compressed(fh, **columns)
+        os.replace(tmp_path, path)
+
+    def refresh(self, es_conn, index_pattern=EVENTS_INDEX_PATTERN, start_ts=None, end_ts=None):
+        """
+        Fetch new and modified events of matching daily indices into the archive.
+
+        :param es_conn: ElasticConn instance
+        :param index_pattern: pattern of the event indices to archive
+        :param start_ts: skip daily indices ending before this time
+        :param end_ts: skip daily indices starting after this time
+        :return: number of events fetched
+        """
+        fetched = 0
+        for index in list_daily_indices(es_conn, index_pattern, start_ts, end_ts):
+            path = self._partition_path(index)
+            columns = self._read_partition(path) if os.path.exists(path) else _empty_columns()
+            watermark = int(columns["last_modified_ts"].max()) if len(columns["last_modified_ts"]) else None
+
+            query = {"size": 10000, "_source": SOURCE_FIELDS}
+            if watermark is not None:
+                query["query"] = {"range": {"last_modified_ts": {"gte": watermark}}}
+            rows = [summarize_event(e) for e in es_conn.search_generator(index=index, query=query, raw_json=True)]
+            if watermark is not None:
+                # events of the watermark second that did not change since the last refresh
+                recent = columns["last_modified_ts"] >= watermark
+                archived = set(zip(*(columns[name][recent].tolist() for name in COLUMNS)))
+                rows = [row for row in rows if row not in archived]
+            if not rows:
+                continue
+
+            new_columns = _to_columns(rows)
+            # modified events replace their archived rows
+            keep = ~np.isin(columns["event_id"], new_columns["event_id"])
+            merged = {name: np.concatenate((columns[name][keep], new_columns[name])) for name in COLUMNS}
+            self._write_partition(path, merged)
+            fetched += len(rows)
+            logging.info("archived {} new or modified events from {}".format(len(rows), index))
+        return fetched
+
+    def load(self, event_type=None, start_ts=None, end_ts=None):
+        """
+        Load archived events into an `EventFrame`.
+
+        :param event_type: only load events of this type
+        :param start_ts: only load events with `view_ts` at or after this time
+        :param end_ts: only load events with `view_ts` before this time
+        :return: EventFrame
+        """
+        parts = []
+        for path in sorted(glob.glob(os.path.join(self.directory, "*.npz"))):
+            index = os.path.basename(path)[:-len(".npz")]
+            day_range = index_day_range(index)
+            if day_range and ((start_ts and day_range[1] <= start_ts) or (end_ts and day_range[0] >= end_ts)):
+                continue
+            parts.append(self._read_partition(path))
+        if not parts:
+            return EventFrame(_empty_columns())
+
+        frame = EventFrame({name: np.concatenate([part[name] for part in parts]) for name in COLUMNS})
+        mask = np.ones(len(frame), dtype=bool)
+        if event_type:
+            mask &= frame["event_type"] == event_type
+        if start_ts:
+            mask &= frame["view_ts"] >= start_ts
+        if end_ts:
+            mask &= frame["view_ts"] < end_ts
+        return frame.filter(mask)
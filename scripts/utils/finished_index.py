@@ -0,0 +1,162 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Sidecar index of FINISHED prefix event lines in consumer files
+"""
+
+import hashlib
+import json
+import logging
+from collections import deque
+
+import wandio
+
+from scripts.utils.swift_manifest import consumer_file_ts
+
+# sidecar objects use the same object names as the consumer files, in a separate container so that listings of the
+# consumer containers are not affected
+SIDECAR_CONTAINER = "bgp-hijacks-{}-finished"
+
+
+def scan_finished_lines(filename):
+    """
+    Scan a consumer file for FINISHED prefix event lines.
+
+    :param filename: consumer file URL
+    :return: list of records with the byte offset of the line in the decompressed file, a fingerprint and the line
+    """
+    records = []
+    offset = 0
+    for line in wandio.open(filename):
+        size = len(line.encode())
+        if not line.endswith("\n"):
+            size += 1
+        if not line.startswith("#") and "FINISHED" in line:
+            line = line.rstrip("\n")
+            records.append({
+                "offset": offset,
+                "fingerprint": hashlib.sha1(line.encode()).hexdigest()[:16],
+                "line": line,
+            })
+        offset += size
+    return records
+
+
+class FinishedLinesIndex:
+    """
+    FinishedLinesIndex serves the FINISHED lines of consumer files from compact sidecar objects.
+
+    A sidecar starts with a header record holding the etag of the consumer file it was built from, followed by one JSON
+    record per FINISHED line of the consumer file (see `scan_finished_lines`). Sidecars missing for a consumer file, or
+    built from an older version of it, are built from the consumer file on first use and uploaded, so later runs only
+    read the small sidecar instead of decompressing the whole consumer file. Uploaded sidecars are recorded in the
+    manifest, since the listing of their day may already be complete.
+
+    `finished_lines` may run on worker threads, while the manifest can only be used from the thread that created it, so
+    uploaded sidecars are queued and only recorded by `record_uploaded` on that thread.
+    """
+
+    def __init__(self, event_type, manifest):
+        self.source_container = "bgp-hijacks-{}".format(event_type)
+        self.container = SIDECAR_CONTAINER.format(event_type)
+        self.manifest = manifest
+        self.known = set()
+        self.source_etags = {}
+        # names of sidecars uploaded but not recorded in the manifest yet
+        self.uploaded = deque()
+
+    def refresh(self, start_ts, end_ts):
+        """
+        Learn which sidecars exist for the consumer files within [start_ts, end_ts], and the current etags of the
+        consumer files.
+        """
+        self.known.update([name for name, _ in self.manifest.list_objects(self.container, start_ts, end_ts)])
+        self.source_etags.update({name: etag for name, _, _, etag in
+                                  self.manifest.list_entries(self.source_container, start_ts, end_ts)})
+
+    def _read_sidecar(self, sidecar_url, source_etag):
+        """
+        :return: list of FINISHED lines, or None if the sidecar was built from another version of the consumer file
+        """
+        lines = []
+        header = None
+        for line in wandio.open(sidecar_url):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if header is None:
+                header = record
+                if "source_etag" not in header or (source_etag is not None and header["source_etag"] != source_etag):
+                    return None
+                continue
+            lines.append(record["line"])
+        return lines
+
+    def record_uploaded(self):
+        """
+        Record the sidecars uploaded since the last call in the manifest. Must be called from the thread that created
+        the manifest.
+        """
+        while self.uploaded:
+            swift_file_name = self.uploaded.popleft()
+            # size and etag of the stored object are filled in by the next full listing
+            self.manifest.add_object(self.container, swift_file_name, consumer_file_ts(swift_file_name), None, None)
+            self.known.add(swift_file_name)
+
+    def finished_lines(self, swift_file_name):
+        """
+        Retrieve the FINISHED lines of a consumer file, building its sidecar if necessary. Safe to call from worker
+        threads, see `record_uploaded`.
+
+        :param swift_file_name: consumer file object name in the consumer container
+        :return: list of FINISHED lines
+        """
+        sidecar_url = "swift://{}/{}".format(self.container, swift_file_name)
+        source_etag = self.source_etags.get(swift_file_name)
+        if swift_file_name in self.known:
+            lines = self._read_sidecar(sidecar_url, source_etag)
+            if lines is not None:
+                return lines
+            logging.info("consumer file {} changed since its sidecar was built, rebuilding".format(swift_file_name))
+
+        records = scan_finished_lines("swift://{}/{}".format(self.source_container, swift_file_name))
+        content = "".join("%s\n" % json.dumps(record) for record in [{"source_etag": source_etag}] + records)
+        try:
+            with wandio.open(sidecar_url, "w") as fout:
+                fout.write(content)
+        except Exception as error:
+            # the sidecar is only an optimization, keep going without it
+            logging.warning("failed to write finished-lines sidecar {}: {}".format(sidecar_url, error))
+        else:
+            self.uploaded.append(swift_file_name)
+        return [record["line"] for record in records]
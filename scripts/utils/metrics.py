@@ -0,0 +1,150 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Periodic operational metrics for the batch tools and monitors
+"""
+
+import contextlib
+import logging
+import os
+import socket
+import time
+
+# matches the `observatory-operations-view-metrics*` template (config/grip-template-view-metrics.json)
+METRICS_INDEX = "observatory-operations-view-metrics-tools"
+
+
+def kafka_consumer_lag(kafka_consumer):
+    """
+    Number of messages between the current position and the high watermark of each assigned partition.
+
+    :param kafka_consumer: confluent_kafka.Consumer instance
+    :return: dictionary of partition to lag
+    """
+    lag = {}
+    for tp in kafka_consumer.position(kafka_consumer.assignment()):
+        _, high = kafka_consumer.get_watermark_offsets(tp, cached=True)
+        if high < 0 or tp.offset < 0:
+            # unknown offsets, e.g. nothing consumed from the partition yet
+            continue
+        lag[tp.partition] = high - tp.offset
+    return lag
+
+
+class MetricsEmitter:
+    """
+    MetricsEmitter aggregates counters, gauges and per-stage latencies, and periodically commits them as one document
+    to the view metrics index.
+
+    Counters are reported as rates per second over the reporting interval, gauges as their latest value, and stage
+    latencies as average and maximum seconds. Tools call `maybe_emit` from their main loops; emitting failures are
+    logged and never interrupt the tool.
+    """
+
+    def __init__(self, es_conn, tool, interval=60, index=METRICS_INDEX):
+        self.es_conn = es_conn
+        self.tool = tool
+        self.interval = interval
+        self.index = index
+        self.host = socket.gethostname()
+        self._reset(time.time())
+        self.gauges = {}
+
+    def _reset(self, now):
+        self.period_start = now
+        self.counters = {}
+        self.latencies = {}
+
+    def incr(self, name, count=1):
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, stage, seconds):
+        total, count, maximum = self.latencies.get(stage, (0.0, 0, 0.0))
+        self.latencies[stage] = (total + seconds, count + 1, max(maximum, seconds))
+
+    def timer(self, stage):
+        """
+        Context manager measuring the latency of a stage, e.g. `with metrics.timer("index"): ...`
+        """
+        return _StageTimer(self, stage)
+
+    def maybe_emit(self):
+        if time.time() - self.period_start >= self.interval:
+            self.emit()
+
+    def emit(self):
+        now = time.time()
+        elapsed = max(now - self.period_start, 1e-6)
+        doc = {
+            "tool": self.tool,
+            "host": self.host,
+            "pid": os.getpid(),
+            "period_start_ts": int(self.period_start),
+            "emit_ts": int(now),
+        }
+        for name, count in self.counters.items():
+            doc[name] = count
+            doc["{}_per_sec".format(name)] = count / elapsed
+        for stage, (total, count, maximum) in self.latencies.items():
+            doc["{}_latency_avg".format(stage)] = total / count
+            doc["{}_latency_max".format(stage)] = maximum
+        doc.update(self.gauges)
+        self._reset(now)
+
+        try:
+            self.es_conn.es.index(index=self.index, body=doc)
+        except Exception as error:
+            logging.warning("failed to emit metrics: {}".format(error))
+
+
+def stage_timer(metrics, stage):
+    """
+    Measure the latency of a stage with `metrics`, or do nothing if metrics are disabled (None).
+    """
+    return metrics.timer(stage) if metrics is not None else contextlib.nullcontext()
+
+
+class _StageTimer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.observe(self.stage, time.time() - self.start)
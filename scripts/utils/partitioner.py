@@ -0,0 +1,146 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Split a time range into chunks holding roughly the same number of events
+"""
+
+import logging
+import math
+
+from bgphijacks.utils.data.elastic_queries import query_in_range
+
+# bgpview produces one view every 5 minutes, there is no point in splitting time ranges any finer
+VIEW_INTERVAL = 300
+# keep the histogram well below the `search.max_buckets` cluster setting
+MAX_BUCKETS = 50000
+
+
+def even_time_chunks(start_ts, end_ts, chunks):
+    """
+    Split [start_ts, end_ts) into `chunks` equal-width time ranges.
+
+    :return: list of (start_ts, end_ts) tuples, empty if the time range is empty
+    """
+    if end_ts <= start_ts:
+        return []
+    chunks = max(1, min(chunks, math.ceil((end_ts - start_ts) / VIEW_INTERVAL)))
+    step = math.ceil((end_ts - start_ts) / chunks)
+    return [(cur_ts, min(cur_ts + step, end_ts)) for cur_ts in range(start_ts, end_ts, step)]
+
+
+def event_histogram(es_conn, index, start_ts, end_ts, query=None, interval=None):
+    """
+    Retrieve the number of events per time bucket from ElasticSearch using a `date_histogram` aggregation on `view_ts`.
+
+    :param es_conn: ElasticConn instance
+    :param index: index pattern to aggregate over
+    :param start_ts: start of the time range (unix time)
+    :param end_ts: end of the time range (unix time)
+    :param query: optional search query (as produced by `query_in_range`) to count only the matching events
+    :param interval: histogram bucket width in seconds, chosen automatically if not specified
+    :return: list of (bucket_ts, count) tuples sorted by time
+    """
+    if interval is None:
+        buckets = math.ceil((end_ts - start_ts) / VIEW_INTERVAL / MAX_BUCKETS)
+        interval = VIEW_INTERVAL * max(1, buckets)
+    if query is None:
+        query = query_in_range(start_ts, end_ts)
+
+    body = {
+        "size": 0,
+        "query": query["query"],
+        "aggs": {
+            "events": {
+                "date_histogram": {
+                    "field": "view_ts",
+                    "fixed_interval": "{}s".format(interval),
+                    "min_doc_count": 1,
+                }
+            }
+        }
+    }
+    res = es_conn.es.search(index=index, body=body)
+    # bucket keys are epoch milliseconds
+    return [(int(b["key"] / 1000), b["doc_count"]) for b in res["aggregations"]["events"]["buckets"]]
+
+
+def balanced_time_chunks(histogram, start_ts, end_ts, chunks):
+    """
+    Cut [start_ts, end_ts) into at most `chunks` consecutive time ranges with roughly equal number of events.
+
+    A single histogram bucket is never split, so a bucket holding more than its share of events becomes a chunk on its
+    own. The returned chunks are ordered from the heaviest to the lightest so that a pool working through them in order
+    starts the long-running ones first.
+
+    :param histogram: list of (bucket_ts, count) tuples sorted by time
+    :param start_ts: start of the time range (unix time)
+    :param end_ts: end of the time range (unix time)
+    :param chunks: desired number of chunks
+    :return: list of (start_ts, end_ts) tuples, empty if the time range is empty
+    """
+    if end_ts <= start_ts:
+        return []
+    total = sum([count for _, count in histogram])
+    if total == 0:
+        return even_time_chunks(start_ts, end_ts, chunks)
+
+    target = total / chunks
+    ranges = []
+    cur_start = start_ts
+    cur_count = 0
+    for i, (bucket_ts, count) in enumerate(histogram):
+        cur_count += count
+        if cur_count < target or i == len(histogram) - 1:
+            continue
+        # cut right before the next non-empty bucket
+        cut_ts = min(max(histogram[i + 1][0], cur_start + 1), end_ts)
+        ranges.append((cur_start, cut_ts, cur_count))
+        cur_start = cut_ts
+        cur_count = 0
+    if cur_start < end_ts:
+        ranges.append((cur_start, end_ts, cur_count))
+
+    ranges.sort(key=lambda r: r[2], reverse=True)
+    logging.info("split {} events into {} chunks, largest chunk has {} events".format(
+        total, len(ranges), ranges[0][2]))
+    return [(s, e) for s, e, _ in ranges]
+
+
+def density_time_chunks(es_conn, index, start_ts, end_ts, chunks, query=None):
+    """
+    Split [start_ts, end_ts) into event-density-balanced chunks based on the events currently on ElasticSearch.
+
+    :return: list of (start_ts, end_ts) tuples, heaviest first
+    """
+    histogram = event_histogram(es_conn, index, start_ts, end_ts, query=query)
+    return balanced_time_chunks(histogram, start_ts, end_ts, chunks)
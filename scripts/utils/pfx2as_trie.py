@@ -0,0 +1,263 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+In-process longest-prefix-match snapshot of a prefix-to-origin-AS table
+"""
+import ipaddress
+import logging
+from array import array
+from collections import OrderedDict
+from datetime import datetime
+
+
+class _BitTrie:
+    """
+    Binary radix trie over fixed-width integer keys, stored as parallel arrays of child and value indices.
+
+    Node 0 is the root, so a child index of 0 means "no child". A value index of -1 means no prefix ends at the node.
+    """
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.left = array("i", [0])
+        self.right = array("i", [0])
+        self.value = array("i", [-1])
+
+    def insert(self, key, length, value):
+        node = 0
+        for i in range(length):
+            children = self.right if (key >> (self.bits - 1 - i)) & 1 else self.left
+            child = children[node]
+            if not child:
+                child = len(self.value)
+                self.left.append(0)
+                self.right.append(0)
+                self.value.append(-1)
+                children[node] = child
+            node = child
+        self.value[node] = value
+
+    def lookup(self, key):
+        node = 0
+        best = self.value[0]
+        for i in range(self.bits):
+            children = self.right if (key >> (self.bits - 1 - i)) & 1 else self.left
+            node = children[node]
+            if not node:
+                break
+            if self.value[node] >= 0:
+                best = self.value[node]
+        return best
+
+    def __len__(self):
+        return len(self.value)
+
+
+class Pfx2AsTrie:
+    """
+    Pfx2AsTrie resolves IP addresses to the origin ASes of their longest matching prefix, entirely in process.
+
+    Distinct origin lists are stored once and referenced by index from the trie nodes, which keeps a full day of
+    routing data compact enough to load once and query for every traceroute hop without any Redis round trip.
+    """
+
+    def __init__(self):
+        self.tries = {4: _BitTrie(32), 6: _BitTrie(128)}
+        self.origins = []
+        self.origin_ids = {}
+        self.prefixes = 0
+
+    def insert(self, prefix, origins):
+        """
+        Add a prefix with its origin ASes.
+
+        :param prefix: prefix as a string, e.g. "192.0.2.0/24"
+        :param origins: list of origin AS numbers as strings
+        """
+        network = ipaddress.ip_network(prefix, strict=False)
+        origins = tuple(origins)
+        value = self.origin_ids.get(origins)
+        if value is None:
+            value = len(self.origins)
+            self.origins.append(origins)
+            self.origin_ids[origins] = value
+        self.tries[network.version].insert(int(network.network_address), network.prefixlen, value)
+        self.prefixes += 1
+
+    def lookup(self, ip):
+        """
+        Get the origin ASes of the longest prefix covering an IP address.
+
+        :param ip: IP address as a string
+        :return: list of origin AS numbers as strings, or None if the address is invalid or not covered
+        """
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        value = self.tries[address.version].lookup(int(address))
+        return list(self.origins[value]) if value >= 0 else None
+
+    def lookup_many(self, ips):
+        """
+        Resolve many IP addresses at once, looking up each distinct address only once.
+
+        :param ips: iterable of IP addresses as strings
+        :return: dictionary of IP address to origin ASes (or None)
+        """
+        return {ip: self.lookup(ip) for ip in set(ips)}
+
+    def resolve_hops(self, responses):
+        """
+        Resolve the addresses of all hops of raw RIPE Atlas traceroute results in one batch.
+
+        :param responses: list of Atlas traceroute results
+        :return: dictionary of hop IP address to origin ASes (or None)
+        """
+        return self.lookup_many(traceroute_hop_ips(responses))
+
+    def nodes(self):
+        return sum(len(trie) for trie in self.tries.values())
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Load a CAIDA RouteViews pfx2as file (`prefix<TAB>length<TAB>origins` per line), where multiple origins are
+        separated by "_" and AS sets by ",".
+
+        :param path: local path or any URL supported by wandio
+        :return: Pfx2AsTrie
+        """
+        import wandio
+
+        trie = cls()
+        for line in wandio.open(path):
+            entry = parse_pfx2as_line(line)
+            if entry is not None:
+                trie.insert(*entry)
+        logging.info("loaded {} prefixes from {} into {} trie nodes".format(trie.prefixes, path, trie.nodes()))
+        return trie
+
+
+def parse_pfx2as_line(line):
+    """
+    Parse a line of a CAIDA RouteViews pfx2as file.
+
+    :param line: `prefix<TAB>length<TAB>origins` line, e.g. "192.0.2.0\t24\t64496_64497,64498"
+    :return: (prefix, list of origin AS numbers as strings) tuple, or None for blank and comment lines
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    address, length, origins = line.split("\t")
+    return "{}/{}".format(address, length), [asn for moas in origins.split("_") for asn in moas.split(",")]
+
+
+def traceroute_hop_ips(responses):
+    """
+    Collect the addresses of all replying hops of raw RIPE Atlas traceroute results, including the destinations.
+
+    :param responses: list of Atlas traceroute results
+    :return: set of IP addresses
+    """
+    ips = set()
+    for response in responses:
+        if response.get("dst_addr"):
+            ips.add(response["dst_addr"])
+        for hop in response.get("result") or []:
+            for reply in hop.get("result") or []:
+                if reply.get("from"):
+                    ips.add(reply["from"])
+    return ips
+
+
+class Pfx2AsSnapshotDB:
+    """
+    Pfx2AsSnapshotDB adapts a `Pfx2AsTrie` to the interface of the Redis-backed `Pfx2AsHistorical`, so it can be
+    passed as `pfx_origin_db` to `extract_atlas_response`, which resolves hops with `pfx_origin_db.lookup(ip, ...)`.
+
+    The snapshot covers the day of the measurement, so the timestamp arguments of `lookup` are ignored. All hops of a
+    measurement are resolved in one batch by `preload`, and `lookup` then serves them from the resolved addresses.
+    """
+
+    def __init__(self, trie, responses=None):
+        self.trie = trie
+        self.resolved = {}
+        if responses is not None:
+            self.preload(responses)
+
+    def preload(self, responses):
+        """
+        Resolve all hop addresses of raw Atlas traceroute results at once.
+        """
+        self.resolved = self.trie.resolve_hops(responses)
+
+    def lookup(self, ip, *args, **kwargs):
+        """
+        Get the origin ASes of the longest prefix covering an IP address.
+
+        :param ip: IP address as a string
+        :return: list of origin AS numbers as strings, or None if the address is invalid or not covered
+        """
+        if ip in self.resolved:
+            return self.resolved[ip]
+        return self.trie.lookup(ip)
+
+
+class DailyPfx2AsTries:
+    """
+    DailyPfx2AsTries loads the pfx2as snapshot of the day of a timestamp on demand, keeping the most recently used
+    days in memory.
+    """
+
+    def __init__(self, path_format, max_days=2):
+        """
+        :param path_format: strftime pattern of the daily pfx2as files, e.g.
+            "/data/routeviews-prefix2as/%Y/%m/routeviews-rv2-%Y%m%d-1200.pfx2as.gz"
+        :param max_days: number of daily snapshots to keep in memory
+        """
+        self.path_format = path_format
+        self.max_days = max_days
+        self.days = OrderedDict()
+
+    def for_ts(self, ts):
+        day = datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d")
+        trie = self.days.get(day)
+        if trie is None:
+            trie = Pfx2AsTrie.from_file(datetime.utcfromtimestamp(ts).strftime(self.path_format))
+            self.days[day] = trie
+            while len(self.days) > self.max_days:
+                self.days.popitem(last=False)
+        else:
+            self.days.move_to_end(day)
+        return trie
@@ -0,0 +1,194 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Local manifest of objects in Swift containers, refreshed incrementally
+"""
+
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from swiftclient.service import SwiftService
+
+DEFAULT_MANIFEST = "/tmp/grip-swift-manifest.sqlite"
+# consumer files are archived under `year=%Y/month=%m/day=%d/hour=%H/` paths
+DAY_PREFIX = "year=%Y/month=%m/day=%d/"
+# a day is considered complete (no more uploads expected) once it has been over for this long
+COMPLETE_DELAY = 86400
+
+
+def consumer_file_ts(name):
+    """
+    Extract timestamp from a consumer file name,
+    e.g. year=2020/month=01/day=01/hour=00/moas.1577836800.events.gz
+    """
+    return int(name.split("/")[4].split('.')[1])
+
+
+class SwiftManifest:
+    """
+    SwiftManifest caches the listing (object name, timestamp, size, etag) of Swift containers in a local SQLite file.
+
+    Listing a time range only fetches the day prefixes of that range that are not known to be complete yet, and each
+    listing continues after the last object name already in the manifest. Objects added to complete days later on, e.g.
+    consumer rerun output, or rewritten objects are only picked up by a full listing.
+    """
+
+    def __init__(self, path=DEFAULT_MANIFEST, swift_service=None):
+        if swift_service is None:
+            swift_service = SwiftService({
+                "auth_version": '3',
+                "os_username": os.environ.get('OS_USERNAME', None),
+                "os_password": os.environ.get('OS_PASSWORD', None),
+                "os_project_name": os.environ.get('OS_PROJECT_NAME', None),
+                "os_auth_url": os.environ.get('OS_AUTH_URL', None),
+            })
+        self.swift_service = swift_service
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS objects ("
+                              "container TEXT, name TEXT, ts INTEGER, size INTEGER, etag TEXT, "
+                              "PRIMARY KEY (container, name))")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS objects_ts ON objects (container, ts)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS prefixes ("
+                              "container TEXT, prefix TEXT, complete INTEGER, PRIMARY KEY (container, prefix))")
+
+    def _last_name(self, container, prefix):
+        row = self.conn.execute("SELECT MAX(name) FROM objects WHERE container = ? AND name >= ? AND name < ?",
+                                (container, prefix, prefix + "\uffff")).fetchone()
+        return row[0]
+
+    def _refresh_prefix(self, container, prefix, parse_ts, complete, full=False):
+        options = {"prefix": prefix}
+        marker = None if full else self._last_name(container, prefix)
+        if marker:
+            options["marker"] = marker
+
+        rows = []
+        for page in self.swift_service.list(container=container, options=options):
+            if not page["success"]:
+                raise page["error"]
+            for obj in page["listing"]:
+                try:
+                    ts = parse_ts(obj["name"])
+                except (IndexError, ValueError):
+                    logging.warning("cannot extract timestamp from {}/{}".format(container, obj["name"]))
+                    continue
+                rows.append((container, obj["name"], ts, obj["bytes"], obj["hash"]))
+
+        with self.conn:
+            if full:
+                # forget deleted objects and pick up the etags of rewritten ones
+                self.conn.execute("DELETE FROM objects WHERE container = ? AND name >= ? AND name < ?",
+                                  (container, prefix, prefix + "\uffff"))
+            self.conn.executemany("INSERT OR REPLACE INTO objects (container, name, ts, size, etag) "
+                                  "VALUES (?, ?, ?, ?, ?)", rows)
+            self.conn.execute("INSERT OR REPLACE INTO prefixes (container, prefix, complete) VALUES (?, ?, ?)",
+                              (container, prefix, int(complete)))
+        return len(rows)
+
+    def add_object(self, container, name, ts, size, etag):
+        """
+        Record an object uploaded by this host, so that it is known even if its day prefix is already complete.
+        """
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO objects (container, name, ts, size, etag) VALUES (?, ?, ?, ?, ?)",
+                              (container, name, ts, size, etag))
+
+    def _prefix_complete(self, container, prefix):
+        row = self.conn.execute("SELECT complete FROM prefixes WHERE container = ? AND prefix = ?",
+                                (container, prefix)).fetchone()
+        return row is not None and bool(row[0])
+
+    def refresh(self, container, start_ts=None, end_ts=None, parse_ts=consumer_file_ts, prefix_format=DAY_PREFIX,
+                full=False):
+        """
+        Bring the manifest of the container up to date for the given time range.
+
+        :param container: Swift container name
+        :param start_ts: start of the time range, list the whole container if not specified
+        :param end_ts: end of the time range, default to now
+        :param parse_ts: function extracting the timestamp from an object name
+        :param prefix_format: strftime format of per-day object name prefixes, None to list the whole container
+        :param full: list all objects again instead of only the ones after the last known object
+        """
+        now = int(time.time())
+        if prefix_format is None or start_ts is None:
+            added = self._refresh_prefix(container, "", parse_ts, complete=False, full=full)
+            logging.info("listed {}: {} new objects".format(container, added))
+            return
+
+        end_ts = min(end_ts or now, now)
+        added = 0
+        day = datetime.utcfromtimestamp(start_ts).replace(hour=0, minute=0, second=0, microsecond=0)
+        while day <= datetime.utcfromtimestamp(end_ts):
+            prefix = day.strftime(prefix_format)
+            day_end = int((day + timedelta(days=1) - datetime(1970, 1, 1)).total_seconds())
+            if full or not self._prefix_complete(container, prefix):
+                added += self._refresh_prefix(container, prefix, parse_ts, complete=day_end + COMPLETE_DELAY < now,
+                                              full=full)
+            day += timedelta(days=1)
+        logging.info("listed {} from {} to {}: {} new objects".format(container, start_ts, end_ts, added))
+
+    def list_entries(self, container, start_ts=None, end_ts=None, parse_ts=consumer_file_ts, prefix_format=DAY_PREFIX,
+                     full=False):
+        """
+        List objects of the container within [start_ts, end_ts], ordered by name.
+
+        :return: list of (object name, timestamp, size, etag) tuples
+        """
+        self.refresh(container, start_ts, end_ts, parse_ts=parse_ts, prefix_format=prefix_format, full=full)
+        query = "SELECT name, ts, size, etag FROM objects WHERE container = ?"
+        params = [container]
+        if start_ts is not None:
+            query += " AND ts >= ?"
+            params.append(start_ts)
+        if end_ts is not None:
+            query += " AND ts <= ?"
+            params.append(end_ts)
+        query += " ORDER BY name"
+        return self.conn.execute(query, params).fetchall()
+
+    def list_objects(self, container, start_ts=None, end_ts=None, parse_ts=consumer_file_ts, prefix_format=DAY_PREFIX,
+                     full=False):
+        """
+        List objects of the container within [start_ts, end_ts], ordered by name.
+
+        :return: list of (object name, timestamp) tuples
+        """
+        return [(name, ts) for name, ts, _, _ in
+                self.list_entries(container, start_ts, end_ts, parse_ts=parse_ts, prefix_format=prefix_format,
+                                  full=full)]
@@ -0,0 +1,123 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Least-recently-used cache of taggers prepared for specific views
+"""
+
+import logging
+import resource
+from collections import OrderedDict
+
+
+def current_rss():
+    """
+    Current resident memory of this process in bytes, 0 if not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class TaggerViewCache:
+    """
+    Keep taggers prepared for the K most recently used views.
+
+    Preparing a tagger for a view (`update_datasets` and `methodology.prepare_for_view`) reloads the datasets of that
+    view. Batch tools that see events in random view order therefore reload the same handful of views over and over.
+    This cache keeps up to `max_views` tagger instances, each prepared for one view, and recycles the least recently used
+    instance when the cache is full or the process exceeds `memory_budget` bytes of resident memory.
+
+    With `max_views` set to 1, the cache behaves like a single tagger that is re-prepared whenever the view changes.
+    """
+
+    def __init__(self, tagger_factory, max_views=1, memory_budget=None):
+        """
+        :param tagger_factory: callable creating a new tagger instance
+        :param max_views: maximum number of views to keep prepared taggers for
+        :param memory_budget: maximum resident memory in bytes before recycling instead of creating taggers
+        """
+        assert max_views >= 1
+        self.tagger_factory = tagger_factory
+        self.max_views = max_views
+        self.memory_budget = memory_budget
+        self.taggers = OrderedDict()
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, view_ts):
+        """
+        Retrieve a tagger prepared for the given view.
+
+        :param view_ts: view timestamp
+        :return: tagger instance ready to tag events of the view
+        """
+        if view_ts in self.taggers:
+            self.hits += 1
+            self.taggers.move_to_end(view_ts)
+            return self.taggers[view_ts]
+
+        self.misses += 1
+        tagger = self._acquire()
+        tagger.update_datasets(view_ts)  # NOTE: only edges run special function to update dataset
+        tagger.methodology.prepare_for_view(view_ts)
+        self.taggers[view_ts] = tagger
+        return tagger
+
+    def _over_budget(self):
+        return self.memory_budget and current_rss() > self.memory_budget
+
+    def _acquire(self):
+        if not self.taggers or (len(self.taggers) < self.max_views and not self._over_budget()):
+            return self.tagger_factory()
+        # recycle the least recently used tagger
+        _, tagger = self.taggers.popitem(last=False)
+        self.evictions += 1
+        return tagger
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "views": len(self.taggers),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / total if total else 0.0,
+        }
+
+    def log_stats(self, prefix=""):
+        logging.info("{}view cache: {}".format(prefix, self.stats()))
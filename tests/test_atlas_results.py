@@ -0,0 +1,131 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Tests of the Atlas results fetcher against a local HTTP stand-in for the Atlas API
+"""
+import json
+import re
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from scripts.utils.atlas_results import AtlasResultsFetcher
+
+RESULTS = [{"prb_id": 1, "dst_addr": "192.0.2.1", "result": []}]
+
+
+class AtlasStandIn(BaseHTTPRequestHandler):
+    # measurement id to status id, 2 is ongoing and 4 is stopped
+    statuses = {}
+    # number of requests to fail with 503 before answering
+    failures = 0
+    requests = []
+
+    def do_GET(self):
+        AtlasStandIn.requests.append(self.path)
+        if AtlasStandIn.failures > 0:
+            AtlasStandIn.failures -= 1
+            self.send_error(503)
+            return
+        match = re.match(r"^/api/v2/measurements/(\d+)/(results/)?", self.path)
+        if not match or int(match.group(1)) not in self.statuses:
+            self.send_error(404)
+            return
+        if match.group(2):
+            body = RESULTS
+        else:
+            body = {"id": int(match.group(1)), "status": {"id": self.statuses[int(match.group(1))]}}
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class AtlasResultsFetcherTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), AtlasStandIn)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = "http://127.0.0.1:{}".format(cls.server.server_address[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        AtlasStandIn.statuses = {100: 4, 200: 2}
+        AtlasStandIn.failures = 0
+        AtlasStandIn.requests = []
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.fetcher = AtlasResultsFetcher(cache_dir=self.cache_dir.name, rate=0, base_url=self.base_url,
+                                           max_retries=2, backoff=0)
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def test_stopped_measurement_is_served_from_cache(self):
+        self.assertEqual(self.fetcher.fetch(100), (True, RESULTS))
+        self.assertEqual(len(AtlasStandIn.requests), 2)
+        self.assertEqual(self.fetcher.fetch(100), (True, RESULTS))
+        self.assertEqual(len(AtlasStandIn.requests), 2)
+
+    def test_running_measurement_is_not_cached(self):
+        self.assertEqual(self.fetcher.fetch(200), (True, RESULTS))
+        self.assertEqual(self.fetcher.fetch(200), (True, RESULTS))
+        self.assertEqual(len(AtlasStandIn.requests), 4)
+
+    def test_failed_requests_are_retried(self):
+        AtlasStandIn.failures = 2
+        self.assertEqual(self.fetcher.fetch(100), (True, RESULTS))
+        self.assertEqual(len(AtlasStandIn.requests), 4)
+
+    def test_gives_up_after_retries(self):
+        is_success, _ = self.fetcher.fetch(300)
+        self.assertFalse(is_success)
+        self.assertEqual(len(AtlasStandIn.requests), 3)
+
+    def test_fetch_many(self):
+        results = self.fetcher.fetch_many([100, 200, 100])
+        self.assertEqual(results, {100: (True, RESULTS), 200: (True, RESULTS)})
+
+
+if __name__ == "__main__":
+    unittest.main()
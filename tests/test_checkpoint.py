@@ -0,0 +1,125 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Tests of the checkpoint journal of long-running batch jobs
+"""
+import argparse
+import os
+import tempfile
+import unittest
+
+from scripts.utils.checkpoint import Checkpoint, run_hash
+
+
+def make_opts(**kwargs):
+    params = dict(type="moas", start=0, end=3600, resume=False, checkpoint_dir="/tmp", refresh_manifest=False)
+    params.update(kwargs)
+    return argparse.Namespace(**params)
+
+
+class RunHashTest(unittest.TestCase):
+
+    def test_same_parameters_same_hash(self):
+        self.assertEqual(run_hash(make_opts()), run_hash(make_opts()))
+
+    def test_work_parameters_change_hash(self):
+        self.assertNotEqual(run_hash(make_opts()), run_hash(make_opts(end=7200)))
+
+    def test_ignored_options_do_not_change_hash(self):
+        self.assertEqual(run_hash(make_opts()),
+                         run_hash(make_opts(resume=True, checkpoint_dir="/var/tmp", refresh_manifest=True)))
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def open(self, resume, **kwargs):
+        checkpoint = Checkpoint.for_run("backfill", make_opts(**kwargs), directory=self.tmpdir.name, resume=resume)
+        self.addCleanup(checkpoint.close)
+        return checkpoint
+
+    def test_progress(self):
+        checkpoint = self.open(resume=False)
+        partition = Checkpoint.partition_name(0, 1800)
+        self.assertEqual(checkpoint.get_progress(partition), (None, False))
+        checkpoint.update(partition, [1500, "moas-1500-1"])
+        self.assertEqual(checkpoint.get_progress(partition), ([1500, "moas-1500-1"], False))
+        checkpoint.finish(partition)
+        self.assertEqual(checkpoint.get_progress(partition), ([1500, "moas-1500-1"], True))
+        other = Checkpoint.partition_name(1800, 3600)
+        checkpoint.finish(other)
+        self.assertEqual(checkpoint.get_progress(other), (None, True))
+
+    def test_resume_keeps_plan_and_progress(self):
+        checkpoint = self.open(resume=False)
+        self.assertIsNone(checkpoint.get_plan())
+        checkpoint.save_plan([(0, 1800), (1800, 3600)])
+        checkpoint.update("0-1800", 900)
+        checkpoint.finish("1800-3600")
+        checkpoint.close()
+
+        # worker processes open the same journal by path
+        worker = Checkpoint(checkpoint.path)
+        self.addCleanup(worker.close)
+        self.assertEqual(worker.get_progress("0-1800"), (900, False))
+
+        resumed = self.open(resume=True)
+        self.assertEqual(resumed.path, checkpoint.path)
+        self.assertEqual(resumed.get_plan(), [(0, 1800), (1800, 3600)])
+        self.assertEqual(resumed.get_progress("0-1800"), (900, False))
+        self.assertEqual(resumed.get_progress("1800-3600"), (None, True))
+
+    def test_without_resume_starts_over(self):
+        checkpoint = self.open(resume=False)
+        checkpoint.save_plan([(0, 3600)])
+        checkpoint.finish("0-3600")
+        checkpoint.close()
+
+        restarted = self.open(resume=False)
+        self.assertIsNone(restarted.get_plan())
+        self.assertEqual(restarted.get_progress("0-3600"), (None, False))
+
+    def test_other_parameters_use_another_journal(self):
+        checkpoint = self.open(resume=False)
+        checkpoint.save_plan([(0, 3600)])
+        other = self.open(resume=True, end=7200)
+        self.assertNotEqual(other.path, checkpoint.path)
+        self.assertIsNone(other.get_plan())
+        self.assertTrue(os.path.exists(checkpoint.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,170 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Tests of the buffered bulk indexer against a scripted stand-in for the `_bulk` API
+"""
+import importlib.util
+import json
+import unittest
+from unittest import mock
+
+HAS_DEPS = all(importlib.util.find_spec(module) for module in ("bgphijacks", "elasticsearch"))
+if HAS_DEPS:
+    from elasticsearch.exceptions import TransportError
+
+    from scripts.utils.elastic_bulk import BulkIndexer
+
+
+class FakeEs:
+    """
+    `_bulk` endpoint rejecting requests larger than `max_docs` with 413, the first `rejections` requests with 429, and
+    answering items by document id from `item_statuses` (a list of statuses per id, consumed one per attempt).
+    """
+
+    def __init__(self, max_docs=None, rejections=0, item_statuses=None):
+        self.max_docs = max_docs
+        self.rejections = rejections
+        self.item_statuses = item_statuses or {}
+        self.requests = []
+        self.indexed = []
+
+    def bulk(self, body):
+        lines = body.splitlines()
+        doc_ids = [json.loads(action)["index"]["_id"] for action in lines[::2]]
+        self.requests.append(doc_ids)
+        if self.max_docs is not None and len(doc_ids) > self.max_docs:
+            raise TransportError(413, "request entity too large", {})
+        if self.rejections > 0:
+            self.rejections -= 1
+            raise TransportError(429, "es_rejected_execution_exception", {})
+        items = []
+        for doc_id in doc_ids:
+            statuses = self.item_statuses.get(doc_id)
+            status = statuses.pop(0) if statuses else 201
+            if status < 300:
+                self.indexed.append(doc_id)
+            items.append({"index": {"_id": doc_id, "status": status, "error": None if status < 300 else "error"}})
+        return {"errors": any(item["index"]["status"] >= 300 for item in items), "items": items}
+
+
+class FakeElasticConn:
+
+    def __init__(self, es):
+        self.es = es
+
+
+@unittest.skipUnless(HAS_DEPS, "grip-core and elasticsearch are required")
+class BulkIndexerTest(unittest.TestCase):
+
+    def indexer(self, es, **kwargs):
+        params = dict(max_docs=100, max_bytes=10 * 1024 * 1024, max_age=10, max_retries=3, backoff=0)
+        params.update(kwargs)
+        return BulkIndexer(es_conn=FakeElasticConn(es), **params)
+
+    @staticmethod
+    def add(indexer, count, start=0):
+        for i in range(start, start + count):
+            indexer.add("observatory-events-moas-2020.01.01", "event-{}".format(i), {"id": "event-{}".format(i)})
+
+    def test_flush_by_count(self):
+        es = FakeEs()
+        indexer = self.indexer(es, max_docs=3)
+        self.add(indexer, 5)
+        self.assertEqual(es.requests, [["event-0", "event-1", "event-2"]])
+        indexer.close()
+        self.assertEqual(es.requests[1], ["event-3", "event-4"])
+        self.assertEqual(indexer.indexed, 5)
+
+    def test_flush_by_size(self):
+        es = FakeEs()
+        indexer = self.indexer(es, max_bytes=1)
+        self.add(indexer, 2)
+        self.assertEqual(es.requests, [["event-0"], ["event-1"]])
+
+    def test_flush_by_age(self):
+        es = FakeEs()
+        indexer = self.indexer(es, max_age=10)
+        with mock.patch("scripts.utils.elastic_bulk.time.time", return_value=1000):
+            self.add(indexer, 1)
+        with mock.patch("scripts.utils.elastic_bulk.time.time", return_value=1005):
+            indexer.flush_if_stale()
+            self.assertEqual(es.requests, [])
+        with mock.patch("scripts.utils.elastic_bulk.time.time", return_value=1010):
+            indexer.flush_if_stale()
+        self.assertEqual(es.requests, [["event-0"]])
+
+    def test_too_large_batches_are_split(self):
+        es = FakeEs(max_docs=2)
+        with self.indexer(es) as indexer:
+            self.add(indexer, 5)
+        self.assertEqual(sorted(es.indexed), ["event-{}".format(i) for i in range(5)])
+        self.assertEqual([len(request) for request in es.requests], [5, 2, 3, 1, 2])
+        self.assertEqual(indexer.indexed, 5)
+        self.assertEqual(indexer.failures, [])
+
+    def test_too_large_document_is_recorded(self):
+        es = FakeEs(max_docs=0)
+        with self.indexer(es) as indexer:
+            self.add(indexer, 2)
+        self.assertEqual(indexer.indexed, 0)
+        self.assertEqual([(doc_id, status) for _, doc_id, status, _ in indexer.failures],
+                         [("event-0", 413), ("event-1", 413)])
+
+    def test_rejected_requests_are_retried(self):
+        es = FakeEs(rejections=2)
+        with self.indexer(es) as indexer:
+            self.add(indexer, 3)
+        self.assertEqual(len(es.requests), 3)
+        self.assertEqual(indexer.indexed, 3)
+        self.assertEqual(indexer.retried, 6)
+
+    def test_rejected_requests_give_up_after_max_retries(self):
+        es = FakeEs(rejections=10)
+        indexer = self.indexer(es, max_retries=2)
+        self.add(indexer, 1)
+        with self.assertRaises(TransportError):
+            indexer.flush()
+        self.assertEqual(len(es.requests), 3)
+
+    def test_rejected_items_are_retried_alone(self):
+        es = FakeEs(item_statuses={"event-1": [429, 429], "event-2": [400]})
+        with self.indexer(es) as indexer:
+            self.add(indexer, 3)
+        self.assertEqual(es.requests, [["event-0", "event-1", "event-2"], ["event-1"], ["event-1"]])
+        self.assertEqual(indexer.indexed, 2)
+        self.assertEqual(indexer.retried, 2)
+        self.assertEqual([(doc_id, status) for _, doc_id, status, _ in indexer.failures], [("event-2", 400)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Tests of the aggregation bodies and result parsing of EventAggregator against canned ElasticSearch responses
+"""
+import unittest
+
+from scripts.utils.event_aggregations import EventAggregator, format_rows
+
+
+class FakeEs:
+
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+
+    def search(self, index, body):
+        self.requests.append((index, body))
+        return self.response
+
+
+class FakeElasticConn:
+
+    def __init__(self, response):
+        self.es = FakeEs(response)
+
+
+def aggregator(aggregations, total=10):
+    return EventAggregator(FakeElasticConn({"hits": {"total": {"value": total}}, "aggregations": aggregations}))
+
+
+class EventAggregatorTest(unittest.TestCase):
+
+    def test_percentiles_of_script_grouped(self):
+        agg = aggregator({"groups": {"buckets": [
+            {"key": "moas", "doc_count": 7, "metric": {"values": {"50.0": 2.0, "99.0": 5.0}}},
+            {"key": "edges", "doc_count": 3, "metric": {"values": {"50.0": 1.0, "99.0": 1.0}}},
+        ]}})
+        rows = agg.percentiles(script="doc['summary.ases'].size()", percents=(50, 99), group_by="event_type",
+                               index="observatory-events-*", query={"match_all": {}})
+        index, body = agg.esconn.es.requests[0]
+        self.assertEqual(index, "observatory-events-*")
+        self.assertEqual(body, {
+            "size": 0,
+            "track_total_hits": True,
+            "query": {"match_all": {}},
+            "aggs": {"groups": {
+                "terms": {"field": "event_type", "size": 10000},
+                "aggs": {"metric": {"percentiles": {
+                    "script": {"lang": "painless", "source": "doc['summary.ases'].size()"},
+                    "percents": [50, 99],
+                }}},
+            }},
+        })
+        self.assertEqual(rows, [
+            {"event_type": "moas", "events": 7, "percentile": 50, "value": 2.0},
+            {"event_type": "moas", "events": 7, "percentile": 99, "value": 5.0},
+            {"event_type": "edges", "events": 3, "percentile": 50, "value": 1.0},
+            {"event_type": "edges", "events": 3, "percentile": 99, "value": 1.0},
+        ])
+
+    def test_cardinality_of_field(self):
+        agg = aggregator({"metric": {"value": 42}}, total=100)
+        rows = agg.cardinality(field="summary.ases")
+        _, body = agg.esconn.es.requests[0]
+        self.assertNotIn("query", body)
+        self.assertEqual(body["aggs"], {"metric": {"cardinality": {"field": "summary.ases"}}})
+        self.assertEqual(rows, [{"events": 100, "cardinality": 42}])
+
+    def test_metric_requires_field_or_script(self):
+        with self.assertRaises(AssertionError):
+            aggregator({}).cardinality()
+
+    def test_terms(self):
+        agg = aggregator({"terms": {"buckets": [{"key": "tag-a", "doc_count": 5}, {"key": "tag-b", "doc_count": 2}]}})
+        rows = agg.terms("tags", size=2)
+        _, body = agg.esconn.es.requests[0]
+        self.assertEqual(body["aggs"], {"terms": {"terms": {"field": "tags", "size": 2}}})
+        self.assertEqual(rows, [{"tags": "tag-a", "count": 5}, {"tags": "tag-b", "count": 2}])
+
+    def test_date_histogram_split(self):
+        agg = aggregator({"histogram": {"buckets": [
+            {"key": 1577836800000, "doc_count": 3, "split": {"buckets": [{"key": "tag-a", "doc_count": 3}]}},
+            {"key": 1577923200000, "doc_count": 1, "split": {"buckets": [{"key": "tag-b", "doc_count": 1}]}},
+        ]}})
+        rows = agg.date_histogram(interval="1d", split_by="tags", split_size=5)
+        _, body = agg.esconn.es.requests[0]
+        self.assertEqual(body["aggs"], {"histogram": {
+            "date_histogram": {"field": "view_ts", "fixed_interval": "1d", "min_doc_count": 1},
+            "aggs": {"split": {"terms": {"field": "tags", "size": 5}}},
+        }})
+        self.assertEqual(rows, [
+            {"time": 1577836800, "tags": "tag-a", "count": 3},
+            {"time": 1577923200, "tags": "tag-b", "count": 1},
+        ])
+
+    def test_date_histogram(self):
+        agg = aggregator({"histogram": {"buckets": [{"key": 1577836800000, "doc_count": 3}]}})
+        self.assertEqual(agg.date_histogram(interval="1h"), [{"time": 1577836800, "count": 3}])
+
+    def test_format_rows(self):
+        self.assertEqual(format_rows([{"tags": "tag-a", "count": 5}, {"tags": "tag-b", "count": 2}]),
+                         ["tags\tcount", "tag-a\t5", "tag-b\t2"])
+        self.assertEqual(format_rows([]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,135 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Tests of the incremental refresh of the local event archive
+"""
+import importlib.util
+import tempfile
+import unittest
+
+HAS_NUMPY = importlib.util.find_spec("numpy") is not None
+if HAS_NUMPY:
+    from scripts.utils.event_archive import EventArchive
+
+INDEX = "observatory-events-moas-2020.01.01"
+
+
+def make_event(event_id, last_modified_ts, n_tags=1):
+    return {
+        "id": event_id,
+        "event_type": "moas",
+        "view_ts": 1577836800,
+        "last_modified_ts": last_modified_ts,
+        "summary": {
+            "ases": ["64496", "64497"],
+            "prefixes": ["192.0.2.0/24"],
+            "tags": ["tag"] * n_tags,
+            "inference_result": {"primary_inference": {"suspicion_level": 0}},
+        },
+    }
+
+
+class FakeIndices:
+
+    def get_alias(self, index, expand_wildcards):
+        return {INDEX: {}}
+
+
+class FakeEs:
+    indices = FakeIndices()
+
+
+class FakeElasticConn:
+    """
+    Stand-in for ElasticConn serving the events of one daily index, applying the last_modified_ts range filter.
+    """
+
+    def __init__(self, events):
+        self.es = FakeEs()
+        self.events = events
+        self.queries = []
+
+    def search_generator(self, index, query, raw_json):
+        self.queries.append(query)
+        bounds = query.get("query", {}).get("range", {}).get("last_modified_ts", {})
+        for event in self.events.values():
+            ts = event["last_modified_ts"]
+            if "gt" in bounds and not ts > bounds["gt"]:
+                continue
+            if "gte" in bounds and not ts >= bounds["gte"]:
+                continue
+            yield dict(event)
+
+
+@unittest.skipUnless(HAS_NUMPY, "numpy is required")
+class EventArchiveRefreshTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.archive = EventArchive(self.tmpdir.name)
+        self.es_conn = FakeElasticConn({
+            "moas-1577836800-1": make_event("moas-1577836800-1", 100),
+            "moas-1577836800-2": make_event("moas-1577836800-2", 200),
+        })
+
+    def tags(self):
+        frame = self.archive.load()
+        return dict(zip(frame["event_id"].tolist(), frame["n_tags"].tolist()))
+
+    def test_first_refresh(self):
+        self.assertEqual(self.archive.refresh(self.es_conn), 2)
+        self.assertNotIn("query", self.es_conn.queries[0])
+        self.assertEqual(self.tags(), {"moas-1577836800-1": 1, "moas-1577836800-2": 1})
+
+    def test_modified_event_replaces_archived_row(self):
+        self.archive.refresh(self.es_conn)
+        self.es_conn.events["moas-1577836800-1"] = make_event("moas-1577836800-1", 300, n_tags=3)
+        self.assertEqual(self.archive.refresh(self.es_conn), 1)
+        self.assertEqual(self.tags(), {"moas-1577836800-1": 3, "moas-1577836800-2": 1})
+        self.assertEqual(len(self.archive.load()), 2)
+
+    def test_modification_in_watermark_second(self):
+        self.archive.refresh(self.es_conn)
+        # modified after the last refresh, but within the second of the newest archived event
+        self.es_conn.events["moas-1577836800-1"] = make_event("moas-1577836800-1", 200, n_tags=2)
+        self.assertEqual(self.archive.refresh(self.es_conn), 1)
+        self.assertEqual(self.tags(), {"moas-1577836800-1": 2, "moas-1577836800-2": 1})
+
+    def test_unchanged_events_are_not_fetched_again(self):
+        self.archive.refresh(self.es_conn)
+        self.assertEqual(self.archive.refresh(self.es_conn), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
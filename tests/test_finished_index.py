@@ -0,0 +1,157 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Tests of the finished-lines sidecar index with an in-memory stand-in for swift
+"""
+import importlib.util
+import io
+import os
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+HAS_DEPS = all(importlib.util.find_spec(module) for module in ("wandio", "swiftclient"))
+if HAS_DEPS:
+    from scripts.utils.finished_index import FinishedLinesIndex
+    from scripts.utils.swift_manifest import SwiftManifest
+
+CONSUMER_FILE = "year=2020/month=01/day=01/hour=00/moas.1577836800.events.gz"
+CONSUMER_LINES = [
+    "# header\n",
+    "1577836800|10.0.0.0/8|NEW|...\n",
+    "1577836800|10.0.0.0/8|FINISHED|...\n",
+]
+
+
+class FakeSwiftService:
+    """
+    Swift listing service serving fixed object listings per container.
+    """
+
+    def __init__(self, listings):
+        self.listings = listings
+
+    def list(self, container, options):
+        yield {"success": True, "listing": [obj for obj in self.listings.get(container, [])
+                                            if obj["name"].startswith(options["prefix"])
+                                            and obj["name"] > options.get("marker", "")]}
+
+
+class FakeObjectStore:
+    """
+    In-memory replacement of wandio.open for swift:// URLs.
+    """
+
+    def __init__(self, objects):
+        self.objects = dict(objects)
+        self.reads = []
+
+    def open(self, url, mode="r"):
+        if mode == "w":
+            store = self
+
+            class Writer(io.StringIO):
+                def close(self):
+                    store.objects[url] = self.getvalue()
+                    super().close()
+
+            return Writer()
+        self.reads.append(url)
+        return io.StringIO(self.objects[url])
+
+
+@unittest.skipUnless(HAS_DEPS, "wandio and swiftclient are required")
+class FinishedLinesIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        source = {"name": CONSUMER_FILE, "bytes": 100, "hash": "etag-1"}
+        self.manifest = SwiftManifest(os.path.join(self.tmpdir.name, "manifest.sqlite"),
+                                      swift_service=FakeSwiftService({"bgp-hijacks-moas": [source]}))
+        self.store = FakeObjectStore({"swift://bgp-hijacks-moas/" + CONSUMER_FILE: "".join(CONSUMER_LINES)})
+        patcher = mock.patch("scripts.utils.finished_index.wandio.open", self.store.open)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def test_sidecar_built_on_worker_thread_is_recorded(self):
+        index = FinishedLinesIndex("moas", self.manifest)
+        index.refresh(1577836800, 1577840400)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            lines = executor.submit(index.finished_lines, CONSUMER_FILE).result()
+        self.assertEqual(lines, ["1577836800|10.0.0.0/8|FINISHED|..."])
+        self.assertIn("swift://bgp-hijacks-moas-finished/" + CONSUMER_FILE, self.store.objects)
+
+        index.record_uploaded()
+        self.assertEqual(index.known, {CONSUMER_FILE})
+        self.assertEqual([name for name, _ in self.manifest.list_objects("bgp-hijacks-moas-finished",
+                                                                         1577836800, 1577840400)],
+                         [CONSUMER_FILE])
+
+        # a later run reads the sidecar instead of the consumer file
+        index = FinishedLinesIndex("moas", self.manifest)
+        index.refresh(1577836800, 1577840400)
+        self.store.reads.clear()
+        self.assertEqual(index.finished_lines(CONSUMER_FILE), ["1577836800|10.0.0.0/8|FINISHED|..."])
+        self.assertEqual(self.store.reads, ["swift://bgp-hijacks-moas-finished/" + CONSUMER_FILE])
+
+    def test_sidecar_of_rewritten_consumer_file_is_rebuilt(self):
+        index = FinishedLinesIndex("moas", self.manifest)
+        index.refresh(1577836800, 1577840400)
+        index.finished_lines(CONSUMER_FILE)
+        index.record_uploaded()
+
+        index.source_etags[CONSUMER_FILE] = "etag-2"
+        self.store.reads.clear()
+        index.finished_lines(CONSUMER_FILE)
+        self.assertIn("swift://bgp-hijacks-moas/" + CONSUMER_FILE, self.store.reads)
+
+    def test_failed_upload_is_not_recorded(self):
+        index = FinishedLinesIndex("moas", self.manifest)
+        index.refresh(1577836800, 1577840400)
+        read = self.store.open
+
+        def failing_open(url, mode="r"):
+            if mode == "w":
+                raise OSError("upload failed")
+            return read(url, mode)
+
+        with mock.patch("scripts.utils.finished_index.wandio.open", failing_open):
+            self.assertEqual(index.finished_lines(CONSUMER_FILE), ["1577836800|10.0.0.0/8|FINISHED|..."])
+        index.record_uploaded()
+        self.assertEqual(index.known, set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Tests of the event-density-balanced time partitioning
+"""
+import importlib.util
+import unittest
+
+HAS_GRIP = importlib.util.find_spec("bgphijacks") is not None
+if HAS_GRIP:
+    from scripts.utils.partitioner import VIEW_INTERVAL, balanced_time_chunks, even_time_chunks
+
+
+def assert_contiguous(test, ranges, start_ts, end_ts):
+    ranges = sorted(ranges)
+    test.assertEqual(ranges[0][0], start_ts)
+    test.assertEqual(ranges[-1][1], end_ts)
+    for (_, prev_end), (next_start, _) in zip(ranges, ranges[1:]):
+        test.assertEqual(prev_end, next_start)
+    for range_start, range_end in ranges:
+        test.assertLess(range_start, range_end)
+
+
+@unittest.skipUnless(HAS_GRIP, "grip-core is required")
+class EvenTimeChunksTest(unittest.TestCase):
+
+    def test_equal_width(self):
+        self.assertEqual(even_time_chunks(0, 3600, 4), [(0, 900), (900, 1800), (1800, 2700), (2700, 3600)])
+
+    def test_last_chunk_is_clipped(self):
+        ranges = even_time_chunks(0, 3700, 4)
+        self.assertEqual(len(ranges), 4)
+        assert_contiguous(self, ranges, 0, 3700)
+
+    def test_chunks_not_finer_than_views(self):
+        self.assertEqual(len(even_time_chunks(0, 2 * VIEW_INTERVAL, 10)), 2)
+        self.assertEqual(even_time_chunks(0, 60, 10), [(0, 60)])
+
+    def test_empty_range(self):
+        self.assertEqual(even_time_chunks(3600, 3600, 4), [])
+        self.assertEqual(even_time_chunks(3600, 0, 4), [])
+
+
+@unittest.skipUnless(HAS_GRIP, "grip-core is required")
+class BalancedTimeChunksTest(unittest.TestCase):
+
+    def test_equal_counts(self):
+        histogram = [(ts, 10) for ts in range(0, 3600, VIEW_INTERVAL)]
+        ranges = balanced_time_chunks(histogram, 0, 3600, 4)
+        self.assertEqual(len(ranges), 4)
+        assert_contiguous(self, ranges, 0, 3600)
+        for range_start, range_end in ranges:
+            self.assertEqual(sum(count for ts, count in histogram if range_start <= ts < range_end), 30)
+
+    def test_burst_is_never_split_and_comes_first(self):
+        histogram = [(0, 1), (300, 1), (600, 1000), (900, 1), (1200, 1)]
+        ranges = balanced_time_chunks(histogram, 0, 1500, 4)
+        # the chunk closes right after the bucket reaching its share, the rest of the range forms the next chunk
+        self.assertEqual(ranges, [(0, 900), (900, 1500)])
+
+    def test_cuts_before_next_non_empty_bucket(self):
+        histogram = [(0, 5), (1800, 5)]
+        self.assertEqual(sorted(balanced_time_chunks(histogram, 0, 3600, 2)), [(0, 1800), (1800, 3600)])
+
+    def test_empty_histogram_falls_back_to_even_chunks(self):
+        self.assertEqual(balanced_time_chunks([], 0, 3600, 4), even_time_chunks(0, 3600, 4))
+        self.assertEqual(balanced_time_chunks([(0, 0)], 0, 3600, 2), [(0, 1800), (1800, 3600)])
+
+    def test_empty_range(self):
+        self.assertEqual(balanced_time_chunks([], 3600, 3600, 4), [])
+        self.assertEqual(balanced_time_chunks([(3600, 5)], 3600, 3600, 4), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
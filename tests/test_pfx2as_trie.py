@@ -0,0 +1,144 @@
+#  This software is Copyright (c) 2015 The Regents of the University of
+#  California. All Rights Reserved. Permission to copy, modify, and distribute this
+#  software and its documentation for academic research and education purposes,
+#  without fee, and without a written agreement is hereby granted, provided that
+#  the above copyright notice, this paragraph and the following three paragraphs
+#  appear in all copies. Permission to make use of this software for other than
+#  academic research and education purposes may be obtained by contacting:
+#
+#  Office of Innovation and Commercialization
+#  9500 Gilman Drive, Mail Code 0910
+#  University of California
+#  La Jolla, CA 92093-0910
+#  (858) 534-5815
+#  invent@ucsd.edu
+#
+#  This software program and documentation are copyrighted by The Regents of the
+#  University of California. The software program and documentation are supplied
+#  "as is", without any accompanying services from The Regents. The Regents does
+#  not warrant that the operation of the program will be uninterrupted or
+#  error-free. The end-user understands that the program was developed for research
+#  purposes and is advised not to rely exclusively on the program for any reason.
+#
+#  IN NO EVENT SHALL THE UNIVERSITY OF CALIFORNIA BE LIABLE TO ANY PARTY FOR
+#  DIRECT, INDIRECT, SPECIAL, INCIDENTAL, OR CONSEQUENTIAL DAMAGES, INCLUDING LOST
+#  PROFITS, ARISING OUT OF THE USE OF THIS SOFTWARE AND ITS DOCUMENTATION, EVEN IF
+#  THE UNIVERSITY OF CALIFORNIA HAS BEEN ADVISED OF THE POSSIBILITY OF SUCH
+#  DAMAGE. THE UNIVERSITY OF CALIFORNIA SPECIFICALLY DISCLAIMS ANY WARRANTIES,
+#  INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+#  FITNESS FOR A PARTICULAR PURPOSE. THE SOFTWARE PROVIDED HEREUNDER IS ON AN "AS
+#  IS" BASIS, AND THE UNIVERSITY OF CALIFORNIA HAS NO OBLIGATIONS TO PROVIDE
+#  MAINTENANCE, SUPPORT, UPDATES, ENHANCEMENTS, OR MODIFICATIONS.
+
+"""
+Tests of the in-process pfx2as trie
+"""
+import unittest
+
+from scripts.utils.pfx2as_trie import Pfx2AsSnapshotDB, Pfx2AsTrie, _BitTrie, parse_pfx2as_line, \
+    traceroute_hop_ips
+
+
+class BitTrieTest(unittest.TestCase):
+
+    def test_longest_match(self):
+        trie = _BitTrie(8)
+        trie.insert(0b10000000, 1, 1)
+        trie.insert(0b10100000, 3, 2)
+        self.assertEqual(trie.lookup(0b10111111), 2)
+        self.assertEqual(trie.lookup(0b11000000), 1)
+        self.assertEqual(trie.lookup(0b01000000), -1)
+
+    def test_default_route(self):
+        trie = _BitTrie(8)
+        trie.insert(0, 0, 7)
+        trie.insert(0b11110000, 4, 3)
+        self.assertEqual(trie.lookup(0b00000001), 7)
+        self.assertEqual(trie.lookup(0b11111111), 3)
+
+    def test_host_route(self):
+        trie = _BitTrie(8)
+        trie.insert(0b00000101, 8, 4)
+        self.assertEqual(trie.lookup(0b00000101), 4)
+        self.assertEqual(trie.lookup(0b00000100), -1)
+
+
+class Pfx2AsTrieTest(unittest.TestCase):
+
+    def setUp(self):
+        self.trie = Pfx2AsTrie()
+        self.trie.insert("10.0.0.0/8", ["64496"])
+        self.trie.insert("10.1.0.0/16", ["64497", "64498"])
+        self.trie.insert("2001:db8::/32", ["64499"])
+        self.trie.insert("2001:db8:1::/48", ["64500"])
+
+    def test_longest_match_v4(self):
+        self.assertEqual(self.trie.lookup("10.1.2.3"), ["64497", "64498"])
+        self.assertEqual(self.trie.lookup("10.2.0.1"), ["64496"])
+
+    def test_longest_match_v6(self):
+        self.assertEqual(self.trie.lookup("2001:db8:1::1"), ["64500"])
+        self.assertEqual(self.trie.lookup("2001:db8:2::1"), ["64499"])
+
+    def test_uncovered_and_invalid_addresses(self):
+        self.assertIsNone(self.trie.lookup("192.0.2.1"))
+        self.assertIsNone(self.trie.lookup("2001:db9::1"))
+        self.assertIsNone(self.trie.lookup("not-an-ip"))
+
+    def test_families_are_separate(self):
+        self.trie.insert("0.0.0.0/0", ["64501"])
+        self.assertEqual(self.trie.lookup("192.0.2.1"), ["64501"])
+        self.assertIsNone(self.trie.lookup("2001:db9::1"))
+
+    def test_origins_are_shared(self):
+        self.trie.insert("10.2.0.0/16", ["64496"])
+        self.assertEqual(len(self.trie.origins), 4)
+        self.assertEqual(self.trie.prefixes, 5)
+
+    def test_lookup_many(self):
+        self.assertEqual(self.trie.lookup_many(["10.1.0.1", "10.1.0.1", "192.0.2.1"]),
+                         {"10.1.0.1": ["64497", "64498"], "192.0.2.1": None})
+
+
+class ParsePfx2AsLineTest(unittest.TestCase):
+
+    def test_single_origin(self):
+        self.assertEqual(parse_pfx2as_line("192.0.2.0\t24\t64496\n"), ("192.0.2.0/24", ["64496"]))
+
+    def test_moas_and_as_sets(self):
+        self.assertEqual(parse_pfx2as_line("192.0.2.0\t24\t64496_64497,64498\n"),
+                         ("192.0.2.0/24", ["64496", "64497", "64498"]))
+
+    def test_v6(self):
+        self.assertEqual(parse_pfx2as_line("2001:db8::\t32\t64499\n"), ("2001:db8::/32", ["64499"]))
+
+    def test_blank_and_comment_lines(self):
+        self.assertIsNone(parse_pfx2as_line("\n"))
+        self.assertIsNone(parse_pfx2as_line("# comment\n"))
+
+
+class Pfx2AsSnapshotDBTest(unittest.TestCase):
+
+    RESPONSES = [{
+        "dst_addr": "10.1.0.1",
+        "result": [
+            {"hop": 1, "result": [{"from": "10.0.0.1"}, {"x": "*"}]},
+            {"hop": 2, "result": [{"from": "192.0.2.1"}]},
+        ],
+    }]
+
+    def test_hop_ips(self):
+        self.assertEqual(traceroute_hop_ips(self.RESPONSES), {"10.1.0.1", "10.0.0.1", "192.0.2.1"})
+
+    def test_lookup_ignores_timestamps(self):
+        trie = Pfx2AsTrie()
+        trie.insert("10.0.0.0/8", ["64496"])
+        db = Pfx2AsSnapshotDB(trie, self.RESPONSES)
+        self.assertEqual(set(db.resolved), {"10.1.0.1", "10.0.0.1", "192.0.2.1"})
+        self.assertEqual(db.lookup("10.0.0.1", 1546300800), ["64496"])
+        self.assertIsNone(db.lookup("192.0.2.1"))
+        self.assertEqual(db.lookup("10.9.9.9"), ["64496"])
+
+
+if __name__ == "__main__":
+    unittest.main()